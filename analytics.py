@@ -0,0 +1,316 @@
+"""Derived features of the annotated situations, for dataset-scale queries.
+
+The features of every annotated object are computed for all situations at once
+from the columns of an AnnotationStore, in metres on the pitch:
+
+- "pass_distance": distance to the passing line, the segment from the ball at the
+  start of the pass to the hypothetical pass end location, or to the intended
+  pass receiver when no end location is annotated.
+- "pass_angle": angle in degrees at the start of the pass between the passing line
+  and the direction to the object, 0 for an object straight on the passing line.
+- "line_angle": angle in degrees between a drawn line, e.g. a body orientation
+  line, and the passing line, from 0 for parallel to 90 for perpendicular.
+- "voronoi_area": area in m² of the Voronoi region of a player within the pitch,
+  counted on a grid shared by the players of the same situation and phase.
+
+The features are indexed by situation and team, and both the features and the
+aggregations over them are cached until the store changes.
+"""
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache
+from instrumentation import timed
+from pitch import FootballPitch
+from pitch_control import get_grid, get_positions
+
+FEATURES = ["pass_distance", "pass_angle", "line_angle", "voronoi_area"]
+# Tags of the ends of the passing line, in order of preference
+PASS_START = ["ball @ start pass"]
+PASS_END = [
+    "hypothetical pass end location @ end pass",
+    "intended pass receiver @ start pass",
+    "ball @ end pass",
+]
+# Roles of annotated objects that are not players
+NOT_PLAYERS = ("ball", "hypothetical pass end location", "body orientation")
+ANALYTICS = LRUCache(max_entries=16)
+# Voronoi areas of the players of a situation, keyed by their positions, so that
+# editing a situation only recomputes its own areas
+VORONOI = LRUCache(max_entries=500_000)
+
+
+def get_pass_lines(codes, tags, xy, n_situations):
+    """Returns the start and end of the passing line of every situation.
+
+    Args:
+        codes (ndarray): Situation index of every object.
+        tags (ndarray): Lowercase tag of every object, e.g. "ball @ start pass".
+        xy (ndarray): Position of every object of size (n,2).
+        n_situations (int): Number of situations.
+
+    Returns:
+        tuple: The starts and ends of size (n_situations,2), NaN when a situation
+            has no passing line
+    """
+    ends = []
+    for names in (PASS_START, PASS_END):
+        points = np.full((n_situations, 2), np.nan)
+        # The most preferred tag is assigned last
+        for name in reversed(names):
+            rows = (tags == name) & np.isfinite(xy).all(axis=1)
+            points[codes[rows]] = xy[rows]
+        ends.append(points)
+    return tuple(ends)
+
+
+def get_segment_distances(points, start, end):
+    """Returns the distances of points to segments, broadcast together."""
+    direction = end - start
+    length2 = (direction**2).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((points - start) * direction).sum(axis=-1) / length2
+    t = np.where(length2 > 0, np.clip(t, 0, 1), 0)
+    return np.linalg.norm(points - (start + t[..., None] * direction), axis=-1)
+
+
+def get_angles(u, v):
+    """Returns the angles in degrees between vectors, in [0, 180], NaN for zero
+    vectors."""
+    cross = u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+    angles = np.degrees(np.abs(np.arctan2(cross, (u * v).sum(axis=-1))))
+    zero = (np.linalg.norm(u, axis=-1) == 0) | (np.linalg.norm(v, axis=-1) == 0)
+    return np.where(zero, np.nan, angles)
+
+
+def get_voronoi_areas(positions, grid, cell_area, chunk_size=256):
+    """Computes the Voronoi areas of the players of many situations by counting the
+    grid cells nearest to each player.
+
+    Args:
+        positions (ndarray): Positions in metres of size (situations, players, 2),
+            NaN where a situation has fewer players.
+        grid (ndarray): Cell centres in metres of size (cells,2).
+        cell_area (float): Area of a cell.
+        chunk_size (int, optional): Number of situations labelled in one batch.
+
+    Returns:
+        ndarray: The areas of size (situations, players), NaN for missing players
+    """
+    n_groups, n_players, _ = positions.shape
+    areas = np.full((n_groups, n_players), np.nan)
+    grid = grid.reshape(-1, 2).astype(np.float32)
+    for start in range(0, n_groups, chunk_size):
+        chunk = positions[start : start + chunk_size].astype(np.float32)
+        nearest = np.zeros((len(chunk), len(grid)), dtype=np.intp)
+        best = np.full((len(chunk), len(grid)), np.inf, dtype=np.float32)
+        # One pass per player slot keeps the arrays at (situations, cells)
+        for slot in range(n_players):
+            dx = grid[None, :, 0] - chunk[:, slot, None, 0]
+            dy = grid[None, :, 1] - chunk[:, slot, None, 1]
+            distances = dx * dx + dy * dy
+            closer = distances < best
+            best[closer] = distances[closer]
+            nearest[closer] = slot
+        labels = np.arange(len(chunk))[:, None] * n_players + nearest
+        counts = np.bincount(labels.ravel(), minlength=len(chunk) * n_players)
+        areas[start : start + len(chunk)] = counts.reshape(-1, n_players) * cell_area
+    areas[np.isnan(positions).any(axis=-1)] = np.nan
+    return areas
+
+
+def get_cached_voronoi_areas(positions, grid, cell_area):
+    """Returns the Voronoi areas of get_voronoi_areas, computing only those of the
+    situations whose players are not in the VORONOI cache.
+
+    Args:
+        positions (ndarray): Positions in metres of size (situations, players, 2),
+            with the players of every situation first, then NaN.
+        grid (ndarray): Cell centres in metres of size (cells,2).
+        cell_area (float): Area of a cell.
+
+    Returns:
+        ndarray: The areas of size (situations, players)
+    """
+    n_players = (~np.isnan(positions).any(axis=-1)).sum(axis=1)
+    keys = [
+        (len(grid), cell_area, row[:n].tobytes())
+        for row, n in zip(positions, n_players)
+    ]
+    areas = np.full(positions.shape[:2], np.nan)
+    missing = []
+    for index, key in enumerate(keys):
+        cached = VORONOI.get(key)
+        if cached is None:
+            missing.append(index)
+        else:
+            areas[index, : len(cached)] = cached
+    if missing:
+        areas[missing] = get_voronoi_areas(positions[missing], grid, cell_area)
+        for index in missing:
+            VORONOI.put(keys[index], areas[index, : n_players[index]].copy())
+    return areas
+
+
+@timed()
+def calculate_features(df, pitch=None, n_x=53):
+    """Computes the features of the annotated objects of all situations.
+
+    Args:
+        df (DataFrame): Annotations, e.g. AnnotationStore.to_frame(), with the
+            "situation_id", the tag as "team" and the position "x", "y" in percent
+            of the pitch of every object, and the "x_start", "y_start", "x_end",
+            "y_end" of lines.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        n_x (int, optional): Number of cells of the Voronoi grid along the length
+            of the pitch.
+
+    Returns:
+        DataFrame: The annotations with their "role", "phase" and FEATURES, indexed
+            by "situation_id" and "team"
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    # Tags are parsed once per distinct tag
+    tag_codes, unique_tags = pd.factorize(df["team"].astype(str))
+    unique_tags = unique_tags.str.lower()
+    parts = unique_tags.str.partition(" @ ")
+    tags = unique_tags.values[tag_codes]
+    roles = parts.get_level_values(0)
+    role = roles.values[tag_codes]
+    phase = parts.get_level_values(2).values[tag_codes]
+    codes, situations = pd.factorize(df["situation_id"])
+    metres = np.array([pitch.X_SIZE, pitch.Y_SIZE]) / 100
+    xy = get_positions(df, pitch)
+    line_start = df[["x_start", "y_start"]].values.astype(float) * metres
+    line_end = df[["x_end", "y_end"]].values.astype(float) * metres
+
+    pass_start, pass_end = get_pass_lines(codes, tags, xy, len(situations))
+    pass_start, pass_end = pass_start[codes], pass_end[codes]
+    pass_direction = pass_end - pass_start
+    line_angle = get_angles(line_end - line_start, pass_direction)
+
+    grid = get_grid(pitch, n_x)
+    n_y = grid.shape[0]
+    players = ~np.asarray(roles.str.startswith(NOT_PLAYERS))[tag_codes]
+    players &= np.isfinite(xy).all(axis=1)
+    players &= np.isnan(line_start).any(axis=1)
+    rows = np.flatnonzero(players)
+    groups = pd.MultiIndex.from_arrays([codes[rows], phase[rows]])
+    group_codes, _ = pd.factorize(groups)
+    slots = pd.Series(group_codes).groupby(group_codes).cumcount().values
+    shape = (group_codes.max() + 1, slots.max() + 1) if len(rows) else (0, 0)
+    positions = np.full(shape + (2,), np.nan)
+    positions[group_codes, slots] = xy[rows]
+    cell_area = pitch.X_SIZE * pitch.Y_SIZE / (n_x * n_y)
+    voronoi_area = np.full(len(df), np.nan)
+    voronoi_area[rows] = get_cached_voronoi_areas(positions, grid, cell_area)[
+        group_codes, slots
+    ]
+
+    features = df.assign(
+        role=role,
+        phase=phase,
+        pass_distance=get_segment_distances(xy, pass_start, pass_end),
+        pass_angle=get_angles(xy - pass_start, pass_direction),
+        line_angle=np.minimum(line_angle, 180 - line_angle),
+        voronoi_area=voronoi_area,
+    )
+    return features.set_index(["situation_id", "team"]).sort_index()
+
+
+def _get_key(values):
+    if values is None:
+        return None
+    if np.ndim(values) == 0:
+        return (values,)
+    return tuple(values)
+
+
+def get_features(store, pitch=None, n_x=53):
+    """Returns the features of calculate_features for an AnnotationStore, once per
+    version of its data."""
+    key = ("features", store.uid, store.version, type(pitch).__name__, n_x)
+    features = ANALYTICS.get(key)
+    if features is None:
+        features = ANALYTICS.put(key, calculate_features(store.to_frame(), pitch, n_x))
+    return features
+
+
+def query(store, situations=None, teams=None, roles=None, pitch=None, n_x=53):
+    """Selects the features of some situations, teams and roles.
+
+    Args:
+        store (AnnotationStore): The annotations.
+        situations (optional): A situation id or a list of them. Defaults to all.
+        teams (optional): A tag or a list of them. Defaults to all.
+        roles (optional): A lowercase role, e.g. "interception candidate", or a
+            list of them. Defaults to all.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        n_x (int, optional): Number of cells of the Voronoi grid along the length
+            of the pitch.
+
+    Returns:
+        DataFrame: The selected rows of get_features
+    """
+    features = get_features(store, pitch, n_x)
+    index = features.index
+    selected = np.ones(len(features), dtype=bool)
+    # Labels are matched against the levels of the index, not against every row
+    for level, values in enumerate([situations, teams]):
+        if values is not None:
+            in_level = index.levels[level].isin(_get_key(values))
+            selected &= in_level[index.codes[level]] & (index.codes[level] >= 0)
+    if roles is not None:
+        selected &= features["role"].isin(_get_key(roles)).values
+    return features[selected]
+
+
+def aggregate(
+    store,
+    by=("team",),
+    features=FEATURES,
+    agg="mean",
+    situations=None,
+    teams=None,
+    roles=None,
+    pitch=None,
+    n_x=53,
+):
+    """Aggregates features over groups of annotated objects, once per version of
+    the store and arguments.
+
+    Args:
+        store (AnnotationStore): The annotations.
+        by (tuple, optional): Index levels or columns to group by, e.g.
+            ("situation_id", "team") or ("role", "phase").
+        features (list, optional): Aggregated columns. Defaults to FEATURES.
+        agg (optional): A function name or a list of them, as accepted by
+            DataFrameGroupBy.agg.
+        situations, teams, roles (optional): Filters of query.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        n_x (int, optional): Number of cells of the Voronoi grid along the length
+            of the pitch.
+
+    Returns:
+        DataFrame: The aggregated features of every group
+    """
+    key = (
+        "aggregate",
+        store.uid,
+        store.version,
+        _get_key(by),
+        _get_key(features),
+        _get_key(agg),
+        _get_key(situations),
+        _get_key(teams),
+        _get_key(roles),
+        type(pitch).__name__,
+        n_x,
+    )
+    result = ANALYTICS.get(key)
+    if result is None:
+        selected = query(store, situations, teams, roles, pitch, n_x)
+        result = selected.groupby(list(by), dropna=False)[list(features)].agg(agg)
+        result = ANALYTICS.put(key, result)
+    return result
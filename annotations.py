@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+KEY = ("situation_id", "object_id")
+
+
+def _get_missing(dtype):
+    return np.nan if np.dtype(dtype).kind == "f" else None
+
+
+def _equal(a, b):
+    # Missing values, e.g. the line ends of a rectangle, are equal to each other
+    return a == b or (pd.isna(a) and pd.isna(b))
+
+
+class AnnotationStore:
+    """Columnar store of annotated objects, keyed by situation and canvas object.
+
+    Rows live in preallocated column buffers that double in size when full, and a
+    dict maps each (situation_id, object_id) key to its row, so adding or updating
+    an annotation does not depend on the number of rows already stored. A row that
+    is upserted again with the same key replaces the previous values instead of
+    being appended. The store is periodically written to a Parquet file and
+    reloaded from it, so a crash or a page refresh does not lose the session.
+
+    Changes are flushed after flush_every changed rows, or at the latest
+    flush_interval seconds after the first unflushed change: a background timer
+    flushes them even if the session makes no further edits.
+    """
+
+    def __init__(
+        self,
+        columns,
+        dtypes=None,
+        path=None,
+        flush_every=20,
+        flush_interval=30.0,
+        capacity=256,
+    ):
+        """
+        Args:
+            columns (list): Names of the stored columns, besides the key columns.
+            dtypes (dict, optional): Numpy dtype of some columns, e.g. {"x": float}.
+                Other columns are stored as objects.
+            path (str, optional): Parquet file the store is flushed to and loaded
+                from. Defaults to no persistence.
+            flush_every (int, optional): Number of changed rows after which the store
+                is flushed.
+            flush_interval (float, optional): Seconds after which pending changes
+                are flushed.
+            capacity (int, optional): Initial number of rows of the buffers.
+        """
+        self.columns = list(dict.fromkeys(list(KEY) + list(columns)))
+        self.dtypes = {c: (dtypes or {}).get(c, object) for c in self.columns}
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        # Identifies the data of the store in caches, unlike id() which is reused
+        # once the store is garbage collected
+        self.uid = uuid.uuid4().hex
+        self.n_rows = 0
+        self.version = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._frame = None
+        self._index = {}
+        self._lock = threading.RLock()
+        self._timer = None
+        self._data = {
+            c: np.full(capacity, _get_missing(self.dtypes[c]), dtype=self.dtypes[c])
+            for c in self.columns
+        }
+        if path is not None and os.path.exists(path):
+            self.upsert(pd.read_parquet(path), flush=False)
+            self._pending = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _grow(self, n_rows):
+        capacity = len(self._data[self.columns[0]])
+        if n_rows <= capacity:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        for column, values in self._data.items():
+            grown = np.full(capacity, _get_missing(values.dtype), dtype=values.dtype)
+            grown[: self.n_rows] = values[: self.n_rows]
+            self._data[column] = grown
+
+    def upsert(self, df, flush=True):
+        """Adds the rows of a DataFrame, replacing the rows with the same key.
+
+        Args:
+            df (DataFrame): Rows with the key columns and some of the store columns.
+            flush (bool, optional): If True, flushes to disk when due, or schedules
+                a flush flush_interval seconds after the last one.
+
+        Returns:
+            int: The number of rows added or changed
+        """
+        with self._lock:
+            changed = self._upsert(df)
+            if changed and flush:
+                if self._flush_due():
+                    self.flush()
+                else:
+                    self._schedule_flush()
+        return changed
+
+    def _upsert(self, df):
+        columns = [c for c in self.columns if c in df.columns]
+        missing = [c for c in self.columns if c not in df.columns]
+        values = {c: df[c].values for c in columns}
+        keys = zip(*(df[c].values for c in KEY))
+        self._grow(self.n_rows + len(df))
+        changed = 0
+        for i, key in enumerate(keys):
+            row = self._index.get(key)
+            if row is None:
+                row = self._index[key] = self.n_rows
+                self.n_rows += 1
+                for column in missing:
+                    self._data[column][row] = _get_missing(self.dtypes[column])
+            elif all(_equal(self._data[c][row], values[c][i]) for c in columns):
+                continue
+            for column in columns:
+                self._data[column][row] = values[column][i]
+            changed += 1
+        if changed:
+            self.version += 1
+            self._pending += changed
+            self._frame = None
+        return changed
+
+    def _flush_due(self):
+        return self._pending >= self.flush_every or (
+            time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def _schedule_flush(self):
+        if self.path is None or self._timer is not None:
+            return
+        delay = max(0.0, self.flush_interval - (time.monotonic() - self._last_flush))
+        self._timer = threading.Timer(delay, self._flush_pending)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush_pending(self):
+        with self._lock:
+            self._timer = None
+            if self._pending:
+                self.flush()
+
+    def flush(self):
+        """Writes the store to its Parquet file, if any."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.path is not None:
+                tmp_path = f"{self.path}.tmp"
+                self.to_frame().to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, self.path)
+            self._pending = 0
+            self._last_flush = time.monotonic()
+
+    def clear(self):
+        """Removes every row, including from the Parquet file."""
+        with self._lock:
+            self.n_rows = 0
+            self._index.clear()
+            self.version += 1
+            self._frame = None
+            self.flush()
+
+    def to_frame(self):
+        """Returns the rows as a DataFrame, cached until the store changes."""
+        with self._lock:
+            if self._frame is None:
+                self._frame = pd.DataFrame(
+                    {c: self._data[c][: self.n_rows] for c in self.columns}
+                )
+            return self._frame
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path, columns, dtypes=None, **kwargs):
+    """Returns the store of a Parquet file, shared by everyone opening the same file
+    in the process, so that the sessions of a project do not overwrite each other's
+    annotations.
+
+    Args:
+        path (str): Parquet file of the store.
+        columns (list): Names of the stored columns, besides the key columns.
+        dtypes (dict, optional): Numpy dtype of some columns.
+        **kwargs: Passed to AnnotationStore when the store is first opened.
+
+    Returns:
+        AnnotationStore: The store, loaded from the file if it exists
+    """
+    path = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = AnnotationStore(columns, dtypes, path, **kwargs)
+        return store
@@ -0,0 +1,300 @@
+"""Headless pipeline warping a whole video to a bird's-eye view.
+
+Usage:
+    python batch.py match.mp4 calibration.json birdseye.mp4 --workers 8
+
+The calibration is a JSON file holding either a "homography" matrix or the canvas
+line "objects" with their pitch "lines" names, plus the "image_size" the lines or
+the homography were defined on (as downloaded from the app). For moving cameras, a
+.npz file of per-frame homographies written by camera_tracking.py can be used
+instead.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from geometry import get_output_size, warp_image
+from helpers import calibrate_lines, get_edge_img, get_lines_info
+from pitch import PITCHES, FootballPitch
+
+
+def load_calibration(path, pitch):
+    """Loads a saved calibration as a homography matrix.
+
+    Args:
+        path (str): Path of the calibration JSON file, or of a .npz file with the
+            per-frame "homographies" of camera_tracking.py.
+        pitch (Pitch): The pitch the lines refer to.
+
+    Returns:
+        tuple: The (3,3) homography matrix, or a (f,3,3) stack of per-frame
+            matrices, and the (width, height) of the image it was computed on
+    """
+    if path.endswith(".npz"):
+        calibration = np.load(path)
+        return calibration["homographies"], tuple(calibration["image_size"])
+    with open(path) as fp:
+        calibration = json.load(fp)
+    if "homography" in calibration:
+        h = np.array(calibration["homography"], dtype=float)
+    else:
+        lines = calibration["lines"]
+        df = get_lines_info(pd.json_normalize(calibration["objects"]), lines)
+        h = calibrate_lines(pitch, df, lines)[0].h
+    return h, tuple(calibration["image_size"])
+
+
+def scale_homography(h, image_size, frame_size):
+    """Adapts a homography computed on a resized image to full resolution frames."""
+    sx, sy = np.array(image_size, dtype=float) / np.array(frame_size, dtype=float)
+    return h @ np.diag([sx, sy, 1.0])
+
+
+def read_frames(path, start=0, stop=None):
+    """Yields the BGR frames of a video from index start (included) to stop (excluded)."""
+    video = cv2.VideoCapture(path)
+    try:
+        if start:
+            video.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while stop is None or index < stop:
+            success, frame = video.read()
+            if not success:
+                break
+            yield frame
+            index += 1
+    finally:
+        video.release()
+
+
+def warp_frames(frames, h, size, remap=False):
+    """Warps frames with one homography or with a sequence of per-frame homographies."""
+    warp = warp_image if remap else cv2.warpPerspective
+    homographies = h if np.ndim(h) == 3 else repeat(h)
+    for frame, h in zip(frames, homographies):
+        yield warp(frame, h, size)
+
+
+def mask_frames(frames, sensitivity):
+    """Blacks out the pixels of the warped frames that are not part of the pitch."""
+    for frame in frames:
+        mask = get_edge_img(frame, sensitivity)
+        yield cv2.bitwise_and(frame, frame, mask=mask)
+
+
+def write_frames(frames, path, fps, size, fourcc="mp4v"):
+    """Encodes frames to a video file and returns the number of frames written."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+    n_frames = 0
+    try:
+        for frame in frames:
+            writer.write(frame)
+            n_frames += 1
+    finally:
+        writer.release()
+    return n_frames
+
+
+def get_video_info(path):
+    video = cv2.VideoCapture(path)
+    try:
+        n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = video.get(cv2.CAP_PROP_FPS) or 25.0
+        size = (
+            int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        )
+    finally:
+        video.release()
+    return n_frames, fps, size
+
+
+def warp_video(
+    video_path,
+    out_path,
+    h,
+    size,
+    start=0,
+    stop=None,
+    sensitivity=None,
+    fourcc="mp4v",
+    remap=False,
+):
+    """Streams frames start to stop of a video through decode, warp and encode.
+
+    Memory use does not depend on the length of the video.
+
+    Returns:
+        int: The number of frames written
+    """
+    _, fps, _ = get_video_info(video_path)
+    if np.ndim(h) == 3:
+        h = h[start:stop]
+    frames = warp_frames(read_frames(video_path, start, stop), h, size, remap)
+    if sensitivity is not None:
+        frames = mask_frames(frames, sensitivity)
+    return write_frames(frames, out_path, fps, size, fourcc)
+
+
+def get_chunks(n_frames, n_chunks):
+    bounds = np.linspace(0, n_frames, n_chunks + 1).astype(int)
+    return [
+        (start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+    ]
+
+
+# Codec of the parts of a parallel run when they cannot be joined without
+# re-encoding, so that the output is only encoded lossily once
+LOSSLESS_FOURCC = "FFV1"
+
+
+def concat_videos(paths, out_path):
+    """Joins videos of the same codec and size without re-encoding them.
+
+    Returns:
+        bool: False if ffmpeg is not installed, in which case nothing is written
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return False
+    list_path = f"{out_path}.parts.txt"
+    with open(list_path, "w") as fp:
+        fp.writelines(f"file '{os.path.abspath(path)}'\n" for path in paths)
+    try:
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0"]
+            + ["-i", list_path, "-c", "copy", out_path],
+            check=True,
+        )
+    finally:
+        os.remove(list_path)
+    return True
+
+
+def process_video(
+    video_path,
+    calibration_path,
+    out_path,
+    pitch=None,
+    workers=1,
+    chunks=None,
+    sensitivity=None,
+    fourcc="mp4v",
+    remap=False,
+    scale=1,
+):
+    """Warps every frame of a video to a bird's-eye view of the pitch.
+
+    Args:
+        video_path (str): Path of the input video.
+        calibration_path (str): Path of the calibration JSON file.
+        out_path (str): Path of the output video.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        workers (int, optional): Number of processes. Defaults to 1.
+        chunks (int, optional): Number of chunks the video is split into when
+            workers > 1. Defaults to 4 chunks per worker.
+        sensitivity (int, optional): If set, masks out non-pitch pixels with
+            get_edge_img at this sensitivity.
+        fourcc (str, optional): Codec of the output video. Defaults to "mp4v".
+        remap (bool, optional): If True, warps with cached cv2.remap lookup tables
+            instead of cv2.warpPerspective. Defaults to False.
+        scale (float, optional): Resolution of the output relative to pitch.SCALE
+            pixels per metre. Defaults to 1.
+
+    Returns:
+        int: The number of frames written
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    size = get_output_size(pitch, scale)
+    n_frames, fps, frame_size = get_video_info(video_path)
+    h, image_size = load_calibration(calibration_path, pitch)
+    h = np.diag([scale, scale, 1.0]) @ scale_homography(h, image_size, frame_size)
+
+    if workers <= 1 or n_frames <= 0:
+        return warp_video(
+            video_path, out_path, h, size, 0, None, sensitivity, fourcc, remap
+        )
+
+    # With ffmpeg, the parts are encoded like the output and joined as they are.
+    # Otherwise they are encoded losslessly and re-encoded once into the output.
+    can_concat = shutil.which("ffmpeg") is not None
+    _, ext = os.path.splitext(out_path)
+    part_ext, part_fourcc = (ext, fourcc) if can_concat else (".avi", LOSSLESS_FOURCC)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        chunk_bounds = get_chunks(n_frames, chunks or 4 * workers)
+        parts = [
+            os.path.join(tmp_dir, f"part{i:05d}{part_ext}")
+            for i in range(len(chunk_bounds))
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    warp_video,
+                    video_path,
+                    part,
+                    h,
+                    size,
+                    *bounds,
+                    sensitivity,
+                    part_fourcc,
+                    remap,
+                )
+                for part, bounds in zip(parts, chunk_bounds)
+            ]
+            n_written = sum(future.result() for future in futures)
+        if can_concat and concat_videos(parts, out_path):
+            return n_written
+        frames = (frame for part in parts for frame in read_frames(part))
+        return write_frames(frames, out_path, fps, size, fourcc)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("video", help="input video")
+    parser.add_argument("calibration", help="calibration JSON file")
+    parser.add_argument("output", help="output video")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunks", type=int, default=None)
+    parser.add_argument("--sensitivity", type=int, default=None)
+    parser.add_argument("--fourcc", default="mp4v")
+    parser.add_argument(
+        "--remap", action="store_true", help="warp with cached remap lookup tables"
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1,
+        help="output resolution relative to pitch.SCALE",
+    )
+    parser.add_argument("--pitch", choices=list(PITCHES), default="Football")
+    args = parser.parse_args(argv)
+    n_frames = process_video(
+        args.video,
+        args.calibration,
+        args.output,
+        workers=args.workers,
+        chunks=args.chunks,
+        sensitivity=args.sensitivity,
+        fourcc=args.fourcc,
+        remap=args.remap,
+        scale=args.scale,
+        pitch=PITCHES[args.pitch],
+    )
+    print(f"Wrote {n_frames} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
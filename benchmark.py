@@ -0,0 +1,377 @@
+"""Benchmarks of the transform, projection and rendering hot paths.
+
+Usage:
+    python benchmark.py [--filter NAME] [--quick]
+    python benchmark.py --save baseline.json
+    python benchmark.py --baseline baseline.json [--tolerance 0.25]
+
+Every benchmark runs on synthetic frames and point sets, over a sweep of input sizes
+up to a full match of 22 players over 135k frames. The timings can be saved as a
+baseline, and a later run compared against it flags every case slower than its
+baseline by more than the tolerance, and exits with status 1.
+"""
+
+import argparse
+import json
+import platform
+import re
+import subprocess
+import sys
+import timeit
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import analytics
+from calibration import solve_homographies
+from helpers import (
+    CanvasParser,
+    Homography,
+    PitchDraw,
+    PitchImage,
+    VoronoiPitch,
+    get_converted_positional_data,
+    get_edge_img,
+    get_warp_maps,
+    project_points,
+    warp_image,
+)
+from overlay import draw_overlays
+from pitch import FootballPitch
+
+PTS_SRC = [
+    [160.0444, 34.4228],
+    [408.3040, 199.1448],
+    [342.0459, 18.1934],
+    [670.2333, 163.3532],
+]
+PTS_DST = [[442.5, 69.2], [442.5, 270.8], [525, 69.2], [525, 270.8]]
+HEAVY_MODULES = [
+    "pandas",
+    "scipy",
+    "shapely",
+    "PIL",
+    "streamlit",
+    "streamlit_drawable_canvas",
+]
+
+# Width of the case column of the results table
+CASE_WIDTH = 48
+TAGS = {"Attacking team": "#ff0000", "Defending team": "#0000ff"}
+
+
+def get_frame(width=1280, height=720, seed=0):
+    """Returns a BGR frame of grass-like noise."""
+    rng = np.random.default_rng(seed)
+    frame = rng.normal((40, 140, 50), 12, (height, width, 3))
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def get_snapshot(width=600):
+    """Returns a calibrated PitchImage of a synthetic frame."""
+    snapshot = PitchImage(FootballPitch(), image=get_frame(), width=width)
+    pts_src = np.array(PTS_SRC) * width / 600
+    snapshot.set_homography(Homography(pts_src, PTS_DST), ["UP", "DP", "RPA", "RG"])
+    return snapshot
+
+
+def get_positions(n, seed=0):
+    """Returns n positions in percent of the pitch with their team color."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "x": rng.uniform(0, 100, n),
+            "y": rng.uniform(0, 100, n),
+            "team": rng.choice(list(TAGS.values()), n),
+        }
+    )
+
+
+def get_canvas(n, seed=0):
+    """Returns an object mimicking the result of st_canvas with n drawn circles."""
+    rng = np.random.default_rng(seed)
+    objects = [
+        {
+            "type": "circle",
+            "left": float(left),
+            "top": float(top),
+            "width": 6.0,
+            "height": 6.0,
+            "scaleX": 1.0,
+            "scaleY": 1.0,
+            "stroke": str(stroke),
+        }
+        for left, top, stroke in zip(
+            rng.uniform(0, 600, n),
+            rng.uniform(0, 300, n),
+            rng.choice(list(TAGS.values()), n),
+        )
+    ]
+    return SimpleNamespace(json_data={"objects": objects})
+
+
+def bench_apply_to_points(n_frames):
+    h = Homography(PTS_SRC, PTS_DST)
+    points = np.random.default_rng(0).uniform(0, 600, (n_frames, 22, 2))
+    return lambda: h.apply_to_points(points)
+
+
+def bench_apply_to_image(width):
+    snapshot = get_snapshot(width)
+    return lambda: snapshot.h.apply_to_image(snapshot)
+
+
+def bench_warp_perspective(scale):
+    frame, h, size = get_warp_inputs(scale)
+    return lambda: cv2.warpPerspective(frame, h, size)
+
+
+def bench_warp_image(scale):
+    frame, h, size = get_warp_inputs(scale)
+    get_warp_maps(h, size)
+    return lambda: warp_image(frame, h, size)
+
+
+def get_warp_inputs(scale):
+    frame = get_frame()
+    h = Homography(PTS_SRC, PTS_DST).h @ np.diag([600 / frame.shape[1]] * 2 + [1])
+    size = (525 * scale, 340 * scale)
+    return frame, np.diag([scale, scale, 1.0]) @ h, size
+
+
+def bench_solve_homographies(n_frames):
+    h = Homography(PTS_SRC, PTS_DST).h
+    pts_dst = np.array(list(FootballPitch().get_intersections().values()))
+    pts_src = np.tile(project_points(pts_dst, np.linalg.inv(h)), (n_frames, 1, 1))
+    pts_src += np.random.default_rng(0).normal(0, 0.5, pts_src.shape)
+    return lambda: solve_homographies(pts_src, pts_dst)
+
+
+def bench_get_edge_img(width):
+    frame = get_frame(width, width * 9 // 16)
+    return lambda: get_edge_img(frame)
+
+
+def bench_voronoi(n_players):
+    snapshot = get_snapshot()
+    df = get_positions(n_players)
+    return lambda: VoronoiPitch(df).get_voronoi_polygons(snapshot)
+
+
+def bench_draw_circle(n_players):
+    snapshot = get_snapshot()
+    df = get_positions(n_players)
+
+    def draw():
+        drawing = PitchDraw(snapshot)
+        for x, y, team in df.values:
+            drawing.draw_circle((x, y), team, size=2, opacity=200)
+
+    return draw
+
+
+def bench_draw_circles(n_players):
+    snapshot = get_snapshot()
+    df = get_positions(n_players)
+    return lambda: PitchDraw(snapshot).draw_circles(
+        df[["x", "y"]].values, df["team"].values, size=2, opacity=200
+    )
+
+
+def bench_draw_overlays(n_frames):
+    frames = [get_frame(525, 340)] * n_frames
+    positions = np.random.default_rng(0).uniform(0, 100, (n_frames, 22, 2))
+    colors = np.random.default_rng(0).choice(list(TAGS.values()), (n_frames, 22))
+    return lambda: list(draw_overlays(frames, positions, colors, size=2, opacity=200))
+
+
+def bench_analytics(n_situations):
+    roles = ["Ball", "Intended pass receiver"] + ["Interception candidate"] * 4
+    df = get_positions(n_situations * len(roles)).assign(
+        situation_id=np.repeat(np.arange(n_situations), len(roles)),
+        team=[f"{role} @ Start pass" for role in roles] * n_situations,
+        x_start=np.nan,
+        y_start=np.nan,
+        x_end=np.nan,
+        y_end=np.nan,
+    )
+
+    def calculate():
+        # Every situation is new to the Voronoi cache
+        analytics.VORONOI.clear()
+        analytics.calculate_features(df)
+
+    return calculate
+
+
+def bench_compose_image(width):
+    snapshot = get_snapshot(width)
+    return lambda: PitchDraw(snapshot).compose_image()
+
+
+def bench_converted_positional_data(n_objects):
+    snapshot = get_snapshot()
+    canvas = get_canvas(n_objects)
+    return lambda: get_converted_positional_data(TAGS, snapshot, True, canvas)
+
+
+def bench_converted_positional_data_incremental(n_objects):
+    snapshot = get_snapshot()
+    canvas = get_canvas(n_objects)
+    parser = CanvasParser()
+    objects = canvas.json_data["objects"]
+
+    def convert():
+        # One object is redrawn at the end, as after an undo and a new rectangle
+        canvas.json_data["objects"] = objects[:-1] + [dict(objects[-1])]
+        return get_converted_positional_data(TAGS, snapshot, True, canvas, parser)
+
+    return convert
+
+
+def measure_import(module):
+    """Imports a module in a fresh interpreter.
+
+    Returns:
+        tuple: The import time in seconds and the heavy dependencies it loaded
+    """
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "seconds = time.perf_counter() - start\n"
+        f"loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+        "print(json.dumps([seconds, loaded]))\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    seconds, loaded = json.loads(output.splitlines()[-1])
+    return seconds, loaded
+
+
+def bench_import(module):
+    return lambda: measure_import(module)
+
+
+# name: (function, sizes, sizes of a quick run)
+BENCHMARKS = {
+    "import": (bench_import, ["geometry", "calibration", "helpers"], ["geometry"]),
+    "apply_to_points": (bench_apply_to_points, [1, 1000, 135000], [1, 1000]),
+    "apply_to_image": (bench_apply_to_image, [300, 600, 1200], [600]),
+    "warpPerspective": (bench_warp_perspective, [1, 2, 4], [1]),
+    "warp_image": (bench_warp_image, [1, 2, 4], [1]),
+    "solve_homographies": (bench_solve_homographies, [1, 1000, 10000], [1]),
+    "get_edge_img": (bench_get_edge_img, [640, 1280, 1920], [1280]),
+    "voronoi": (bench_voronoi, [22, 100, 1000], [22]),
+    "draw_circle": (bench_draw_circle, [22, 100, 1000], [22]),
+    "draw_circles": (bench_draw_circles, [22, 100, 1000], [22]),
+    "draw_overlays": (bench_draw_overlays, [1, 100, 1000], [1]),
+    "analytics": (bench_analytics, [1, 100, 10000], [1]),
+    "compose_image": (bench_compose_image, [300, 600, 1200], [600]),
+    "converted_positional_data": (
+        bench_converted_positional_data,
+        [22, 220, 2200],
+        [22],
+    ),
+    "converted_positional_data_incremental": (
+        bench_converted_positional_data_incremental,
+        [22, 220, 2200],
+        [22],
+    ),
+}
+
+
+def measure(func, repeat=3, min_time=0.2):
+    """Returns the best time of one call in seconds, over repeat runs of enough
+    calls to last min_time."""
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time and number < 10**6:
+        number *= 10 if number == 1 else 2
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(pattern=None, quick=False):
+    """Runs the benchmarks whose name matches a regular expression.
+
+    Returns:
+        dict: The time in seconds of every case, keyed by "name[size]"
+    """
+    results = {}
+    for name, (bench, sizes, quick_sizes) in BENCHMARKS.items():
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        for size in quick_sizes if quick else sizes:
+            func = bench(size)
+            results[f"{name}[{size}]"] = measure(
+                func, repeat=1 if quick else 3, min_time=0.05 if quick else 0.2
+            )
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Returns the cases slower than their baseline by more than the tolerance,
+    with their ratio to the baseline."""
+    return {
+        case: seconds / baseline[case]
+        for case, seconds in results.items()
+        if case in baseline and seconds > baseline[case] * (1 + tolerance)
+    }
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", help="regular expression on benchmark names")
+    parser.add_argument("--quick", action="store_true", help="small sizes only")
+    parser.add_argument("--save", help="save the timings as a baseline JSON file")
+    parser.add_argument("--baseline", help="baseline JSON file to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative slowdown flagged as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = run(args.filter, args.quick)
+    regressions = compare(results, baseline, args.tolerance)
+    print(f"{'case':<{CASE_WIDTH}} {'time':>11} {'baseline':>11} {'ratio':>7}")
+    for case, seconds in results.items():
+        line = f"{case:<{CASE_WIDTH}} {seconds * 1000:>9.3f}ms"
+        if case in baseline:
+            line += f" {baseline[case] * 1000:>9.3f}ms"
+            line += f" {seconds / baseline[case]:>6.2f}x"
+            if case in regressions:
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"environment": get_environment(), "results": results}, f, indent=2
+            )
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,18 +1,30 @@
-from dataclasses import dataclass
+import os
+import re
 
 import pandas as pd
 import streamlit as st
 from streamlit_drawable_canvas import st_canvas
 
+import instrumentation
+from analytics import aggregate
+from annotations import get_store
 from helpers import (
+    CanvasParser,
     download_data,
     visualize_pitch,
     get_field_lines,
+    get_calibration_download_link,
+    get_image_download_link,
     get_converted_positional_data,
     VoronoiPitch,
     PitchDraw,
+    split_calibration_objects,
 )
-from pitch import FootballPitch
+from pitch import PITCHES
+from sessions import Session, get_manager
+
+# The line and player detectors are imported on first use, as most sessions only
+# draw lines and annotate by hand
 
 tags = {
     "Direct opponent of pass sender @ Pre pass": "#00fff1",
@@ -41,62 +53,141 @@ columns_of_interest = [
     "situation_id",
     "facing_passing_line",
     "nationality",
+    "x_start",
+    "y_start",
+    "x_end",
+    "y_end",
 ]
 
 st.set_option("deprecation.showfileUploaderEncoding", False)
 st.beta_set_page_config(page_title="BirdsPyView", layout="wide")
 
 
-@dataclass
-class SessionState:
-    positional_data = pd.DataFrame(columns=columns_of_interest)
+class SessionState(Session):
+    def __init__(self, session_id):
+        super().__init__(session_id, max_bytes=512 * 2**20)
+        self.store = None
+        self.canvas_parser = CanvasParser()
 
+    def open_project(self, project):
+        """Opens the annotations of a project, which outlive the session id, as it
+        changes on every page refresh. Sessions of the same project share them."""
+        project = re.sub(r"[^\w-]", "_", project.strip()) or "annotations"
+        path = os.environ.get("BPV_ANNOTATIONS", "{project}.parquet").format(
+            project=project
+        )
+        if self.store is None or self.store.path != os.path.abspath(path):
+            if self.store is not None:
+                self.store.flush()
+            self.store = get_store(
+                path,
+                columns_of_interest,
+                dtypes={
+                    c: float for c in ["x", "y", "x_start", "y_start", "x_end", "y_end"]
+                },
+            )
 
-@st.cache(allow_output_mutation=True)
-def fetch_session():
-    session = SessionState()
-    return session
+    def close(self):
+        if self.store is not None:
+            self.store.flush()
+        instrumentation.disable(owner=self.id)
+        super().close()
 
 
-session = fetch_session()
+session = get_manager(SessionState).get()
+session.open_project(st.sidebar.text_input("Project", "annotations"))
+
+show_counters = st.sidebar.checkbox("Show performance counters")
+if show_counters:
+    instrumentation.enable(
+        memory=st.sidebar.checkbox("Trace allocations (slower)"), owner=session.id
+    )
+else:
+    instrumentation.disable(owner=session.id)
 
 st.title("Upload Image or Video")
 uploaded_file = st.file_uploader(
     "Select Image file to open:", type=["png", "jpg", "mp4"]
 )
-pitch = FootballPitch()
+pitch = PITCHES[st.sidebar.selectbox("Pitch", list(PITCHES))]
 
 if uploaded_file:
-    snapshot = visualize_pitch(uploaded_file, pitch)
+    snapshot = visualize_pitch(uploaded_file, pitch, session)
 
     st.title("Pitch lines")
 
     lines_expander = st.beta_expander(
-        "Draw pitch lines on selected image (2 horizontal lines, then 2 vertical lines)",
+        "Draw pitch lines on selected image (at least 2 horizontal and 2 vertical "
+        "lines) and optionally keypoints, then name each of them",
         expanded=True,
     )
     with lines_expander:
         col1, col2, col_, col3 = st.beta_columns([2, 1, 0.5, 1])
 
-        canvas_image, hlines, vlines = get_field_lines(
-            pitch, snapshot, col1, col2, col3
-        )
+        canvas_image, names = get_field_lines(pitch, snapshot, col1, col2, col3)
+        with col2:
+            detect_lines = st.checkbox(
+                "Detect pitch lines automatically if fewer than 4 lines are drawn"
+            )
 
     if canvas_image.json_data is not None:
-        n_lines = len(canvas_image.json_data["objects"])
+        objects = canvas_image.json_data["objects"]
+        n_lines = sum(obj["type"] == "line" for obj in objects)
         with col3:
             st.write(
-                f"You have drawn {n_lines} lines. Use the Undo button to delete lines."
+                f"You have drawn {n_lines} lines and {len(objects) - n_lines} "
+                "keypoints. Use the Undo button to delete them."
             )
 
-        if n_lines >= 4:
-            snapshot.set_info(
-                pd.json_normalize(canvas_image.json_data["objects"]), hlines + vlines
-            )
+        calibrated = len(objects) >= 4
+        if calibrated:
+            try:
+                session.run(
+                    snapshot.set_info,
+                    *split_calibration_objects(objects, names),
+                    cache=session.cache,
+                )
+            except ValueError as error:
+                calibrated = False
+                st.warning(str(error))
+            else:
+                calibration = snapshot.calibration
+                with col3:
+                    st.write(
+                        f"Reprojection error of {calibration['rms_error']:.1f} pitch "
+                        f"pixels, {calibration['inliers'].sum()} of "
+                        f"{len(calibration['inliers'])} intersections used."
+                    )
+        elif detect_lines:
+            # The detection of an image is cached, as every rerun would repeat it
+            detection = session.run(snapshot.set_detected_lines, cache=session.cache)
+            calibrated = detection is not None
+            if calibrated:
+                with col3:
+                    st.write(
+                        f"Detected lines {', '.join(detection['lines'])} "
+                        f"with confidence {detection['confidence']:.0%}."
+                    )
+
+        if calibrated:
 
             with lines_expander:
                 st.write("Converted image:")
                 st.image(snapshot.conv_im)
+                st.markdown(
+                    get_calibration_download_link(snapshot), unsafe_allow_html=True
+                )
+                warp_scale = st.selectbox(
+                    "Scale of the full resolution bird's-eye view", [1, 2, 4, 8]
+                )
+                if st.button("Prepare full resolution bird's-eye view"):
+                    st.markdown(
+                        get_image_download_link(
+                            session.run(snapshot.get_warped_image, scale=warp_scale),
+                            "birdseye.png",
+                        ),
+                        unsafe_allow_html=True,
+                    )
 
             st.title("Annotate positional data")
             st.write(
@@ -143,6 +234,11 @@ if uploaded_file:
                     )
 
                 update = st.button("Update data")
+                prefill = st.checkbox("Pre-fill player boxes with automatic detection")
+                if prefill:
+                    prefill_tag = st.selectbox(
+                        "Tag of the detected players", list(tags)
+                    )
 
             if team_color == "Body orientation visual line @ Start pass":
                 body_orientation_lines = True
@@ -152,6 +248,20 @@ if uploaded_file:
             image2 = snapshot.get_image(original)
             height2 = image2.height
             width2 = image2.width
+            initial_drawing = None
+            if prefill:
+                from detection import detect_players, to_canvas_objects
+
+                try:
+                    with instrumentation.stage("detect_players"):
+                        detections = session.run(
+                            detect_players, image2, key=(snapshot.key, original)
+                        )
+                    initial_drawing = {
+                        "objects": to_canvas_objects(detections, tags[prefill_tag])
+                    }
+                except RuntimeError as error:
+                    st.warning(str(error))
             with p_col1:
                 canvas_converted = st_canvas(
                     fill_color="rgba(255, 165, 0, 0.3)",
@@ -160,6 +270,7 @@ if uploaded_file:
                     background_image=image2,
                     drawing_mode="line" if body_orientation_lines else "rect",
                     update_streamlit=update,
+                    initial_drawing=initial_drawing,
                     height=height2,
                     width=width2,
                     key="canvas2",
@@ -168,47 +279,45 @@ if uploaded_file:
             if canvas_converted.json_data is not None:
                 if len(canvas_converted.json_data["objects"]) > 0:
                     dfCoords = get_converted_positional_data(
-                        tags, snapshot, original, canvas_converted
+                        tags,
+                        snapshot,
+                        original,
+                        canvas_converted,
+                        session.canvas_parser,
                     )
 
-                    # Add metadata to dataframe
-                    dfCoords["situation_id"] = situation_id
-                    dfCoords["pass_duration"] = pass_duration
-                    dfCoords["player_name"] = player_name
-                    dfCoords["pass_duration"] = pass_duration
-                    dfCoords["player_role"] = player_role
-                    dfCoords["facing_passing_line"] = is_facing_the_passingline
-                    dfCoords["nationality"] = nationality
-
-                    session.positional_data = pd.concat(
-                        [session.positional_data, dfCoords[columns_of_interest]],
-                        axis=0,
-                    )
+                    with instrumentation.stage("annotations"):
+                        # Add metadata to dataframe
+                        dfCoords["situation_id"] = situation_id
+                        dfCoords["pass_duration"] = pass_duration
+                        dfCoords["player_name"] = player_name
+                        dfCoords["pass_duration"] = pass_duration
+                        dfCoords["player_role"] = player_role
+                        dfCoords["facing_passing_line"] = is_facing_the_passingline
+                        dfCoords["nationality"] = nationality
+                        dfCoords["object_id"] = dfCoords.index
 
-                    session.positional_data.drop_duplicates(
-                        keep="last",
-                        ignore_index=True,
-                        inplace=True,
-                    )
-
-                    session.positional_data.drop_duplicates(
-                        keep="first", ignore_index=True, inplace=True
-                    )
+                        session.store.upsert(dfCoords)
 
                 st.title("Overlay of positional data of current frame")
-                voronoi = VoronoiPitch(dfCoords)
+                voronoi = session.run(VoronoiPitch, dfCoords)
 
                 sensitivity = 10
                 player_circle_size = 2
                 player_opacity = 100
                 draw = PitchDraw(snapshot, original=True)
-                for pid, coord in dfCoords.iterrows():
-                    draw.draw_circle(
-                        coord[["x", "y"]].values,
-                        "black",
-                        player_circle_size,
-                        player_opacity,
-                    )
+                draw.draw_circles(
+                    dfCoords[["x", "y"]].values.astype(float),
+                    "black",
+                    player_circle_size,
+                    player_opacity,
+                )
+                lines = dfCoords[dfCoords["type"] == "line"]
+                draw.draw_lines(
+                    lines[["x_start", "y_start"]].values.astype(float),
+                    lines[["x_end", "y_end"]].values.astype(float),
+                    "black",
+                )
                 st.image(draw.compose_image(sensitivity))
 
 
@@ -219,10 +328,28 @@ def empty_uploaded_cache():
 
 if "dfCoords" in globals():
     st.title("Inspect raw dataframe")
-    st.dataframe(session.positional_data)
+    positional_data = session.store.to_frame()[columns_of_interest]
+    st.dataframe(positional_data)
+    st.title("Features by role")
+    st.dataframe(aggregate(session.store, by=("role", "phase"), pitch=pitch))
     st.title("Downloda data")
-    download_data(session.positional_data)
+    download_data(session.store, columns_of_interest)
 
     if st.button("Clear all cached data"):
-        session.positional_data = pd.DataFrame(columns=session.positional_data.columns)
+        session.store.clear()
+        session.cache.clear()
         empty_uploaded_cache()
+
+if show_counters:
+    st.sidebar.title("Performance counters")
+    stats = instrumentation.get_stats()
+    if stats:
+        st.sidebar.dataframe(
+            pd.DataFrame.from_dict(stats, orient="index").sort_values(
+                "seconds", ascending=False
+            )
+        )
+    if st.sidebar.button("Reset counters"):
+        instrumentation.reset()
+    st.sidebar.title("Sessions")
+    st.sidebar.dataframe(pd.DataFrame(get_manager().get_stats()))
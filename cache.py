@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from threading import RLock
+
+
+def get_nbytes(value):
+    """Estimates the memory held by a cached value.
+
+    Args:
+        value: A numpy array, a PIL image or any object exposing `nbytes`.
+
+    Returns:
+        int: The number of bytes, 0 if unknown
+    """
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if hasattr(value, "size") and hasattr(value, "getbands"):
+        width, height = value.size
+        return width * height * len(value.getbands())
+    return 0
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache bounded by entries and/or bytes."""
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=get_nbytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self.pop(key)
+            self._data[key] = value
+            self._sizes[key] = self.sizeof(value)
+            self.nbytes += self._sizes[key]
+            self._evict()
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self.nbytes -= self._sizes.pop(key)
+            return self._data.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def _evict(self):
+        while len(self._data) > 1 and (
+            (self.max_entries is not None and len(self._data) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            self.pop(next(iter(self._data)))
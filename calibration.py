@@ -0,0 +1,257 @@
+"""Homography calibration from any number of pitch line and keypoint annotations.
+
+Image lines are handled in homogeneous form, a*x + b*y + c = 0 with a² + b² = 1,
+so vertical lines and parallel lines need no special case. The intersections of
+the annotated vertical and horizontal pitch lines, and any annotated keypoints, are
+matched to their pitch positions. When there are more than four of them, the
+homography is estimated with RANSAC, then refined with Levenberg-Marquardt on the
+inlier points and on the distance of the annotated line ends to their pitch
+lines, so that a line without a crossing partner still constrains the result.
+Only the lines whose ends lie near their pitch line under the RANSAC estimate are
+refined on, so that a mislabelled line does not skew the result.
+
+Many frames, e.g. keypoints tracked over a video, are calibrated at once with a
+normalized DLT solved for all frames in a single batched eigendecomposition.
+"""
+
+import cv2
+import numpy as np
+
+from geometry import project_points
+
+
+def get_homogeneous_lines(segments):
+    """Returns the lines through segments in homogeneous form.
+
+    Args:
+        segments (ndarray): Segment ends x1, y1, x2, y2 of size (..., 4).
+
+    Returns:
+        ndarray: Lines a, b, c of size (..., 3), normalized so that a² + b² = 1
+    """
+    segments = np.asarray(segments, dtype=float)
+    ones = np.ones(segments.shape[:-1] + (1,))
+    start = np.concatenate([segments[..., :2], ones], axis=-1)
+    end = np.concatenate([segments[..., 2:], ones], axis=-1)
+    lines = np.cross(start, end)
+    return lines / np.linalg.norm(lines[..., :2], axis=-1, keepdims=True)
+
+
+def intersect_lines(lines1, lines2):
+    """Returns the intersections of pairs of homogeneous lines, inf or NaN for
+    parallel lines."""
+    points = np.cross(lines1, lines2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return points[..., :2] / points[..., 2:]
+
+
+def get_pitch_lines(pitch, names):
+    """Returns pitch lines in homogeneous form in pitch pixels."""
+    lines = []
+    for name in names:
+        if name in pitch.vert_lines:
+            lines.append([1.0, 0.0, -pitch.vert_lines[name] * pitch.SCALE])
+        else:
+            lines.append([0.0, 1.0, -pitch.horiz_lines[name] * pitch.SCALE])
+    return np.array(lines).reshape(-1, 3)
+
+
+def get_correspondences(pitch, segments, names, keypoints=None):
+    """Matches annotated lines and keypoints with their pitch positions.
+
+    Args:
+        pitch (Pitch): The pitch the lines were drawn on.
+        segments (ndarray): Image segment ends x1, y1, x2, y2 of size (n,4).
+        names (list): Pitch line name of each segment.
+        keypoints (dict, optional): Image position of pitch intersections, keyed
+            by their name in pitch.get_intersections(), e.g. "LG_U".
+
+    Returns:
+        tuple: Image points and pitch points of size (m,2), and their names
+    """
+    lines = dict(zip(names, get_homogeneous_lines(np.reshape(segments, (-1, 4)))))
+    pitch_intersections = pitch.get_intersections()
+    point_names = [
+        "_".join([v, h])
+        for v in names
+        if v in pitch.vert_lines
+        for h in names
+        if h in pitch.horiz_lines
+    ]
+    pts_src = [
+        intersect_lines(lines[name.split("_")[0]], lines[name.split("_")[1]])
+        for name in point_names
+    ]
+    for name, point in (keypoints or {}).items():
+        point_names.append(name)
+        pts_src.append(point)
+    pts_dst = [pitch_intersections[name] for name in point_names]
+    return (
+        np.array(pts_src, dtype=float).reshape(-1, 2),
+        np.array(pts_dst, dtype=float).reshape(-1, 2),
+        point_names,
+    )
+
+
+def get_reprojection_errors(h, pts_src, pts_dst):
+    """Returns the distance between the projected image points and their pitch
+    points, in pitch pixels."""
+    return np.linalg.norm(project_points(pts_src, h) - pts_dst, axis=-1)
+
+
+def get_line_residuals(h, segments, pitch_lines):
+    """Returns the signed distances of the projected segment ends to their pitch
+    lines, of size (n,2)."""
+    ends = project_points(np.reshape(segments, (-1, 2, 2)), h)
+    return np.einsum("nkj,nj->nk", ends, pitch_lines[:, :2]) + pitch_lines[:, None, 2]
+
+
+def refine_homography(h, pts_src, pts_dst, segments=None, pitch_lines=None):
+    """Refines a homography with Levenberg-Marquardt on the reprojection errors of
+    points and the distances of segment ends to their pitch lines."""
+    from scipy.optimize import least_squares
+
+    segments = np.zeros((0, 4)) if segments is None else np.reshape(segments, (-1, 4))
+    pitch_lines = np.zeros((0, 3)) if pitch_lines is None else pitch_lines
+
+    def residuals(params):
+        h = np.append(params, 1.0).reshape(3, 3)
+        return np.concatenate(
+            [
+                (project_points(pts_src, h) - pts_dst).ravel(),
+                get_line_residuals(h, segments, pitch_lines).ravel(),
+            ]
+        )
+
+    h = h / h[2, 2]
+    if 2 * len(pts_src) + 2 * len(segments) < 8:
+        return h
+    result = least_squares(residuals, h.ravel()[:8], method="lm")
+    return np.append(result.x, 1.0).reshape(3, 3)
+
+
+def solve_homography(
+    pts_src, pts_dst, segments=None, pitch_lines=None, threshold=3.0, refine=True
+):
+    """Estimates a homography from four or more point correspondences.
+
+    Args:
+        pts_src (ndarray): Image points of size (n,2).
+        pts_dst (ndarray): Pitch points of size (n,2).
+        segments (ndarray, optional): Annotated image segments x1, y1, x2, y2 of
+            size (m,4), used by the refinement.
+        pitch_lines (ndarray, optional): Homogeneous pitch line of every segment,
+            as returned by get_pitch_lines.
+        threshold (float, optional): Maximal reprojection error in pitch pixels of
+            a RANSAC inlier.
+        refine (bool, optional): If True, refines the homography on the inliers
+            and the segments.
+
+    Returns:
+        dict: The (3,3) "homography", the "inliers" mask and reprojection "errors"
+            of the points, the "rms_error" of the inliers in pitch pixels, and the
+            "line_inliers" mask of the segments within threshold of their pitch
+            line
+    """
+    pts_src = np.asarray(pts_src, dtype=float).reshape(-1, 2)
+    pts_dst = np.asarray(pts_dst, dtype=float).reshape(-1, 2)
+    valid = np.isfinite(pts_src).all(axis=1)
+    if valid.sum() < 4:
+        raise ValueError(
+            f"A homography needs at least 4 points, got {valid.sum()} "
+            "intersections and keypoints"
+        )
+    if valid.sum() == 4:
+        h, _ = cv2.findHomography(pts_src[valid], pts_dst[valid])
+        inliers = valid
+    else:
+        h, mask = cv2.findHomography(
+            pts_src[valid], pts_dst[valid], cv2.RANSAC, threshold
+        )
+        inliers = valid.copy()
+        inliers[valid] = mask.ravel().astype(bool)
+    if h is None:
+        raise ValueError("The points do not define a homography")
+    segments = np.zeros((0, 4)) if segments is None else np.reshape(segments, (-1, 4))
+    pitch_lines = np.zeros((0, 3)) if pitch_lines is None else pitch_lines
+    with np.errstate(invalid="ignore"):
+        line_errors = np.abs(get_line_residuals(h, segments, pitch_lines))
+    line_inliers = (line_errors <= threshold).all(axis=1)
+    if refine:
+        h = refine_homography(
+            h,
+            pts_src[inliers],
+            pts_dst[inliers],
+            segments[line_inliers],
+            pitch_lines[line_inliers],
+        )
+    errors = get_reprojection_errors(h, pts_src, pts_dst)
+    return {
+        "homography": h,
+        "inliers": inliers,
+        "errors": errors,
+        "rms_error": float(np.sqrt(np.mean(errors[inliers] ** 2))),
+        "line_inliers": line_inliers,
+    }
+
+
+def get_normalization(points):
+    """Returns the similarities moving the centroid of the finite points of every
+    frame to the origin at a mean distance of sqrt(2), of size (f,3,3)."""
+    with np.errstate(invalid="ignore"):
+        centroid = np.nanmean(points, axis=1)
+        distance = np.nanmean(np.linalg.norm(points - centroid[:, None], axis=-1), 1)
+    scale = np.sqrt(2) / np.where(distance > 0, distance, 1)
+    scale = np.nan_to_num(scale, nan=1.0)
+    centroid = np.nan_to_num(centroid)
+    t = np.zeros((len(points), 3, 3))
+    t[:, 0, 0] = t[:, 1, 1] = scale
+    t[:, :2, 2] = -centroid * scale[:, None]
+    t[:, 2, 2] = 1
+    return t
+
+
+def solve_homographies(pts_src, pts_dst):
+    """Estimates the homographies of many frames with a batched normalized DLT.
+
+    Args:
+        pts_src (ndarray): Image points of size (f,n,2), NaN where a point is not
+            visible.
+        pts_dst (ndarray): Pitch points of size (n,2), or (f,n,2).
+
+    Returns:
+        tuple: Homographies of size (f,3,3), NaN for frames with fewer than 4
+            points, and the RMS reprojection error of every frame in pitch pixels
+    """
+    pts_src = np.asarray(pts_src, dtype=float)
+    pts_dst = np.broadcast_to(np.asarray(pts_dst, dtype=float), pts_src.shape)
+    n_frames, n_points, _ = pts_src.shape
+    valid = np.isfinite(pts_src).all(axis=-1) & np.isfinite(pts_dst).all(axis=-1)
+    pts_dst = np.where(valid[..., None], pts_dst, np.nan)
+    t_src, t_dst = get_normalization(pts_src), get_normalization(pts_dst)
+    src = np.nan_to_num(project_points(pts_src, t_src))
+    dst = np.nan_to_num(project_points(pts_dst, t_dst))
+
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    rows = np.stack(
+        [
+            np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y, -u], -1),
+            np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y, -v], -1),
+        ],
+        axis=2,
+    )
+    rows = rows * valid[..., None, None]
+    a = rows.reshape(n_frames, 2 * n_points, 9)
+    # The solution is the eigenvector of the smallest eigenvalue of AᵀA
+    _, vectors = np.linalg.eigh(np.swapaxes(a, 1, 2) @ a)
+    h = vectors[:, :, 0].reshape(n_frames, 3, 3)
+    h = np.linalg.inv(t_dst) @ h @ t_src
+    h /= h[:, 2:, 2:]
+    h[valid.sum(axis=1) < 4] = np.nan
+
+    errors = np.where(valid, get_reprojection_errors(h, pts_src, pts_dst), 0)
+    with np.errstate(invalid="ignore"):
+        rms = np.sqrt((errors**2).sum(axis=1) / valid.sum(axis=1))
+    return h, rms
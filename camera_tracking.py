@@ -0,0 +1,187 @@
+"""Frame-to-frame homography tracking for moving broadcast cameras.
+
+Usage:
+    python camera_tracking.py match.mp4 calibration.json homographies.npz
+
+The homography of one calibrated frame is propagated to the following frames by
+tracking features of the pitch with sparse optical flow and composing the
+frame-to-frame homographies. To bound the drift, the features of an anchor frame
+are also tracked directly to the current frame; when the composed and the direct
+estimates disagree, the direct estimate replaces the composed one, and when the
+anchor is lost the current frame becomes the new anchor.
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+
+from batch import get_video_info, load_calibration, read_frames, scale_homography
+from geometry import project_points
+from helpers import get_edge_img
+from pitch import PITCHES
+
+LK_PARAMS = dict(
+    winSize=(21, 21),
+    maxLevel=3,
+    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01),
+)
+
+
+def get_pitch_area(frame, sensitivity=25):
+    """Returns the grass mask of a frame with the lines and players closed in."""
+    grass = get_edge_img(frame, sensitivity=sensitivity)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
+    return cv2.morphologyEx(grass, cv2.MORPH_CLOSE, kernel)
+
+
+def estimate_motion(prev_gray, gray, points, min_inliers=0.5):
+    """Estimates the homography between two frames from tracked features.
+
+    Args:
+        prev_gray (ndarray): Previous grayscale frame.
+        gray (ndarray): Current grayscale frame.
+        points (ndarray): Features of the previous frame, of size (n,1,2).
+        min_inliers (float, optional): Minimal fraction of RANSAC inliers.
+
+    Returns:
+        ndarray: The (3,3) homography from the previous to the current frame, or None
+            if the motion could not be estimated reliably
+    """
+    if points is None or len(points) < 8:
+        return None
+    tracked, status, _ = cv2.calcOpticalFlowPyrLK(
+        prev_gray, gray, points, None, **LK_PARAMS
+    )
+    found = status.ravel() == 1
+    if found.sum() < 8:
+        return None
+    g, inliers = cv2.findHomography(points[found], tracked[found], cv2.RANSAC, 3.0)
+    if g is None or inliers.sum() < min_inliers * len(points):
+        return None
+    return g
+
+
+class HomographyTracker:
+    """Propagates the calibration of one frame to the following frames."""
+
+    def __init__(
+        self,
+        h,
+        frame,
+        sensitivity=25,
+        max_corners=400,
+        drift_threshold=2.0,
+        min_inliers=0.5,
+    ):
+        """
+        Args:
+            h (ndarray): (3,3) homography from the frame to pitch coordinates, e.g.
+                PitchImage.h.h.
+            frame (ndarray): The calibrated frame.
+            sensitivity (int, optional): Sensitivity of the grass mask the features
+                are restricted to.
+            max_corners (int, optional): Number of tracked features.
+            drift_threshold (float, optional): Disagreement in pixels between the
+                composed and the direct anchor estimate above which the direct
+                estimate is used.
+            min_inliers (float, optional): Minimal fraction of features consistent
+                with a homography for a motion estimate to be accepted.
+        """
+        self.sensitivity = sensitivity
+        self.max_corners = max_corners
+        self.drift_threshold = drift_threshold
+        self.min_inliers = min_inliers
+        self.h = np.asarray(h, dtype=float)
+        self.drift = 0.0
+        self.n_anchors = 0
+        self._set_anchor(frame)
+
+    def _get_features(self, frame, gray):
+        mask = get_pitch_area(frame, self.sensitivity)
+        return cv2.goodFeaturesToTrack(
+            gray, self.max_corners, 0.01, 10, mask=mask, blockSize=7
+        )
+
+    def _set_anchor(self, frame):
+        gray = cv2.cvtColor(np.asarray(frame), cv2.COLOR_RGB2GRAY)
+        self.anchor_gray = self.prev_gray = gray
+        self.anchor_h = self.h
+        self.anchor_points = self.prev_points = self._get_features(frame, gray)
+        self.n_anchors += 1
+
+    def update(self, frame):
+        """Returns the homography from the frame to pitch coordinates.
+
+        Args:
+            frame (ndarray): The next frame of the sequence.
+
+        Returns:
+            ndarray: A (3,3) homography
+        """
+        gray = cv2.cvtColor(np.asarray(frame), cv2.COLOR_RGB2GRAY)
+        g = estimate_motion(self.prev_gray, gray, self.prev_points, self.min_inliers)
+        if g is not None:
+            self.h = self.h @ np.linalg.inv(g)
+
+        g_anchor = estimate_motion(
+            self.anchor_gray, gray, self.anchor_points, self.min_inliers
+        )
+        if g_anchor is None:
+            # The anchor frame is too far away, start again from the current frame
+            self._set_anchor(frame)
+            return self.h
+
+        h_direct = self.anchor_h @ np.linalg.inv(g_anchor)
+        points = self.anchor_points[:, 0]
+        composed = project_points(points, np.linalg.inv(self.h) @ self.anchor_h)
+        direct = project_points(points, g_anchor)
+        self.drift = float(np.mean(np.linalg.norm(composed - direct, axis=1)))
+        if g is None or self.drift > self.drift_threshold:
+            self.h = h_direct
+        self.prev_gray = gray
+        self.prev_points = self._get_features(frame, gray)
+        return self.h
+
+
+def track_homographies(frames, h, **kwargs):
+    """Tracks the homography of the first frame through a sequence of frames.
+
+    Args:
+        frames (iterable): RGB frames, the first one being calibrated by h.
+        h (ndarray): (3,3) homography from the first frame to pitch coordinates.
+        **kwargs: Passed to HomographyTracker.
+
+    Returns:
+        ndarray: A (f,3,3) stack of homographies
+    """
+    frames = iter(frames)
+    tracker = HomographyTracker(h, next(frames), **kwargs)
+    return np.stack([tracker.h] + [tracker.update(frame) for frame in frames])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("video", help="input video, calibrated on its first frame")
+    parser.add_argument("calibration", help="calibration JSON file")
+    parser.add_argument("output", help="output .npz file")
+    parser.add_argument("--pitch", choices=list(PITCHES), default="Football")
+    args = parser.parse_args(argv)
+
+    h, image_size = load_calibration(args.calibration, PITCHES[args.pitch])
+    frames = (
+        cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), image_size)
+        for frame in read_frames(args.video)
+    )
+    homographies = track_homographies(frames, h)
+    _, _, frame_size = get_video_info(args.video)
+    np.savez(
+        args.output,
+        homographies=scale_homography(homographies, image_size, frame_size),
+        image_size=frame_size,
+    )
+    print(f"Tracked {len(homographies)} frames")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""Player detection on the CPU, to pre-fill the annotation of frames.
+
+Usage:
+    python detection.py match.mp4 detections.csv --workers 8
+    python detection.py match.mp4 detections.csv --calibration calibration.json
+
+Players are detected with the HOG people detector of OpenCV, as the blobs that
+are not grass inside the grass area of a single frame, or for static cameras by
+background subtraction. The default "auto" method uses HOG when the installed
+OpenCV has it, as OpenCV 5 dropped it, and the grass blobs otherwise. Only
+detections standing on the grass mask of get_edge_img are kept. Each detection is
+a box and the position of the feet, the middle of the base of the box, which is
+also how annotated rectangles are read.
+"""
+
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from batch import get_video_info, load_calibration, read_frames, scale_homography
+from camera_tracking import get_pitch_area
+from cache import LRUCache
+from geometry import get_output_size, project_points
+from helpers import get_edge_img
+from pitch import PITCHES
+
+COLUMNS = ["left", "top", "width", "height", "score", "x", "y"]
+METHODS = ["auto", "hog", "grass", "background"]
+DETECTIONS = LRUCache(max_entries=16)
+
+
+class PlayerDetector:
+    """Detects the players of a frame."""
+
+    def __init__(
+        self,
+        method="auto",
+        sensitivity=25,
+        scale=2.0,
+        min_score=0.3,
+        min_area=50,
+        max_area=20000,
+        history=500,
+    ):
+        """
+        Args:
+            method (str, optional): "hog" for the HOG people detector or "grass" for
+                the non-grass blobs inside the grass area, which both work on single
+                frames, or "background" for background subtraction, which needs the
+                frames of a static camera in order. Defaults to "auto", HOG if the
+                installed OpenCV has it and grass blobs otherwise.
+            sensitivity (int, optional): Sensitivity of the grass mask.
+            scale (float, optional): Upscaling of the frame before HOG detection, as
+                the detector does not find people smaller than 128 pixels.
+            min_score (float, optional): Minimal HOG score of a detection.
+            min_area (int, optional): Minimal area in pixels of a foreground or grass
+                blob.
+            max_area (int, optional): Maximal area in pixels of a foreground or grass
+                blob.
+            history (int, optional): Number of frames the background model learns
+                from.
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown detection method {method}")
+        if method == "auto":
+            method = "hog" if hasattr(cv2, "HOGDescriptor") else "grass"
+        if method == "hog" and not hasattr(cv2, "HOGDescriptor"):
+            raise RuntimeError(
+                f"OpenCV {cv2.__version__} has no HOG people detector, use the "
+                "grass or background method, or OpenCV 4"
+            )
+        self.method = method
+        self.sensitivity = sensitivity
+        self.scale = scale
+        self.min_score = min_score
+        self.min_area = min_area
+        self.max_area = max_area
+        self._local = threading.local()
+        if method == "background":
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(
+                history=history, detectShadows=True
+            )
+
+    def _get_hog(self):
+        # HOG descriptors are not shared between threads
+        if not hasattr(self._local, "hog"):
+            self._local.hog = cv2.HOGDescriptor()
+            self._local.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        return self._local.hog
+
+    def detect(self, frame):
+        """Detects the players standing on the pitch.
+
+        Args:
+            frame: A PIL image or an array of size (height, width, 3).
+
+        Returns:
+            DataFrame: The "left", "top", "width", "height" of the box, the "score"
+                and the feet position "x", "y" in pixels of every detection
+        """
+        frame = np.asarray(frame)
+        if self.method == "hog":
+            boxes, scores = self._detect_hog(frame)
+        elif self.method == "grass":
+            boxes, scores = self._detect_grass(frame)
+        else:
+            boxes, scores = self._detect_background(frame)
+        detections = pd.DataFrame(
+            np.c_[boxes, scores].reshape(-1, 5), columns=COLUMNS[:5]
+        )
+        detections["x"] = detections["left"] + detections["width"] / 2
+        detections["y"] = detections["top"] + detections["height"]
+        if self.method == "grass":
+            # The blobs are inside the grass area by construction
+            return detections
+        return detections[self._on_pitch(frame, detections)].reset_index(drop=True)
+
+    def _detect_hog(self, frame):
+        image = cv2.resize(frame, None, fx=self.scale, fy=self.scale)
+        boxes, scores = self._get_hog().detectMultiScale(
+            image, winStride=(8, 8), padding=(8, 8), scale=1.05
+        )
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4) / self.scale
+        scores = np.asarray(scores, dtype=float).ravel()
+        keep = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), self.min_score, 0.4)
+        keep = np.asarray(keep, dtype=int).ravel()
+        return boxes[keep], scores[keep]
+
+    def _detect_background(self, frame):
+        foreground = self.subtractor.apply(frame)
+        # Shadows are marked 127 by the subtractor
+        _, foreground = cv2.threshold(foreground, 200, 255, cv2.THRESH_BINARY)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        foreground = cv2.morphologyEx(foreground, cv2.MORPH_OPEN, kernel)
+        foreground = cv2.dilate(foreground, kernel, iterations=2)
+        return self._get_blobs(foreground)
+
+    def _detect_grass(self, frame):
+        grass = get_edge_img(frame, self.sensitivity)
+        # The players are holes of the grass area, which are filled in
+        contours, _ = cv2.findContours(
+            grass, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        )
+        pitch_area = np.zeros_like(grass)
+        cv2.drawContours(pitch_area, contours, -1, 255, cv2.FILLED)
+        foreground = cv2.bitwise_and(pitch_area, cv2.bitwise_not(grass))
+        # The opening removes the painted lines, thinner than the players
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        foreground = cv2.morphologyEx(foreground, cv2.MORPH_OPEN, kernel)
+        return self._get_blobs(foreground)
+
+    def _get_blobs(self, foreground):
+        _, _, stats, _ = cv2.connectedComponentsWithStats(foreground)
+        stats = stats[1:]
+        area = stats[:, cv2.CC_STAT_AREA]
+        stats = stats[(area >= self.min_area) & (area <= self.max_area)]
+        return stats[:, :4].astype(float), np.ones(len(stats))
+
+    def _on_pitch(self, frame, detections):
+        pitch_area = get_pitch_area(frame, self.sensitivity)
+        height, width = pitch_area.shape
+        x = np.clip(detections["x"].values.astype(int), 0, width - 1)
+        y = np.clip(detections["y"].values.astype(int) - 1, 0, height - 1)
+        return pitch_area[y, x] > 0
+
+
+def detect_frames(frames, detector=None, workers=1, **kwargs):
+    """Detects the players of a sequence of frames.
+
+    Args:
+        frames (iterable): The frames, e.g. read_frames of a video.
+        detector (PlayerDetector, optional): Defaults to a PlayerDetector created
+            with kwargs.
+        workers (int, optional): Number of threads HOG detection runs on. Background
+            subtraction processes the frames in order on a single thread.
+
+    Returns:
+        DataFrame: The detections of PlayerDetector.detect with their "frame" index
+    """
+    detector = detector if detector is not None else PlayerDetector(**kwargs)
+    if detector.method == "background" or workers <= 1:
+        results = map(detector.detect, frames)
+    else:
+        results = _map_bounded(detector.detect, frames, workers)
+    detections = [df.assign(frame=i) for i, df in enumerate(results)]
+    if not detections:
+        return pd.DataFrame(columns=["frame"] + COLUMNS)
+    return pd.concat(detections, ignore_index=True)[["frame"] + COLUMNS]
+
+
+def _map_bounded(func, items, workers):
+    # Unlike Executor.map, only a few frames are decoded ahead of the detection
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def detect_players(image, key=None, **kwargs):
+    """Detects the players of a single image, once per image key.
+
+    Args:
+        image: A PIL image or an array.
+        key (hashable, optional): Identifies the image, e.g. PitchImage.key.
+            Defaults to no caching.
+        **kwargs: Passed to PlayerDetector, whose default method works on single
+            images with any OpenCV version.
+
+    Returns:
+        DataFrame: The detections of PlayerDetector.detect
+    """
+    cache_key = None if key is None else (key, tuple(sorted(kwargs.items())))
+    detections = DETECTIONS.get(cache_key) if cache_key is not None else None
+    if detections is None:
+        detections = PlayerDetector(**kwargs).detect(image)
+        if cache_key is not None:
+            DETECTIONS.put(cache_key, detections)
+    return detections
+
+
+def to_canvas_objects(detections, stroke_color, fill_color="rgba(255, 165, 0, 0.3)"):
+    """Converts detections to rectangles of a canvas, e.g. for the initial_drawing
+    of st_canvas, so that the annotator only corrects them."""
+    return [
+        {
+            "type": "rect",
+            "left": float(row.left),
+            "top": float(row.top),
+            "width": float(row.width),
+            "height": float(row.height),
+            "scaleX": 1,
+            "scaleY": 1,
+            "fill": fill_color,
+            "stroke": stroke_color,
+            "strokeWidth": 2,
+        }
+        for row in detections.itertuples()
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("video", help="input video")
+    parser.add_argument("output", help="output CSV file")
+    parser.add_argument(
+        "--calibration", help="calibration file, to add the pitch positions"
+    )
+    parser.add_argument("--pitch", choices=list(PITCHES), default="Football")
+    parser.add_argument("--method", choices=METHODS, default="auto")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--stop", type=int, default=None)
+    parser.add_argument("--scale", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    frames = read_frames(args.video, args.start, args.stop)
+    detections = detect_frames(
+        frames, workers=args.workers, method=args.method, scale=args.scale
+    )
+    detections["frame"] += args.start
+    if args.calibration:
+        pitch = PITCHES[args.pitch]
+        h, image_size = load_calibration(args.calibration, pitch)
+        _, _, frame_size = get_video_info(args.video)
+        h = scale_homography(h, image_size, frame_size)
+        feet = detections[["x", "y"]].values.astype(float)
+        if h.ndim == 3:
+            # Per-frame homographies of a moving camera
+            h = h[detections["frame"].values]
+            positions = project_points(feet[:, None], h)[:, 0]
+        else:
+            positions = project_points(feet, h)
+        positions = positions / (np.array(get_output_size(pitch)) / 100)
+        detections["pitch_x"], detections["pitch_y"] = positions.T
+    detections.to_csv(args.output, index=False)
+    print(
+        f"Detected {len(detections)} players in {detections['frame'].nunique()} frames"
+    )
+
+
+if __name__ == "__main__":
+    main()
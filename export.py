@@ -0,0 +1,160 @@
+"""Export of positional data to files, usable with or without Streamlit.
+
+Every exporter accepts a DataFrame or an iterable of DataFrame chunks, so datasets
+larger than memory can be streamed to disk chunk by chunk.
+"""
+
+import io
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache
+
+CHUNK_SIZE = 100_000
+EXPORTS = LRUCache(max_entries=4, sizeof=len)
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """Yields DataFrame chunks of at most chunk_size rows."""
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, max(len(data), 1), chunk_size):
+            yield data.iloc[start : start + chunk_size]
+    else:
+        yield from data
+
+
+def export_csv(data, path, index=False, chunk_size=CHUNK_SIZE):
+    """Writes CSV chunk by chunk to a path or a file object."""
+    fp = open(path, "w", newline="") if isinstance(path, str) else path
+    try:
+        for i, chunk in enumerate(iter_chunks(data, chunk_size)):
+            chunk.to_csv(fp, index=index, header=i == 0)
+    finally:
+        if isinstance(path, str):
+            fp.close()
+
+
+def export_parquet(data, path, index=False, chunk_size=CHUNK_SIZE):
+    """Writes Parquet with one row group per chunk to a path or a file object."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for chunk in iter_chunks(data, chunk_size):
+            table = pa.Table.from_pandas(chunk, preserve_index=index)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def export_npz(data, path, chunk_size=CHUNK_SIZE):
+    """Writes a compact .npz file: x and y as a float32 (n,2) array and every other
+    column as integer codes with their categories.
+
+    The arrays of every chunk are appended to temporary files, then compressed into
+    the archive one entry at a time, so only a chunk and the categories of the
+    columns are held in memory.
+    """
+    spools, categories, n_rows = {}, {}, 0
+    try:
+        for chunk in iter_chunks(data, chunk_size):
+            if not spools:
+                columns = list(chunk.columns.drop(["x", "y"]))
+                categories = {column: {} for column in columns}
+                for name in ["xy"] + [f"{column}_codes" for column in columns]:
+                    spools[name] = tempfile.TemporaryFile()
+            spools["xy"].write(chunk[["x", "y"]].values.astype("<f4").tobytes())
+            for column, index in categories.items():
+                codes, uniques = pd.factorize(chunk[column])
+                # Codes of the chunk are mapped to codes of the whole export
+                mapping = np.array(
+                    [index.setdefault(value, len(index)) for value in uniques] + [-1]
+                )
+                spools[f"{column}_codes"].write(mapping[codes].astype("<i4").tobytes())
+            n_rows += len(chunk)
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, spool in spools.items():
+                shape = (n_rows, 2) if name == "xy" else (n_rows,)
+                dtype = np.dtype("<f4" if name == "xy" else "<i4")
+                with archive.open(f"{name}.npy", "w", force_zip64=True) as fp:
+                    np.lib.format.write_array_header_1_0(
+                        fp,
+                        {
+                            "descr": np.lib.format.dtype_to_descr(dtype),
+                            "fortran_order": False,
+                            "shape": shape,
+                        },
+                    )
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, fp)
+            for column, index in categories.items():
+                with archive.open(f"{column}_categories.npy", "w") as fp:
+                    np.save(fp, np.array(list(index), dtype=object).astype(str))
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+
+def export_f32(data, path, chunk_size=CHUNK_SIZE):
+    """Streams x and y as raw little-endian float32 pairs, readable with
+    np.fromfile(path, "<f4").reshape(-1, 2)."""
+    fp = open(path, "wb") if isinstance(path, str) else path
+    try:
+        for chunk in iter_chunks(data, chunk_size):
+            fp.write(chunk[["x", "y"]].values.astype("<f4").tobytes())
+    finally:
+        if isinstance(path, str):
+            fp.close()
+
+
+EXPORTERS = {
+    "csv": export_csv,
+    "parquet": export_parquet,
+    "npz": export_npz,
+    "f32": export_f32,
+}
+
+
+def export(data, path, fmt=None, **kwargs):
+    """Exports positional data to a file.
+
+    Args:
+        data: A DataFrame or an iterable of DataFrame chunks.
+        path (str): Output path.
+        fmt (str, optional): One of EXPORTERS. Defaults to the extension of path.
+        **kwargs: Passed to the exporter.
+    """
+    fmt = fmt or path.rsplit(".", 1)[-1]
+    EXPORTERS[fmt](data, path, **kwargs)
+
+
+def get_export_bytes(store, fmt, columns=None):
+    """Serializes an AnnotationStore in memory, once per version of its data.
+
+    Args:
+        store (AnnotationStore): The store to export.
+        fmt (str): One of EXPORTERS.
+        columns (list, optional): Exported columns. Defaults to all columns.
+
+    Returns:
+        bytes: The content of the exported file
+    """
+    key = (store.uid, store.version, fmt, tuple(columns or ()))
+    content = EXPORTS.get(key)
+    if content is None:
+        df = store.to_frame()
+        buffer = io.StringIO() if fmt == "csv" else io.BytesIO()
+        kwargs = {"index": True} if fmt == "csv" else {}
+        EXPORTERS[fmt](df[columns] if columns else df, buffer, **kwargs)
+        content = buffer.getvalue()
+        content = EXPORTS.put(key, content.encode() if fmt == "csv" else content)
+    return content
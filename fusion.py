@@ -0,0 +1,159 @@
+"""Fusion of the positions detected on several calibrated views of the same pitch.
+
+The detections of every view are projected to the pitch in one batch per view.
+Detections of different views that are closer than a radius on the pitch are
+taken as the same player, each player being seen at most once per view, and are
+merged into a position weighted by the local resolution of each view: a camera
+that sees a player from close by, with many pixels per square metre, weighs more
+than a distant one.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from pitch import FootballPitch
+
+
+def get_resolution(h, points):
+    """Returns the local resolution of a homography at image points.
+
+    Args:
+        h (ndarray): (3,3) homography from image to pitch coordinates.
+        points (ndarray): Image points of size (n,2).
+
+    Returns:
+        ndarray: The number of image pixels per unit of pitch area at each point,
+            i.e. the inverse absolute determinant of the Jacobian of h
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    w = points @ h[2, :2] + h[2, 2]
+    projected = (points @ h[:2, :2].T + h[:2, 2]) / w[:, None]
+    jacobian = h[None, :2, :2] - projected[:, :, None] * h[None, 2, None, :2]
+    jacobian /= w[:, None, None]
+    return 1 / np.abs(np.linalg.det(jacobian))
+
+
+def project_view(h, detections, pitch=None):
+    """Projects the detections of one view to the pitch.
+
+    Args:
+        h (Homography): Homography of the view, e.g. PitchImage.h.
+        detections (DataFrame): Image positions "x", "y" in pixels.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+
+    Returns:
+        tuple: Positions in metres of size (n,2) and their resolution in pixels per
+            square metre
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    points = detections[["x", "y"]].values.astype(float)
+    metres_per_pixel = np.array([pitch.X_SIZE, pitch.Y_SIZE]) / h.im_size
+    positions = h.apply_to_points(points) * metres_per_pixel
+    resolution = get_resolution(h.h, points) / np.prod(metres_per_pixel)
+    return positions, resolution
+
+
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def get_clusters(positions, frames, views, teams=None, radius=1.0):
+    """Groups detections of the same player seen by different views.
+
+    The pairs of detections of the same frame and of different views closer than
+    the radius are merged from the closest to the farthest, unless the merged
+    group would contain two detections of the same view.
+
+    Returns:
+        ndarray: The cluster label of every detection
+    """
+    # Frames are laid side by side so that a single tree covers all of them
+    offset = np.ptp(positions[:, 0]) + 2 * radius + 1 if len(positions) else 0
+    points = positions + np.c_[frames * offset, np.zeros(len(frames))]
+    pairs = cKDTree(points).query_pairs(radius, output_type="ndarray")
+    valid = views[pairs[:, 0]] != views[pairs[:, 1]]
+    if teams is not None:
+        valid &= teams[pairs[:, 0]] == teams[pairs[:, 1]]
+    pairs = pairs[valid]
+    distances = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1)
+    pairs = pairs[np.argsort(distances, kind="stable")]
+
+    parents = list(range(len(positions)))
+    # Bit masks of the views of every group
+    members = [1 << view for view in views.tolist()]
+    for i, j in pairs.tolist():
+        i, j = _find(parents, i), _find(parents, j)
+        if i != j and not members[i] & members[j]:
+            parents[j] = i
+            members[i] |= members[j]
+    roots = np.array(parents, dtype=int)
+    while True:
+        grand_parents = roots[roots]
+        if np.array_equal(grand_parents, roots):
+            break
+        roots = grand_parents
+    return np.unique(roots, return_inverse=True)[1]
+
+
+def fuse_detections(views, detections, pitch=None, radius=1.0, workers=1):
+    """Merges the detections of several calibrated views into one table per frame.
+
+    Args:
+        views (list): Homography of every view, e.g. PitchImage.h.
+        detections (list): DataFrame of every view with the image positions "x", "y"
+            in pixels of its detections, and optionally their "frame" and "team".
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        radius (float, optional): Distance in metres under which detections of
+            different views are the same player.
+        workers (int, optional): Number of threads the views are projected with.
+
+    Returns:
+        DataFrame: The merged positions, with their "frame", "x" and "y" in percent
+            of the pitch as returned by get_converted_positional_data, "team" if
+            given, and the number of views "n_views" they were seen by
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        projections = list(
+            executor.map(
+                lambda args: project_view(*args, pitch), zip(views, detections)
+            )
+        )
+    positions = np.concatenate([p for p, _ in projections]).reshape(-1, 2)
+    weights = np.concatenate([w for _, w in projections])
+    frames = np.concatenate(
+        [
+            df["frame"].values if "frame" in df else np.zeros(len(df))
+            for df in detections
+        ]
+    ).astype(int)
+    view_index = np.repeat(np.arange(len(views)), [len(df) for df in detections])
+    has_teams = all("team" in df for df in detections)
+    teams = (
+        np.concatenate([df["team"].values for df in detections]) if has_teams else None
+    )
+
+    labels = get_clusters(positions, frames, view_index, teams, radius)
+    total = np.bincount(labels, weights)
+    merged = np.c_[
+        np.bincount(labels, weights * positions[:, 0]) / total,
+        np.bincount(labels, weights * positions[:, 1]) / total,
+    ]
+    first = np.unique(labels, return_index=True)[1]
+    fused = pd.DataFrame(
+        {
+            "frame": frames[first],
+            "x": merged[:, 0] * 100 / pitch.X_SIZE,
+            "y": merged[:, 1] * 100 / pitch.Y_SIZE,
+            "n_views": np.bincount(labels),
+        }
+    )
+    if has_teams:
+        fused.insert(3, "team", teams[first])
+    return fused.sort_values("frame", kind="stable").reset_index(drop=True)
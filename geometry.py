@@ -0,0 +1,245 @@
+"""Core geometry of the pitch projection: homographies, point projection and
+perspective warps.
+
+This module only depends on numpy and OpenCV, so that headless workers can
+project and warp without loading the pandas, shapely, PIL and Streamlit
+dependencies of the app. The app helpers re-export everything defined here.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from cache import LRUCache
+from instrumentation import timed
+
+WARP_MAPS = LRUCache(
+    max_entries=16,
+    max_bytes=512 * 2**20,
+    sizeof=lambda maps: sum(m.nbytes for m in maps),
+)
+
+
+class Homography:
+    def __init__(self, pts_src, pts_dst, im_size=(525, 340), h=None):
+        """
+        Args:
+            pts_src (array-like): Points on the image.
+            pts_dst (array-like): The same points in pitch pixels.
+            im_size (tuple, optional): (width, height) of the pitch in pixels, as
+                returned by get_output_size.
+            h (ndarray, optional): The homography matrix, e.g. estimated robustly
+                by calibration.solve_homography. Defaults to fitting the points.
+        """
+        self.pts_src = np.array(pts_src)
+        self.pts_dst = np.array(pts_dst)
+        if h is None:
+            h, out = cv2.findHomography(self.pts_src, self.pts_dst)
+        self.h = np.asarray(h, dtype=float)
+        self._h_inv = None
+        self.im_size = tuple(im_size)
+        self.im_width = self.im_size[0]
+        self.im_heigth = self.im_size[1]
+        self.coord_converter = np.array(self.im_size) / 100
+
+    @property
+    def h_inv(self):
+        """ndarray: The inverse homography matrix, computed once and cached."""
+        if self._h_inv is None:
+            self._h_inv = np.linalg.inv(self.h)
+        return self._h_inv
+
+    @timed()
+    def apply_to_image(self, image, cached=False):
+        """Applies homography to provided image.
+
+        Args:
+            image (PitchImage): A PitchImage instance
+            cached (bool, optional): If True, warps with cv2.remap and lookup tables
+                that are built once per homography and output size, then reused by
+                every frame warped with it. This trades the memory of the maps for
+                computing the per-pixel source coordinates only once; whether it is
+                faster than cv2.warpPerspective depends on the machine. Defaults to
+                False.
+
+        Returns:
+            ndarray: numpy array representing an image of size self.im_size
+        """
+        if cached:
+            return warp_image(np.array(image.im), self.h, self.im_size)
+        im_out = cv2.warpPerspective(np.array(image.im), self.h, self.im_size)
+        return im_out
+
+    def apply_to_points(self, points, inverse=False):
+        """Applies homography to provided points
+
+        Args:
+            points (ndarray): An array of size (n,2) or a batch of size (f,n,2).
+            inverse (bool, optional): If True, inverts the homography matrix. Defaults to False.
+
+        Returns:
+            ndarray: An array of the same size as points
+        """
+        return project_points(points, self.h_inv if inverse else self.h)
+
+
+def get_output_size(pitch, scale=1):
+    """Returns the (width, height) in pixels of a pitch drawn at pitch.SCALE."""
+    return (
+        int(round(pitch.X_SIZE * pitch.SCALE * scale)),
+        int(round(pitch.Y_SIZE * pitch.SCALE * scale)),
+    )
+
+
+def project_points(points, h):
+    """Projects points through one homography or a stack of per-frame homographies
+    in a single vectorized pass.
+
+    Args:
+        points (ndarray): An array of size (n,2) or a batch of size (f,n,2).
+        h (ndarray): A (3,3) homography matrix or a (f,3,3) stack of matrices. A
+            stack is broadcast against an (n,2) array of points.
+
+    Returns:
+        ndarray: An array of size (n,2) or (f,n,2) with the projected points
+    """
+    points = np.asarray(points, dtype=float)
+    h = np.asarray(h, dtype=float)
+    converted = np.matmul(points, np.swapaxes(h[..., :2], -1, -2))
+    converted += h[..., :, 2][..., None, :]
+    return converted[..., :2] / converted[..., 2:]
+
+
+def get_perspective_transforms(pts_src, pts_dst):
+    """Solves many 4-point homographies at once, like cv2.getPerspectiveTransform.
+
+    Args:
+        pts_src (ndarray): Source points of size (k,4,2).
+        pts_dst (ndarray): Destination points of size (k,4,2).
+
+    Returns:
+        ndarray: A (k,3,3) stack of homography matrices, NaN for degenerate point sets
+    """
+    pts_src = np.asarray(pts_src, dtype=float)
+    pts_dst = np.asarray(pts_dst, dtype=float)
+    x, y = pts_src[..., 0], pts_src[..., 1]
+    u, v = pts_dst[..., 0], pts_dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    a = np.concatenate(
+        [
+            np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=-1),
+            np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=-1),
+        ],
+        axis=-2,
+    )
+    b = np.concatenate([u, v], axis=-1)
+    h = np.full(pts_src.shape[:-2] + (9,), np.nan)
+    valid = np.abs(np.linalg.det(a)) > 1e-9
+    h[valid, :8] = np.linalg.solve(a[valid], b[valid][..., None])[..., 0]
+    h[valid, 8] = 1
+    return h.reshape(pts_src.shape[:-2] + (3, 3))
+
+
+def get_warp_maps(h, size):
+    """Returns the fixed-point cv2.remap lookup tables of a perspective warp.
+
+    The tables are cached by homography matrix and output size.
+
+    Args:
+        h (ndarray): A (3,3) homography matrix.
+        size (tuple): Output (width, height).
+
+    Returns:
+        tuple: map1 (int16 coordinates) and map2 (interpolation table indices)
+    """
+    h = np.asarray(h, dtype=float)
+    key = (h.tobytes(), tuple(size))
+    maps = WARP_MAPS.get(key)
+    if maps is None:
+        width, height = size
+        grid = np.dstack(np.meshgrid(np.arange(width), np.arange(height)))
+        src = project_points(grid, np.linalg.inv(h)).astype(np.float32)
+        maps = WARP_MAPS.put(
+            key, cv2.convertMaps(src[..., 0], src[..., 1], cv2.CV_16SC2)
+        )
+    return maps
+
+
+def warp_image(image, h, size):
+    """Equivalent of cv2.warpPerspective(image, h, size) using cached lookup tables."""
+    map1, map2 = get_warp_maps(h, size)
+    return cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+
+
+def _warp_tile(image, h, out, x, y):
+    height, width = out.shape[:2]
+    h = np.array([[1.0, 0, -x], [0, 1, -y], [0, 0, 1]]) @ h
+    # Only the part of the image seen by the tile is read, unless the tile
+    # reaches the horizon of the image
+    corners = np.c_[[[0, 0], [width, 0], [0, height], [width, height]], np.ones(4)]
+    corners = corners @ np.linalg.inv(h).T
+    if np.all(corners[:, 2] * np.linalg.det(h) > 0):
+        corners = corners[:, :2] / corners[:, 2:]
+        x0, y0 = np.clip(np.floor(corners.min(axis=0)) - 2, 0, None).astype(int)
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + 2
+        if x0 >= image.shape[1] or y0 >= image.shape[0] or x1 <= 0 or y1 <= 0:
+            return
+        image = image[y0:y1, x0:x1]
+        h = h @ np.array([[1.0, 0, x0], [0, 1, y0], [0, 0, 1]])
+    out[:] = cv2.warpPerspective(image, h, (width, height))
+
+
+def warp_tiled(image, h, size, tile_size=1024, workers=None):
+    """Equivalent of cv2.warpPerspective(image, h, size) for large outputs.
+
+    The output is split into tiles that are warped independently on a thread pool,
+    each from the part of the image it covers.
+
+    Args:
+        image (ndarray): The image to warp.
+        h (ndarray): (3,3) homography from the image to the output.
+        size (tuple): (width, height) of the output.
+        tile_size (int, optional): Width and height of the tiles.
+        workers (int, optional): Number of threads. Defaults to the number of CPUs.
+
+    Returns:
+        ndarray: The warped image
+    """
+    width, height = size
+    out = np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+    tiles = [
+        (x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _warp_tile, image, h, out[y : y + tile_size, x : x + tile_size], x, y
+            )
+            for x, y in tiles
+        ]
+        for future in futures:
+            future.result()
+    return out
+
+
+def get_circle_radius(coord_converter):
+    """Returns the radius in pitch pixels of a circle of size 1, which is the same
+    along both axes although the pitch pixels per percent differ."""
+    return np.prod(coord_converter) / np.sum(coord_converter)
+
+
+def get_circle_polygons(centres, radius, n_vertices=32):
+    """Returns regular polygons approximating circles.
+
+    Args:
+        centres (ndarray): Centres of size (..., n, 2).
+        radius (float): Radius of the circles.
+        n_vertices (int, optional): Number of vertices of the polygons.
+
+    Returns:
+        ndarray: The vertices, of size (..., n, n_vertices, 2)
+    """
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    offsets = radius * np.c_[np.cos(angles), np.sin(angles)]
+    return np.asarray(centres)[..., None, :] + offsets
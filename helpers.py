@@ -1,34 +1,167 @@
 import cv2
 import numpy as np
-from shapely.geometry import Polygon, Point
-from shapely.affinity import scale
-from itertools import product
 from PIL import Image, ImageFont, ImageDraw, ImageColor
-import streamlit as st
-import tempfile
 import base64
-from streamlit_drawable_canvas import st_canvas
+import hashlib
+import io
+import json
 import pandas as pd
 
+from cache import LRUCache, get_nbytes
+from calibration import (
+    get_correspondences,
+    get_homogeneous_lines,
+    get_pitch_lines,
+    solve_homography,
+)
+from export import EXPORTERS, get_export_bytes
+from geometry import (
+    WARP_MAPS,
+    Homography,
+    get_circle_polygons,
+    get_circle_radius,
+    get_output_size,
+    get_perspective_transforms,
+    get_warp_maps,
+    project_points,
+    warp_image,
+    warp_tiled,
+)
+from instrumentation import timed
+from video import VideoReader
+
+# Streamlit, its canvas component and shapely are imported by the functions using
+# them, so that batch workers importing this module do not load them
+
+# Decoded images and their calibrations, kept across Streamlit reruns
+SNAPSHOTS = LRUCache(
+    max_entries=16,
+    max_bytes=256 * 2**20,
+    sizeof=lambda snapshot: get_nbytes(snapshot.im) + get_nbytes(snapshot.full_im),
+)
+CALIBRATIONS = LRUCache(
+    max_entries=32,
+    max_bytes=128 * 2**20,
+    sizeof=lambda calibration: get_nbytes(calibration[1]),
+)
+VIDEOS = LRUCache(max_entries=2)
+
+
+class CanvasParser:
+    """Incremental parser of the objects drawn on a canvas.
+
+    The canvas returns all of its objects on every rerun, but objects are mostly
+    appended at the end. The parsed pixel coordinates of every object are kept,
+    and only the objects after the longest unchanged prefix are parsed again.
+    """
+
+    def __init__(self):
+        self.original = None
+        self.objects = []
+        self.rows = []
+
+    def parse(self, objects, original=True):
+        """Returns the pixel coordinates of the objects of a canvas.
+
+        Args:
+            objects (list): The "objects" of the canvas JSON data.
+            original (bool, optional): If True, the position of a rectangle is the
+                middle of its base, else its bottom right corner.
 
-def get_converted_positional_data(tags, snapshot, original, canvas_converted):
-    dfCoords = pd.json_normalize(canvas_converted.json_data["objects"])
+        Returns:
+            tuple: Arrays of size (n,2) of start and end points, which are equal
+                for rectangles, and lists of the object types and strokes
+        """
+        if original != self.original:
+            self.original = original
+            self.objects, self.rows = [], []
+        n_unchanged = 0
+        for cached, obj in zip(self.objects, objects):
+            if cached != obj:
+                break
+            n_unchanged += 1
+        self.objects = self.objects[:n_unchanged] + list(objects[n_unchanged:])
+        self.rows = self.rows[:n_unchanged] + [
+            self.parse_object(obj) for obj in objects[n_unchanged:]
+        ]
+        points = np.array([row[:4] for row in self.rows], dtype=float).reshape(-1, 4)
+        types = [row[4] for row in self.rows]
+        strokes = [row[5] for row in self.rows]
+        return points[:, :2], points[:, 2:], types, strokes
+
+    def parse_object(self, obj):
+        if obj["type"] == "line":
+            # Line ends are relative to the centre of the line
+            start = (obj["left"] + obj["x1"], obj["top"] + obj["y1"])
+            end = (obj["left"] + obj["x2"], obj["top"] + obj["y2"])
+        else:
+            width = obj["width"] * obj["scaleX"]
+            x = obj["left"] + (width / 2 if self.original else width)
+            start = end = (x, obj["top"] + obj["height"] * obj["scaleY"])
+        return (*start, *end, obj["type"], obj.get("stroke"))
+
+
+@timed()
+def get_converted_positional_data(
+    tags, snapshot, original, canvas_converted, parser=None
+):
+    """Converts the objects drawn on a canvas to positions on the pitch.
+
+    Args:
+        tags (dict): Stroke color of every tag.
+        snapshot (PitchImage): The calibrated image the objects are drawn on.
+        original (bool): If True, the objects are drawn on the original image, else
+            on the converted image.
+        canvas_converted: The result of st_canvas.
+        parser (CanvasParser, optional): Parser kept across reruns, so only the new
+            objects are parsed. Defaults to parsing all objects.
+
+    Returns:
+        DataFrame: The type, stroke, tag (team) and position (x, y) in percent of the
+            pitch of every object. Lines also have their start and end points, and
+            their position is their middle.
+    """
+    parser = parser if parser is not None else CanvasParser()
+    start, end, types, strokes = parser.parse(
+        canvas_converted.json_data["objects"], original
+    )
+    points = np.concatenate([start, end])
     if original:
-        dfCoords["x"] = dfCoords["left"] + (dfCoords["width"] * dfCoords["scaleX"]) / 2
-        dfCoords["y"] = dfCoords["top"] + dfCoords["height"] * dfCoords["scaleY"]
-        dfCoords[["x", "y"]] = snapshot.h.apply_to_points(dfCoords[["x", "y"]].values)
-    else:
-        dfCoords["x"] = dfCoords["left"] + dfCoords["width"] * dfCoords["scaleX"]
-        dfCoords["y"] = dfCoords["top"] + dfCoords["height"] * dfCoords["scaleY"]
-    dfCoords[["x", "y"]] = dfCoords[["x", "y"]] / snapshot.h.coord_converter
-    dfCoords["team"] = dfCoords.apply(
-        lambda x: {code: color for color, code in tags.items()}.get(x["stroke"]),
-        axis=1,
+        points = snapshot.h.apply_to_points(points)
+    start, end = np.split(points / snapshot.h.coord_converter, 2)
+    is_line = (np.array(types) == "line")[:, None]
+    xy = np.where(is_line, (start + end) / 2, start)
+    start, end = np.where(is_line, start, np.nan), np.where(is_line, end, np.nan)
+    teams = {code: tag for tag, code in tags.items()}
+    dfCoords = pd.DataFrame(
+        {
+            "type": types,
+            "stroke": strokes,
+            "team": [teams.get(stroke) for stroke in strokes],
+            "x": xy[:, 0],
+            "y": xy[:, 1],
+            "x_start": start[:, 0],
+            "y_start": start[:, 1],
+            "x_end": end[:, 0],
+            "y_end": end[:, 1],
+        }
     )
     return dfCoords
 
 
 def get_field_lines(pitch, snapshot, col1, col2, col3):
+    """Shows the canvas the pitch lines and keypoints are drawn on, and a selectbox
+    naming every drawn object.
+
+    Returns:
+        tuple: The result of st_canvas and the name of every drawn object, a pitch
+            line name for lines and an intersection name for keypoints
+    """
+    import streamlit as st
+    from streamlit_drawable_canvas import st_canvas
+
+    with col2:
+        mode = st.radio("Draw", ["Pitch lines", "Keypoints"], key="calibration mode")
     with col1:
         canvas_image = st_canvas(
             fill_color="rgba(255, 165, 0, 0.3)",
@@ -37,97 +170,183 @@ def get_field_lines(pitch, snapshot, col1, col2, col3):
             background_image=snapshot.im,
             width=snapshot.im.width,
             height=snapshot.im.height,
-            drawing_mode="line",
+            drawing_mode="line" if mode == "Pitch lines" else "circle",
             key="canvas",
         )
+    objects = canvas_image.json_data["objects"] if canvas_image.json_data else []
+    line_options = list(pitch.vert_lines) + list(pitch.horiz_lines)
+    point_options = list(pitch.get_intersections())
+    names = []
     with col2:
-        line_seq = ["UP", "DP", "RPA", "RG"]
-        h_line_options = list(pitch.horiz_lines.keys())
-        v_line_options = list(pitch.vert_lines.keys())
-        hlines = [
-            st.selectbox(
-                f"Horizontal Line #{x+1}",
-                h_line_options,
-                key=f"hline {x}",
-                index=h_line_options.index(line_seq[x]),
+        n_lines = n_points = 0
+        for obj in objects:
+            if obj["type"] == "line":
+                defaults = list(pitch.DEFAULT_LINES[n_lines : n_lines + 1])
+                options, label = line_options, f"Line #{n_lines + 1}"
+                n_lines += 1
+            else:
+                defaults, options = [], point_options
+                label = f"Keypoint #{n_points + 1}"
+                n_points += 1
+            # The default line of the pitch, else the first name not taken yet
+            default = next(
+                (name for name in defaults + options if name not in names), options[0]
             )
-            for x in range(2)
-        ]
-        vlines = [
-            st.selectbox(
-                f"Vertical Line #{x+1}",
-                v_line_options,
-                key=f"vline {x}",
-                index=v_line_options.index(line_seq[x + 2]),
+            names.append(
+                st.selectbox(label, options, key=label, index=options.index(default))
             )
-            for x in range(2)
-        ]
     with col3:
-        st.image("pitch.png", width=300)
-    return canvas_image, hlines, vlines
+        st.image(pitch.IMAGE or get_pitch_diagram(pitch), width=300)
+    return canvas_image, names
+
+
+def get_circle_center(obj):
+    """Returns the centre of a circle drawn on a canvas, from its origin, radius,
+    scale and rotation."""
+    origins = {"left": 0.0, "top": 0.0, "center": 0.5, "right": 1.0, "bottom": 1.0}
+    origin = [origins[obj.get("originX", "left")], origins[obj.get("originY", "top")]]
+    diameter = (
+        2 * obj["radius"] * np.array([obj.get("scaleX", 1), obj.get("scaleY", 1)])
+    )
+    offset = (0.5 - np.array(origin)) * diameter
+    angle = np.radians(obj.get("angle", 0))
+    cos, sin = np.cos(angle), np.sin(angle)
+    rotated = [cos * offset[0] - sin * offset[1], sin * offset[0] + cos * offset[1]]
+    return np.array([obj["left"], obj["top"]]) + rotated
+
+
+def split_calibration_objects(objects, names):
+    """Splits the objects drawn on the calibration canvas into lines and keypoints.
+
+    Args:
+        objects (list): The "objects" of the canvas JSON data.
+        names (list): Name of every object, as returned by get_field_lines.
+
+    Returns:
+        tuple: The normalized line objects, their pitch line names and the image
+            position of the keypoints keyed by intersection name, as taken by
+            PitchImage.set_info
+
+    Raises:
+        ValueError: If two objects have the same name.
+    """
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"{', '.join(sorted(duplicates))} is selected more than once")
+    lines = [(obj, name) for obj, name in zip(objects, names) if obj["type"] == "line"]
+    keypoints = {
+        name: get_circle_center(obj).tolist()
+        for obj, name in zip(objects, names)
+        if obj["type"] == "circle"
+    }
+    df = pd.json_normalize([obj for obj, _ in lines])
+    if not lines:
+        df = pd.DataFrame(columns=["left", "top", "x1", "y1", "x2", "y2"], dtype=float)
+    return df, [name for _, name in lines], keypoints
+
+
+def get_pitch_diagram(pitch, scale=2):
+    """Draws the line segments of a pitch with the names of its lines, as a guide for
+    pitches without an image of their line names."""
+    margin = 30
+    size = np.array(get_output_size(pitch, scale)) + 2 * margin
+    image = np.full((size[1], size[0], 3), (40, 120, 40), np.uint8)
+    segments = pitch.get_line_segments() * scale + margin
+    cv2.polylines(image, list(segments.round().astype(np.int32)), False, (255,) * 3)
+    font, color = cv2.FONT_HERSHEY_SIMPLEX, (255, 230, 0)
+    for name, x in pitch.vert_lines.items():
+        x = int(x * pitch.SCALE * scale + margin)
+        cv2.putText(image, name, (x - 8, margin - 10), font, 0.4, color)
+    for name, y in pitch.horiz_lines.items():
+        y = int(y * pitch.SCALE * scale + margin)
+        cv2.putText(image, name, (2, y + 4), font, 0.4, color)
+    return image
+
+
+def download_data(store, columns=None):
+    import streamlit as st
+
+    fmt = st.selectbox("File format", list(EXPORTERS))
+    # Serializing is deferred to an explicit request, as the link embeds the file
+    if st.button("Prepare download"):
+        content = get_export_bytes(store, fmt, columns)
+        st.markdown(
+            get_file_download_link(content, f"data.{fmt}"), unsafe_allow_html=True
+        )
 
 
-def download_data(data):
-    st.markdown(get_table_download_link(data), unsafe_allow_html=True)
+def load_video(data, digest, cache=None):
+    """Returns the VideoReader of an uploaded video, kept across Streamlit reruns.
 
+    Args:
+        data (bytes): The uploaded video.
+        digest (str): Hash of the data.
+        cache (LRUCache, optional): Cache of the session. Defaults to VIDEOS.
+    """
+    cache = cache if cache is not None else VIDEOS
+    video = cache.get(("video", digest))
+    if video is None:
+        video = cache.put(("video", digest), VideoReader(data=data))
+    return video
+
+
+@timed()
+def visualize_pitch(uploaded_file, pitch, session=None):
+    """Decodes the uploaded image, or the frame chosen with a slider of an uploaded
+    video.
+
+    Args:
+        uploaded_file: The file returned by st.file_uploader.
+        pitch (Pitch): The pitch on the image.
+        session (Session, optional): The session of the user, whose cache keeps the
+            video and the image, decoded with Session.run. Defaults to the global
+            caches.
+
+    Returns:
+        PitchImage: The image
+    """
+    import streamlit as st
 
-def visualize_pitch(uploaded_file, pitch):
+    snapshots = session.cache if session is not None else SNAPSHOTS
+    videos = session.cache if session is not None else VIDEOS
+    run = session.run if session is not None else _run_inline
+    data = uploaded_file.getvalue()
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
     if uploaded_file.type == "video/mp4":
-        play = Play(uploaded_file)
+        # Indexing a long video is not bounded by Session.run, so that it does
+        # not hold back the other computations of the session
+        video = load_video(data, digest, videos)
         t = st.slider(
             "You have uploaded a video. Choose the frame you want to process:",
             0.0,
-            15.0,
+            video.duration - 1 / video.fps,
+            step=1 / video.fps,
         )
-        snapshot = PitchImage(pitch, image=play.get_frame(t))
     else:
-        snapshot = PitchImage(pitch, image_bytes=uploaded_file)
         t = 0.0
+    # The decoded image is reused by the following reruns of the same upload and frame
+    key = (digest, t, type(pitch).__name__)
+    snapshot = snapshots.get(key)
+    if snapshot is None:
+        if uploaded_file.type == "video/mp4":
+            image = run(video.get_frame_at, t)
+            snapshot = run(PitchImage, pitch, image=image, key=key)
+        else:
+            snapshot = run(PitchImage, pitch, image_bytes=uploaded_file, key=key)
+        snapshots.put(key, snapshot)
     return snapshot
 
 
-class Homography:
-    def __init__(self, pts_src, pts_dst):
-        self.pts_src = np.array(pts_src)
-        self.pts_dst = np.array(pts_dst)
-        self.h, out = cv2.findHomography(self.pts_src, self.pts_dst)
-        self.im_size = (525, 340)
-        self.im_width = self.im_size[0]
-        self.im_heigth = self.im_size[1]
-        self.coord_converter = np.array(self.im_size) / 100
-
-    def apply_to_image(self, image):
-        """Applies homography to provided image.
-
-        Args:
-            image (PitchImage): A PitchImage instance
-
-        Returns:
-            ndarray: numpy array representing an image of size self.im_size
-        """
-        im_out = cv2.warpPerspective(np.array(image.im), self.h, self.im_size)
-        return im_out
-
-    def apply_to_points(self, points, inverse=False):
-        """Applies homography to provided points
-
-        Args:
-            points (ndarray): An array of size (n,2).
-            inverse (bool, optional): If True, inverts the homography matrix. Defaults to False.
-
-        Returns:
-            ndarray: An array of size (n,2)
-        """
-        h = np.linalg.inv(self.h) if inverse else self.h
-        _points = np.hstack([points, np.ones((len(points), 1))])
-        _converted_points = np.dot(h, _points.T)
-        points = _converted_points / _converted_points[2]
-        return points[:2].T
+def _run_inline(func, *args, **kwargs):
+    return func(*args, **kwargs)
 
 
 class VoronoiPitch:
+    @timed()
     def __init__(self, df):
         self.vor, self.df = calculate_voronoi(df)
+        self.region_team = np.full(len(self.vor.regions), None, dtype=object)
+        self.region_team[self.df["region"].values] = self.df["team"].values
 
     def get_regions(self):
         return [
@@ -137,85 +356,206 @@ class VoronoiPitch:
         ]
 
     def get_points_region(self, region):
-        return np.vstack([self.vor.vertices[i] for i in self.vor.regions[region]])
+        return self.vor.vertices[self.vor.regions[region]]
 
     def get_color_region(self, region):
-        return self.df[self.df["region"] == region]["team"].values[0]
+        return self.region_team[region]
 
+    @timed()
     def get_voronoi_polygons(self, image, original=True):
+        regions = self.get_regions()
+        polygons = get_polygons(
+            [
+                self.get_points_region(region) * image.h.coord_converter
+                for region in regions
+            ],
+            image,
+            original,
+        )
         return [
-            {
-                "polygon": get_polygon(
-                    self.get_points_region(region) * image.h.coord_converter,
-                    image,
-                    original,
-                ),
-                "color": self.get_color_region(region),
-            }
-            for region in self.get_regions()
+            {"polygon": polygon, "color": self.region_team[region]}
+            for polygon, region in zip(polygons, regions)
         ]
 
+    def get_raster(self, size, method="kdtree"):
+        """Rasterizes the regions as a nearest-player label image.
 
-class Play:
-    def __init__(self, uploaded_video):
-        with tempfile.NamedTemporaryFile() as fp:
-            fp.write(uploaded_video.getvalue())
-            self.video = cv2.VideoCapture(fp.name)
+        Args:
+            size (tuple): (width, height) of the raster, e.g. Homography.im_size.
+            method (str, optional): "kdtree" for exact nearest players or "distance"
+                for a faster approximation with a distance transform.
 
-    def get_frame(self, t):
-        self.video.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
-        success, img = self.video.read()
-        return img
+        Returns:
+            ndarray: An int array of size (height, width) with the row of self.df
+                of the nearest player of each pixel
+        """
+        points = self.df[["x", "y"]].values * np.array(size) / 100
+        return calculate_voronoi_raster(points, size, method)
 
 
 class PitchImage:
-    def __init__(self, pitch, image=None, image_bytes=None, width=600):
+    @timed()
+    def __init__(self, pitch, image=None, image_bytes=None, width=600, key=None):
+        """
+        Args:
+            pitch (Pitch): The pitch on the image.
+            image (ndarray, optional): A BGR image.
+            image_bytes (file, optional): An encoded image, if image is None.
+            width (int, optional): Width of the preview the lines and players are
+                drawn on. The image is kept at full resolution for get_warped_image.
+                None uses the full resolution image as preview.
+            key (hashable, optional): Identifies the content of the image, e.g. a hash
+                of the upload. Calibrations of images with a key are cached by
+                set_info.
+        """
+        self.key = key
         if image is not None:
-            im_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            self.im = self.resize(Image.fromarray(im_rgb), width=width)
+            self.full_im = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
         else:
-            self.im = self.resize(Image.open(image_bytes), width=width)
+            self.full_im = Image.open(image_bytes)
+        self.im = self.full_im if width is None else self.resize(self.full_im, width)
         self.pitch = pitch
+        self.masks = {}
 
     def resize(self, im, width):
         im = im.resize((width, int(width * im.height / im.width)))
         return im
 
-    def set_info(self, df, lines):
-        df["line"] = lines
-        df["y1_line"] = df["top"] + df["y1"]
-        df["y2_line"] = df["top"] + df["y2"]
-        df["x1_line"] = df["left"] + df["x1"]
-        df["x2_line"] = df["left"] + df["x2"]
-        df["slope"], df["intercept"] = get_si_from_coords(
-            df[["x1_line", "y1_line", "x2_line", "y2_line"]].values
-        )
-        df = df.set_index("line")
-        self.df = df
-        self.lines = lines
-        self.h = Homography(*self.get_intersections())
-        self.conv_im = Image.fromarray(self.h.apply_to_image(self))
+    def get_full_resolution_homography(self):
+        """Returns the (3,3) homography from the full resolution image to pitch
+        pixels, self.h being defined on the preview."""
+        sx, sy = np.array(self.im.size) / np.array(self.full_im.size)
+        return self.h.h @ np.diag([sx, sy, 1.0])
 
-    def get_intersections(self):
-        lines = self.lines
-        vertical_lines = [x for x in lines if x in self.pitch.vert_lines]
-        horizontal_lines = [x for x in lines if x in self.pitch.horiz_lines]
-        intersections = {
-            "_".join([v, h]): line_intersect(
-                self.df.loc[v, ["slope", "intercept"]],
-                self.df.loc[h, ["slope", "intercept"]],
+    @timed()
+    def get_warped_image(self, scale=1, tile_size=1024, workers=None):
+        """Warps the full resolution image to a bird's-eye view.
+
+        Args:
+            scale (float, optional): Resolution of the output relative to
+                self.h.im_size.
+            tile_size (int, optional): Size of the output tiles warped in parallel.
+            workers (int, optional): Number of threads. Defaults to the number of
+                CPUs.
+
+        Returns:
+            ndarray: An RGB image of size self.h.im_size * scale
+        """
+        size = tuple(int(round(s * scale)) for s in self.h.im_size)
+        h = np.diag([scale, scale, 1.0]) @ self.get_full_resolution_homography()
+        return warp_tiled(np.asarray(self.full_im), h, size, tile_size, workers)
+
+    @timed()
+    def set_info(self, df, lines, keypoints=None, cache=None):
+        """Calibrates the image with lines drawn on the canvas.
+
+        Args:
+            df (DataFrame): Normalized canvas line objects, in drawing order.
+            lines (list): Pitch line name of each drawn line.
+            keypoints (dict, optional): Image position of pitch intersections,
+                keyed by their name in pitch.get_intersections().
+            cache (LRUCache, optional): Cache of the calibrations of images with a
+                key, e.g. the cache of the session. Defaults to CALIBRATIONS.
+        """
+        cache = cache if cache is not None else CALIBRATIONS
+        self.df = get_lines_info(df, lines)
+        key = None
+        if self.key is not None:
+            coords = self.df[["x1_line", "y1_line", "x2_line", "y2_line"]].values
+            key = (
+                "calibration",
+                self.key,
+                tuple(lines),
+                coords.astype(float).tobytes(),
+                json.dumps(keypoints, sort_keys=True),
             )
-            for v, h in product(vertical_lines, horizontal_lines)
-        }
+        calibration = cache.get(key) if key is not None else None
+        if calibration is None:
+            h, calibration = calibrate_lines(self.pitch, self.df, lines, keypoints)
+            self.set_homography(h, lines)
+            self.calibration = calibration
+            if key is not None:
+                cache.put(key, (self.h, self.conv_im, self.calibration))
+        elif calibration[0] is not getattr(self, "h", None):
+            self.set_homography(calibration[0], lines, conv_im=calibration[1])
+            self.calibration = calibration[2]
+
+    @timed()
+    def set_detected_lines(self, cache=None):
+        """Calibrates the image with automatically detected pitch lines.
+
+        Args:
+            cache (LRUCache, optional): Cache of the detections of images with a
+                key, e.g. the cache of the session. Defaults to CALIBRATIONS.
 
-        pts_src = list(intersections.values())
-        pts_dst = [self.pitch.get_intersections()[x] for x in intersections]
+        Returns:
+            dict: The detection of line_detection.detect_pitch_lines, None if no
+                lines were found
+        """
+        from line_detection import detect_pitch_lines
+
+        cache = cache if cache is not None else CALIBRATIONS
+        key = ("detection", self.key) if self.key is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is None:
+            detection = detect_pitch_lines(self.im, self.pitch)
+            if detection is not None:
+                self.set_homography(detection["homography"], detection["lines"])
+            if key is not None:
+                conv_im = self.conv_im if detection is not None else None
+                cache.put(key, (detection, conv_im))
+            return detection
+        detection, conv_im = cached
+        if detection is not None and detection["homography"] is not getattr(
+            self, "h", None
+        ):
+            self.set_homography(
+                detection["homography"], detection["lines"], conv_im=conv_im
+            )
+        return detection
 
-        return pts_src, pts_dst
+    @timed()
+    def set_homography(self, h, lines, conv_im=None):
+        """Calibrates the image with a homography, e.g. from detected pitch lines.
+
+        Args:
+            h (Homography): Homography from image to pitch coordinates.
+            lines (list): Names of the pitch lines the homography is based on.
+            conv_im (Image, optional): The image already warped by h. Defaults to
+                warping the image.
+        """
+        self.lines = lines
+        self.h = h
+        self.calibration = None
+        if conv_im is None:
+            conv_im = Image.fromarray(self.h.apply_to_image(self))
+        self.conv_im = conv_im
+        self.masks = {key: mask for key, mask in self.masks.items() if key[0]}
+
+    def get_intersections(self):
+        return get_line_intersections(self.pitch, self.df, self.lines)
+
+    def get_calibration(self):
+        """Returns the calibration of this image as a JSON-serializable dict, to be
+        reused by the batch pipeline on other frames of the same camera."""
+        return {
+            "image_size": list(self.im.size),
+            "lines": list(self.lines),
+            "homography": self.h.h.tolist(),
+        }
 
     def get_image(self, original=True):
         return self.im if original else self.conv_im
 
+    def get_pitch_mask(self, sensitivity=25, original=True):
+        """Returns the grass mask of the image, computed once per sensitivity."""
+        key = (original, sensitivity)
+        if key not in self.masks:
+            self.masks[key] = get_edge_img(
+                self.get_image(original), sensitivity=sensitivity
+            )
+        return self.masks[key]
+
     def get_pitch_coords(self):
         return (
             (0, 0),
@@ -224,6 +564,19 @@ class PitchImage:
             (self.h.im_width, 0),
         )
 
+    def get_clip_polygon(self):
+        """Returns the part of the pitch visible on the image, in pitch pixels.
+
+        It is computed once per homography."""
+        if getattr(self, "_clip_h", None) is not self.h:
+            from shapely.geometry import Polygon
+
+            pitch_polygon = Polygon(self.get_pitch_coords())
+            camera_polygon = Polygon(self.get_camera_coords()).convex_hull
+            self._clip_polygon = camera_polygon.intersection(pitch_polygon)
+            self._clip_h = self.h
+        return self._clip_polygon
+
     def get_camera_coords(self):
         return self.h.apply_to_points(
             (
@@ -241,6 +594,7 @@ class PitchDraw:
         self.draw_im = Image.new("RGBA", self.base_im.size, (0, 0, 0, 0))
         self.draw = ImageDraw.Draw(self.draw_im, mode="RGBA")
         self.original = original
+        self.pitch_image = pitch_image
         self.h = pitch_image.h
 
     def draw_polygon(self, polygon, color, outline="gray"):
@@ -256,21 +610,122 @@ class PitchDraw:
                 fill_color = get_rgba(pol["color"], opacity)
                 self.draw_polygon(pol["polygon"], fill_color)
 
-    def draw_circle(self, xy, color, size=1, opacity=255, outline=None):
-        center = Point(*xy)
-        scaler = self.h.coord_converter / self.h.coord_converter.sum()
-        circle = scale(center.buffer(size), *reversed(scaler))
+    def draw_surface(self, surface, color, opacity=255):
+        """Draws a surface covering the whole pitch, e.g. the pitch control of a team.
+
+        Args:
+            surface (ndarray): An array of size (n_y, n_x) with values between 0 and 1.
+            color (str): Color of the surface.
+            opacity (int, optional): Opacity where the surface is 1. Defaults to 255.
+        """
+        alpha = cv2.resize(np.asarray(surface, dtype=np.float32), self.h.im_size)
+        alpha = np.clip(alpha, 0, 1) * opacity
         if self.original:
-            points = self.h.apply_to_points(
-                np.vstack(circle.exterior.xy).T * self.h.coord_converter, inverse=True
+            alpha = cv2.warpPerspective(alpha, self.h.h_inv, self.base_im.size)
+        layer = np.zeros(alpha.shape + (4,), dtype=np.uint8)
+        layer[:, :, :3] = get_rgba(color)[:3]
+        layer[:, :, 3] = alpha
+        self.draw_im.alpha_composite(Image.fromarray(layer))
+
+    def draw_polygons(self, polygons, colors, opacity=255, outlines=None):
+        """Draws polygons with the same number of vertices in one pass per color.
+
+        Args:
+            polygons (ndarray): Vertices in image pixels, of size (n, vertices, 2).
+            colors: A color or a list of n colors.
+            opacity (int, optional): Opacity of the fill. Defaults to 255.
+            outlines (optional): A color or a list of n colors of the opaque
+                outlines. Defaults to the fill colors.
+        """
+        polygons = np.asarray(polygons, dtype=float)
+        visible = np.isfinite(polygons).all(axis=(1, 2))
+        colors = np.broadcast_to(np.asarray(colors, dtype=object), len(polygons))
+        outlines = colors if outlines is None else outlines
+        outlines = np.broadcast_to(np.asarray(outlines, dtype=object), len(polygons))
+        # Vertices with 4 fractional bits, for sub-pixel accuracy
+        vertices = np.round(np.nan_to_num(polygons) * 16).astype(np.int32)
+        layer = np.zeros((self.base_im.height, self.base_im.width, 4), np.uint8)
+        for color in set(colors[visible]):
+            cv2.fillPoly(
+                layer,
+                list(vertices[visible & (colors == color)]),
+                get_rgba(color, opacity),
+                cv2.LINE_AA,
+                4,
             )
-        else:
-            points = np.vstack(circle.exterior.xy).T * self.h.coord_converter
+        for color in set(outlines[visible]):
+            cv2.polylines(
+                layer,
+                list(vertices[visible & (outlines == color)]),
+                True,
+                get_rgba(color),
+                1,
+                cv2.LINE_AA,
+                4,
+            )
+        self.draw_im.alpha_composite(Image.fromarray(layer))
+
+    @timed()
+    def draw_circles(self, xy, colors, size=1, opacity=255, outlines=None):
+        """Draws circles around many positions with a single projection.
+
+        Args:
+            xy (ndarray): Centres in percent of the pitch, of size (n,2).
+            colors: A color or a list of n colors.
+            size (float, optional): Radius, in the units of draw_circle.
+            opacity (int, optional): Opacity of the fill. Defaults to 255.
+            outlines (optional): A color or a list of n colors of the outlines.
+                Defaults to the fill colors.
+        """
+        polygons = get_circle_polygons(
+            np.asarray(xy, dtype=float).reshape(-1, 2) * self.h.coord_converter,
+            size * get_circle_radius(self.h.coord_converter),
+        )
+        if self.original:
+            polygons = self.h.apply_to_points(polygons, inverse=True)
+        self.draw_polygons(polygons, colors, opacity, outlines)
+
+    @timed()
+    def draw_circle(self, xy, color, size=1, opacity=255, outline=None):
+        points = get_circle_polygons(
+            np.asarray(xy, dtype=float) * self.h.coord_converter,
+            size * get_circle_radius(self.h.coord_converter),
+        )
+        if self.original:
+            points = self.h.apply_to_points(points, inverse=True)
         fill_color = get_rgba(color, opacity)
         if outline is None:
             outline = color
         self.draw_polygon(points, fill_color, outline)
 
+    def draw_lines(self, start, end, colors, width=2):
+        """Draws segments between positions with a single projection.
+
+        Args:
+            start (ndarray): Starts in percent of the pitch, of size (n,2).
+            end (ndarray): Ends in percent of the pitch, of size (n,2).
+            colors: A color or a list of n colors.
+            width (int, optional): Width of the lines in pixels.
+        """
+        points = np.stack([start, end], axis=1).astype(float) * self.h.coord_converter
+        if self.original:
+            points = self.h.apply_to_points(points, inverse=True)
+        visible = np.isfinite(points).all(axis=(1, 2))
+        colors = np.broadcast_to(np.asarray(colors, dtype=object), len(points))
+        points = np.round(np.nan_to_num(points) * 16).astype(np.int32)
+        layer = np.zeros((self.base_im.height, self.base_im.width, 4), np.uint8)
+        for color in set(colors[visible]):
+            cv2.polylines(
+                layer,
+                list(points[visible & (colors == color)]),
+                False,
+                get_rgba(color),
+                width,
+                cv2.LINE_AA,
+                4,
+            )
+        self.draw_im.alpha_composite(Image.fromarray(layer))
+
     def draw_text(self, xy, string, color):
         xy = xy * self.h.coord_converter
         font = ImageFont.load_default()
@@ -278,29 +733,83 @@ class PitchDraw:
             xy = self.h.apply_to_points([xy], inverse=True)[0]
         self.draw.text(tuple(xy), string, font=font, fill=color)
 
+    @timed()
     def compose_image(self, sensitivity=25):
-        pitch_mask = get_edge_img(self.base_im, sensitivity=sensitivity)
+        pitch_mask = self.pitch_image.get_pitch_mask(sensitivity, self.original)
         self.draw_im.putalpha(
             Image.fromarray(np.minimum(pitch_mask, np.array(self.draw_im.split()[-1])))
         )
         return Image.alpha_composite(self.base_im.convert("RGBA"), self.draw_im)
 
 
-def line_intersect(si1, si2):
-    m1, b1 = si1
-    m2, b2 = si2
-    if m1 == m2:
-        return None
-    x = (b2 - b1) / (m1 - m2)
-    y = m1 * x + b1
-    return x, y
+def get_lines_info(df, lines):
+    """Adds absolute coordinates and homogeneous coefficients to the lines drawn on a
+    canvas.
 
+    Args:
+        df (DataFrame): Normalized canvas line objects, in drawing order.
+        lines (list): Pitch line name of each drawn line.
 
-def get_si_from_coords(lines):
-    x1, y1, x2, y2 = lines.T
-    slope = (y2 - y1) / (x2 - x1)
-    intercept = y2 - slope * x2
-    return slope, intercept
+    Returns:
+        DataFrame: The line information indexed by pitch line name
+    """
+    df = df.copy()
+    df["line"] = lines
+    df["y1_line"] = df["top"] + df["y1"]
+    df["y2_line"] = df["top"] + df["y2"]
+    df["x1_line"] = df["left"] + df["x1"]
+    df["x2_line"] = df["left"] + df["x2"]
+    df["a"], df["b"], df["c"] = get_homogeneous_lines(
+        df[["x1_line", "y1_line", "x2_line", "y2_line"]].values.astype(float)
+    ).T
+    return df.set_index("line")
+
+
+def get_line_intersections(pitch, df, lines, keypoints=None):
+    """Matches the intersections of the drawn lines with the pitch intersections.
+
+    Args:
+        pitch (Pitch): The pitch the lines were drawn on.
+        df (DataFrame): Line information as returned by get_lines_info.
+        lines (list): Pitch line names of the drawn lines.
+        keypoints (dict, optional): Image position of pitch intersections, keyed
+            by their name in pitch.get_intersections().
+
+    Returns:
+        tuple: Source (image) and destination (pitch) points
+    """
+    segments = df.loc[lines, ["x1_line", "y1_line", "x2_line", "y2_line"]].values
+    pts_src, pts_dst, _ = get_correspondences(pitch, segments, lines, keypoints)
+    return pts_src, pts_dst
+
+
+def calibrate_lines(pitch, df, lines, keypoints=None, im_size=None, **kwargs):
+    """Estimates the homography of an image from any number of drawn pitch lines.
+
+    Args:
+        pitch (Pitch): The pitch the lines were drawn on.
+        df (DataFrame): Line information as returned by get_lines_info.
+        lines (list): Pitch line names of the drawn lines.
+        keypoints (dict, optional): Image position of pitch intersections, keyed
+            by their name in pitch.get_intersections().
+        im_size (tuple, optional): (width, height) of the pitch in pixels.
+            Defaults to get_output_size(pitch).
+        **kwargs: Passed to calibration.solve_homography.
+
+    Returns:
+        tuple: The Homography, and the result of solve_homography with the
+            "names" of the points
+    """
+    segments = df.loc[lines, ["x1_line", "y1_line", "x2_line", "y2_line"]].values
+    segments = segments.astype(float)
+    pts_src, pts_dst, names = get_correspondences(pitch, segments, lines, keypoints)
+    result = solve_homography(
+        pts_src, pts_dst, segments, get_pitch_lines(pitch, lines), **kwargs
+    )
+    result["names"] = names
+    im_size = im_size if im_size is not None else get_output_size(pitch)
+    h = Homography(pts_src, pts_dst, im_size=im_size, h=result["homography"])
+    return h, result
 
 
 def calculate_voronoi(df):
@@ -320,27 +829,125 @@ def calculate_voronoi(df):
     return vor, df
 
 
-def get_polygon(points, image, convert):
-    base_polygon = Polygon(points.tolist())
-    pitch_polygon = Polygon(image.get_pitch_coords())
-    camera_polygon = Polygon(image.get_camera_coords()).convex_hull
-    polygon = camera_polygon.intersection(pitch_polygon).intersection(base_polygon)
-    if polygon.area > 0:
-        if convert:
-            polygon = image.h.apply_to_points(
-                np.vstack(polygon.exterior.xy).T, inverse=True
-            )
-        else:
-            polygon = np.vstack(polygon.exterior.xy).T
-        return polygon
+def calculate_voronoi_raster(points, size, method="kdtree"):
+    """Computes nearest-player label images on a pixel grid.
+
+    Args:
+        points (ndarray): Player positions in pixels, of size (n,2) or (f,n,2) for a
+            sequence of frames. Missing players can be set to NaN.
+        size (tuple): (width, height) of the grid.
+        method (str, optional): "kdtree" queries a KD-tree of the players with every
+            pixel centre (exact). "distance" labels pixels with a distance transform
+            seeded at the players' pixels, which is faster but approximates the
+            region boundaries. Defaults to "kdtree".
+
+    Returns:
+        ndarray: An int array of size (height, width) or (f, height, width) with the
+            index of the nearest player, -1 if there is none
+    """
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 3:
+        return np.stack([calculate_voronoi_raster(p, size, method) for p in points])
+
+    width, height = size
+    labels = np.full((height, width), -1, dtype=np.int32)
+    valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+    if len(valid) == 0:
+        return labels
+    if method == "kdtree":
+        from scipy.spatial import cKDTree
+
+        grid = np.dstack(np.meshgrid(np.arange(width), np.arange(height))) + 0.5
+        _, nearest = cKDTree(points[valid]).query(grid.reshape(-1, 2))
+        labels[:] = valid[nearest].reshape(height, width)
+    elif method == "distance":
+        pixels = np.clip(points[valid].astype(int), 0, [width - 1, height - 1])
+        seeds = np.ones((height, width), dtype=np.uint8)
+        seeds[pixels[:, 1], pixels[:, 0]] = 0
+        _, seed_labels = cv2.distanceTransformWithLabels(
+            seeds, cv2.DIST_L2, 5, labelType=cv2.DIST_LABEL_PIXEL
+        )
+        # Seeds are labelled 1..k in raster order
+        order = np.lexsort((pixels[:, 0], pixels[:, 1]))
+        seed_index = np.ravel_multi_index(
+            (pixels[order, 1], pixels[order, 0]), (height, width)
+        )
+        _, first = np.unique(seed_index, return_index=True)
+        lookup = np.concatenate([[-1], valid[order[first]]])
+        labels[:] = lookup[seed_labels]
     else:
-        return None
+        raise ValueError(f"Unknown method {method}")
+    return labels
+
 
+def get_polygons(regions, image, convert):
+    """Clips polygons to the visible part of the pitch.
+
+    The clipping polygon is computed once per homography and all the clipped
+    polygons are projected with a single homography call.
+
+    Args:
+        regions (list): Arrays of size (n,2) with the vertices of each polygon in
+            pitch pixels.
+        image (PitchImage): The calibrated image.
+        convert (bool): If True, converts the polygons to image coordinates.
+
+    Returns:
+        list: Arrays of size (n,2) with the clipped polygons, None for the polygons
+            outside of the visible pitch
+    """
+    from shapely.geometry import Polygon
 
-def get_edge_img(img, sensitivity=25):
+    clip_polygon = image.get_clip_polygon()
+    polygons = [clip_polygon.intersection(Polygon(points)) for points in regions]
+    exteriors = [
+        np.array(polygon.exterior.coords) if polygon.area > 0 else np.empty((0, 2))
+        for polygon in polygons
+    ]
+    if convert and len(exteriors):
+        points = image.h.apply_to_points(np.vstack(exteriors), inverse=True)
+        exteriors = np.split(points, np.cumsum([len(e) for e in exteriors])[:-1])
+    return [exterior if len(exterior) else None for exterior in exteriors]
+
+
+def get_polygon(points, image, convert):
+    return get_polygons([points], image, convert)[0]
+
+
+def get_hue_histogram(hues):
+    """Counts the pixels of each hue, ignoring hues 0 and 1."""
+    hist = np.bincount(hues.ravel(), minlength=256)
+    hist[:2] = 0
+    return hist
+
+
+def get_histogram_median(hist):
+    """Returns the median of the values counted in a histogram, same as np.median."""
+    cumsum = np.cumsum(hist)
+    n = cumsum[-1]
+    if n == 0:
+        return np.nan
+    low, high = np.searchsorted(cumsum, [(n - 1) // 2 + 1, n // 2 + 1])
+    return (low + high) / 2
+
+
+@timed()
+def get_edge_img(img, sensitivity=25, hist=None):
+    """Returns the mask of the grass pixels of an image.
+
+    Args:
+        img: A PIL image or an array.
+        sensitivity (int, optional): Maximal hue distance to the median hue.
+        hist (ndarray, optional): Precomputed hue histogram of the image, as
+            returned by get_hue_histogram.
+
+    Returns:
+        ndarray: A uint8 mask, 255 on the pitch
+    """
     hsv_img = cv2.cvtColor(np.array(img), cv2.COLOR_BGR2HSV)
-    hues = hsv_img[:, :, 0]
-    median_hue = np.median(hues[hues > 1])
+    if hist is None:
+        hist = get_hue_histogram(hsv_img[:, :, 0])
+    median_hue = get_histogram_median(hist)
     min_filter = np.array([median_hue - sensitivity, 20, 0])
     max_filter = np.array([median_hue + sensitivity, 255, 255])
 
@@ -353,14 +960,22 @@ def get_rgba(color, alpha=255):
     return color + (alpha,)
 
 
-def get_table_download_link(df):
-    """Generates a link allowing the data in a given panda dataframe to be downloaded
-    in:  dataframe
-    out: href string
-    """
-    csv = df.to_csv(index=True)
-    b64 = base64.b64encode(
-        csv.encode()
-    ).decode()  # some strings <-> bytes conversions necessary here
-    href = f'<a href="data:file/csv;base64,{b64}" download="data.csv">Download csv file</a>'
-    return href
\ No newline at end of file
+def get_file_download_link(content, filename):
+    """Generates a link allowing the given bytes to be downloaded as a file"""
+    b64 = base64.b64encode(content).decode()
+    href = f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}">Download {filename}</a>'
+    return href
+
+
+def get_image_download_link(image, filename):
+    """Generates a link allowing an RGB image array to be downloaded as a PNG file"""
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG")
+    return get_file_download_link(buffer.getvalue(), filename)
+
+
+def get_calibration_download_link(snapshot):
+    """Generates a link to download the calibration of an image for the batch pipeline"""
+    b64 = base64.b64encode(json.dumps(snapshot.get_calibration()).encode()).decode()
+    href = f'<a href="data:file/json;base64,{b64}" download="calibration.json">Download calibration</a>'
+    return href
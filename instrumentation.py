@@ -0,0 +1,221 @@
+"""Timing and allocation counters of the pipeline stages.
+
+Stages are measured with the `stage` context manager or the `timed` decorator:
+
+    with stage("decode"):
+        ...
+
+    @timed("edge_img")
+    def get_edge_img(img):
+        ...
+
+Instrumentation is disabled by default, and then costs a single flag check per
+call. It is enabled with enable(), for a given owner such as an app session, and
+stays enabled while any owner has it enabled. For headless runs, it is enabled
+with the BPV_INSTRUMENT environment variable, set to 1 for timings only or to
+"memory" to also trace allocations with tracemalloc. If BPV_INSTRUMENT_DUMP is
+set to a path, the counters are written there at exit, as JSON or, for a .prom or
+.txt path, in the Prometheus text format.
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_enabled = False
+_memory = False
+# Memory flag of every owner that enabled the counters, e.g. app sessions
+_owners = {}
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _update():
+    global _enabled, _memory
+    memory = any(_owners.values())
+    if _memory and not memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = bool(_owners)
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def enable(memory=False, owner=None):
+    """Starts collecting counters.
+
+    Counters stay enabled while any owner has enabled them, so that the sessions
+    of the app can turn them on and off without affecting each other. Allocations
+    are traced while any owner asked for memory tracing.
+
+    Args:
+        memory (bool, optional): If True, also measures the memory allocated by every
+            stage with tracemalloc, which slows down allocations noticeably.
+        owner (hashable, optional): Who enables the counters, e.g. a session id.
+    """
+    with _lock:
+        _owners[owner] = memory
+        _update()
+
+
+def disable(owner=None):
+    """Stops collecting counters for an owner, keeping the ones already collected.
+    They are only stopped once no other owner has enabled them."""
+    with _lock:
+        _owners.pop(owner, None)
+        _update()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Discards the collected counters."""
+    with _lock:
+        _stats.clear()
+
+
+def _record(name, seconds, allocated=None, peak=None):
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["last_seconds"] = seconds
+        if peak is not None:
+            stats["allocated_bytes"] = stats.get("allocated_bytes", 0) + allocated
+            stats["peak_bytes"] = max(stats.get("peak_bytes", 0), peak)
+
+
+@contextmanager
+def _measure(name):
+    memory = _memory and tracemalloc.is_tracing()
+    if memory:
+        # Peaks of nested stages are propagated to the enclosing ones, as
+        # tracemalloc only keeps a single peak
+        stack = _local.__dict__.setdefault("stack", [])
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        stack.append([current, current])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            start_bytes, inner_peak = stack.pop()
+            peak = max(peak, inner_peak)
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            _record(name, seconds, current - start_bytes, peak - start_bytes)
+        else:
+            _record(name, seconds)
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+def stage(name):
+    """Returns a context manager measuring a stage, or a no-op when disabled."""
+    return _measure(name) if _enabled else _NULL_CONTEXT
+
+
+def timed(name=None):
+    """Decorator measuring every call of a function as a stage.
+
+    Args:
+        name (str, optional): Name of the stage. Defaults to the qualified name of
+            the function.
+    """
+
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _measure(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats():
+    """Returns the counters of every stage.
+
+    Returns:
+        dict: For every stage name, its number of calls, total, mean, maximal and
+            last duration in seconds, and with memory tracing its total net
+            allocation and maximal peak allocation in bytes
+    """
+    with _lock:
+        stats = {name: dict(values) for name, values in _stats.items()}
+    for values in stats.values():
+        values["mean_seconds"] = values["seconds"] / values["count"]
+    return stats
+
+
+def to_json():
+    return json.dumps(get_stats(), indent=2, sort_keys=True)
+
+
+def to_prometheus(prefix="bpv_stage"):
+    """Returns the counters in the Prometheus text exposition format."""
+    metrics = {
+        "count": ("calls_total", "counter", "Number of calls of the stage"),
+        "seconds": ("seconds_total", "counter", "Total time spent in the stage"),
+        "max_seconds": ("max_seconds", "gauge", "Longest call of the stage"),
+        "allocated_bytes": ("allocated_bytes_total", "counter", "Net allocations"),
+        "peak_bytes": ("peak_bytes", "gauge", "Largest allocation peak of a call"),
+    }
+    stats = get_stats()
+    lines = []
+    for key, (suffix, kind, doc) in metrics.items():
+        samples = [
+            (name, values[key]) for name, values in stats.items() if key in values
+        ]
+        if not samples:
+            continue
+        lines.append(f"# HELP {prefix}_{suffix} {doc}")
+        lines.append(f"# TYPE {prefix}_{suffix} {kind}")
+        lines.extend(
+            f'{prefix}_{suffix}{{stage="{name}"}} {value}' for name, value in samples
+        )
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """Writes the counters to a file, in the Prometheus text format for a .prom or
+    .txt path and as JSON otherwise."""
+    content = to_prometheus() if path.endswith((".prom", ".txt")) else to_json()
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+if os.environ.get("BPV_INSTRUMENT", "0") not in ("", "0"):
+    enable(memory=os.environ["BPV_INSTRUMENT"] == "memory")
+    if os.environ.get("BPV_INSTRUMENT_DUMP"):
+        atexit.register(dump, os.environ["BPV_INSTRUMENT_DUMP"])
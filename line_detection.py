@@ -0,0 +1,417 @@
+"""Automatic detection of the pitch lines, replacing the manual line drawing.
+
+Usage:
+    python line_detection.py match.mp4 calibration.npz --step 25
+
+White line pixels are extracted inside the grass area of get_edge_img, and line
+segments are found with Canny edges and a probabilistic Hough transform. The
+segments are merged into lines, split into two orientation families, and every
+assignment of two lines of each family to a pair of vertical and horizontal pitch
+lines is scored by projecting the painted pitch lines into the image and counting
+how many of them fall on line pixels.
+
+The command line writes one homography per frame of the video, at its full
+resolution, with the "image_size" of the frames, so the output can be passed as a
+calibration to batch.py, overlay.py and detection.py. Frames between every
+--step, and frames where no lines are detected, hold the last detection.
+"""
+
+import argparse
+from itertools import combinations
+
+import cv2
+import numpy as np
+
+from batch import get_video_info, scale_homography
+from geometry import (
+    Homography,
+    get_output_size,
+    get_perspective_transforms,
+    project_points,
+)
+from helpers import get_edge_img
+from pitch import PITCHES, FootballPitch
+
+
+def get_line_mask(img, sensitivity=25):
+    """Returns the mask of the bright, non-grass pixels inside the grass area."""
+    img = np.array(img)
+    grass = get_edge_img(img, sensitivity=sensitivity)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (15, 15))
+    pitch_area = cv2.morphologyEx(grass, cv2.MORPH_CLOSE, kernel)
+    value = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[:, :, 2]
+    if not grass.any():
+        return np.zeros_like(grass)
+    threshold = np.percentile(value[grass > 0], 75) + 30
+    bright = (value > threshold).astype(np.uint8) * 255
+    return cv2.bitwise_and(bright, cv2.bitwise_and(pitch_area, cv2.bitwise_not(grass)))
+
+
+def get_segments(line_mask, min_length=None):
+    """Finds line segments on the edges of the line mask.
+
+    Returns:
+        ndarray: An array of size (n,4) with the x1, y1, x2, y2 of each segment
+    """
+    height, width = line_mask.shape
+    min_length = min_length if min_length is not None else width // 15
+    edges = cv2.Canny(line_mask, 50, 150)
+    segments = cv2.HoughLinesP(
+        edges, 1, np.pi / 360, threshold=30, minLineLength=min_length, maxLineGap=10
+    )
+    return (
+        np.empty((0, 4)) if segments is None else segments.reshape(-1, 4).astype(float)
+    )
+
+
+def to_homogeneous_lines(segments):
+    """Converts segments of size (n,4) to normalized lines (a, b, c), ax + by + c = 0."""
+    p1 = np.column_stack([segments[:, :2], np.ones(len(segments))])
+    p2 = np.column_stack([segments[:, 2:], np.ones(len(segments))])
+    lines = np.cross(p1, p2)
+    return lines / np.linalg.norm(lines[:, :2], axis=1, keepdims=True)
+
+
+def merge_segments(segments, angle_tolerance=np.deg2rad(3), distance_tolerance=8):
+    """Merges segments lying on the same line, e.g. both borders of a painted line.
+
+    Returns:
+        tuple: Merged lines of size (m,3) and their total segment length of size (m,)
+    """
+    lengths = np.hypot(*(segments[:, 2:] - segments[:, :2]).T)
+    order = np.argsort(-lengths)
+    lines = to_homogeneous_lines(segments)
+    angles = np.arctan2(lines[:, 1], lines[:, 0]) % np.pi
+    clusters = []
+    for i in order:
+        for cluster in clusters:
+            j = cluster[0]
+            angle = abs(angles[i] - angles[j])
+            midpoint = np.append((segments[i, :2] + segments[i, 2:]) / 2, 1)
+            if (
+                min(angle, np.pi - angle) < angle_tolerance
+                and abs(lines[j] @ midpoint) < distance_tolerance
+            ):
+                cluster.append(i)
+                break
+        else:
+            clusters.append([i])
+
+    merged = []
+    for cluster in clusters:
+        points = segments[cluster].reshape(-1, 2).astype(np.float32)
+        vx, vy, x0, y0 = cv2.fitLine(points, cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+        merged.append([vy, -vx, vx * y0 - vy * x0])
+    return np.array(merged, dtype=float), np.array([lengths[c].sum() for c in clusters])
+
+
+def split_families(lines):
+    """Splits lines in two orientation families with k-means on the doubled angle."""
+    angles = 2 * np.arctan2(lines[:, 1], lines[:, 0])
+    features = np.column_stack([np.cos(angles), np.sin(angles)]).astype(np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, labels, _ = cv2.kmeans(features, 2, None, criteria, 3, cv2.KMEANS_PP_CENTERS)
+    return labels.ravel()
+
+
+def get_hypotheses(families, pitch, vertical_pairs, horizontal_pairs):
+    """Lists every assignment of two lines of each family to pitch line pairs.
+
+    Returns:
+        tuple: Image intersections of size (k,4,2), pitch intersections of size
+            (k,4,2) and the names of the four pitch lines of each hypothesis
+    """
+    v_names = np.array([p for pair in vertical_pairs for p in (pair, pair[::-1])])
+    h_names = np.array([p for pair in horizontal_pairs for p in (pair, pair[::-1])])
+    # Line positions are not always whole metres, e.g. 28.7 for a basketball court
+    v_pitch = np.vectorize(pitch.vert_lines.get, otypes=[float])(v_names)
+    h_pitch = np.vectorize(pitch.horiz_lines.get, otypes=[float])(h_names)
+    v_pitch, h_pitch = v_pitch * pitch.SCALE, h_pitch * pitch.SCALE
+    # (qv, qh, 2, 2, 2) pitch intersections of vertical line k and horizontal line l
+    qv, qh = len(v_names), len(h_names)
+    dst = np.stack(
+        [
+            np.broadcast_to(v_pitch[:, None, :, None], (qv, qh, 2, 2)),
+            np.broadcast_to(h_pitch[None, :, None, :], (qv, qh, 2, 2)),
+        ],
+        axis=-1,
+    )
+    names = np.concatenate(
+        [
+            np.broadcast_to(h_names[None, :, :], (qv, qh, 2)),
+            np.broadcast_to(v_names[:, None, :], (qv, qh, 2)),
+        ],
+        axis=-1,
+    )
+
+    pts_src, pts_dst, hypotheses_names = [], [], []
+    for vertical, horizontal in [families, families[::-1]]:
+        v_lines = vertical[np.array(list(combinations(range(len(vertical)), 2)))]
+        h_lines = horizontal[np.array(list(combinations(range(len(horizontal)), 2)))]
+        # (pv, ph, 2, 2, 3) image intersections of vertical line k and horizontal line l
+        points = np.cross(v_lines[:, None, :, None, :], h_lines[None, :, None, :, :])
+        with np.errstate(all="ignore"):
+            src = points[..., :2] / points[..., 2:]
+        pv, ph = src.shape[:2]
+        src = np.broadcast_to(src[:, :, None, None], (pv, ph, qv, qh, 2, 2, 2))
+        pts_src.append(src.reshape(-1, 4, 2))
+        pts_dst.append(np.broadcast_to(dst[None, None], src.shape).reshape(-1, 4, 2))
+        hypotheses_names.append(
+            np.broadcast_to(names[None, None], (pv, ph, qv, qh, 4)).reshape(-1, 4)
+        )
+    return (
+        np.concatenate(pts_src),
+        np.concatenate(pts_dst),
+        np.concatenate(hypotheses_names),
+    )
+
+
+def get_samples(pitch, step=1.0):
+    """Samples points every step metres along the painted lines, in pitch pixels."""
+    samples = []
+    for start, end in pitch.get_line_segments(convert=False):
+        n = max(2, int(np.hypot(*(end - start)) / step) + 1)
+        samples.append(np.linspace(start, end, n))
+    return np.vstack(samples) * pitch.SCALE
+
+
+def get_distance_map(pitch):
+    """Returns the distance in pitch pixels of every pitch pixel to the nearest
+    painted line."""
+    # Rounded up, so that the lines on the far borders of the pitch are drawn
+    size = tuple(
+        int(np.ceil(s * pitch.SCALE)) + 1 for s in (pitch.X_SIZE, pitch.Y_SIZE)
+    )
+    lines = np.full(size[::-1], 255, dtype=np.uint8)
+    for start, end in pitch.get_line_segments().round().astype(int):
+        cv2.line(lines, tuple(map(int, start)), tuple(map(int, end)), 0)
+    return cv2.distanceTransform(lines, cv2.DIST_L2, 5)
+
+
+def score_hypotheses(h, samples, distance_map, support, line_points, tolerance):
+    """Scores homographies by how well the painted pitch lines and the detected line
+    pixels overlap.
+
+    Args:
+        h (ndarray): (k,3,3) homographies from the image to pitch pixels.
+        samples (ndarray): (m,2) points on the painted lines, in pitch pixels.
+        distance_map (ndarray): Distance of each pitch pixel to the nearest painted
+            line, as returned by get_distance_map.
+        support (ndarray): Boolean image, True near detected line pixels.
+        line_points (ndarray): (p,2) detected line pixels.
+        tolerance (float): Distance in pitch pixels under which a line pixel is
+            explained by a painted line.
+
+    Returns:
+        ndarray: The harmonic mean of the fraction of visible painted line samples
+            landing on line pixels and the fraction of line pixels explained by a
+            painted line, between 0 and 1
+    """
+    height, width = support.shape
+    h_inv = np.linalg.inv(h)
+    with np.errstate(all="ignore"):
+        points = project_points(samples, h_inv)
+        # Points behind the camera have a negative homogeneous coordinate
+        w = h_inv[:, 2, :2] @ samples.T + h_inv[:, 2, 2, None]
+        x, y = points[..., 0], points[..., 1]
+        inside = (w > 0) & (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        hits = np.zeros_like(inside)
+        hits[inside] = support[y[inside].astype(int), x[inside].astype(int)]
+        recall = hits.sum(axis=1) / np.maximum(inside.sum(axis=1), 1)
+
+        points = project_points(line_points, h)
+        x, y = points[..., 0], points[..., 1]
+        height, width = distance_map.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        explained = np.zeros_like(inside)
+        explained[inside] = (
+            distance_map[y[inside].astype(int), x[inside].astype(int)] < tolerance
+        )
+        precision = explained.mean(axis=1)
+        return np.nan_to_num(2 * recall * precision / (recall + precision))
+
+
+def detect_pitch_lines(
+    img,
+    pitch=None,
+    sensitivity=25,
+    max_lines=3,
+    vertical_pairs=None,
+    horizontal_pairs=None,
+    n_points=200,
+):
+    """Detects the pitch lines of an image and calibrates it.
+
+    Args:
+        img: A PIL image or an RGB array, e.g. PitchImage.im.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        sensitivity (int, optional): Sensitivity of the grass mask.
+        max_lines (int, optional): Number of longest lines of each orientation
+            family that are considered.
+        vertical_pairs (list, optional): Pairs of vertical pitch lines to match.
+            Defaults to those of pitch.get_line_pairs().
+        horizontal_pairs (list, optional): Pairs of horizontal pitch lines to match.
+            Defaults to those of pitch.get_line_pairs().
+        n_points (int, optional): Number of line pixels sampled to score hypotheses.
+
+    Returns:
+        dict: The "homography" (Homography), the four pitch "lines" it is based on,
+            their image intersections "pts_src" and pitch intersections "pts_dst",
+            and a "confidence" between 0 and 1. None if no lines were found.
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    default_pairs = pitch.get_line_pairs()
+    vertical_pairs = vertical_pairs or default_pairs[0]
+    horizontal_pairs = horizontal_pairs or default_pairs[1]
+    line_mask = get_line_mask(img, sensitivity)
+    segments = get_segments(line_mask)
+    if len(segments) < 4:
+        return None
+    lines, lengths = merge_segments(segments)
+    if len(lines) < 4:
+        return None
+    labels = split_families(lines)
+    families = []
+    for label in range(2):
+        index = np.flatnonzero(labels == label)
+        families.append(lines[index[np.argsort(-lengths[index])][:max_lines]])
+    if min(len(family) for family in families) < 2:
+        return None
+
+    pts_src, pts_dst, names = get_hypotheses(
+        families, pitch, vertical_pairs, horizontal_pairs
+    )
+    with np.errstate(all="ignore"):
+        h = get_perspective_transforms(pts_src, pts_dst)
+        det = np.linalg.det(np.nan_to_num(h))
+        # Keep orientation preserving homographies, the camera is above the pitch
+        centre = np.array([line_mask.shape[1] / 2, line_mask.shape[0] / 2, 1])
+        valid = np.isfinite(h).all(axis=(1, 2)) & (det * (h[:, 2] @ centre) > 0)
+        # The far touchline is at the top of the image, which also breaks the tie
+        # between the hypotheses related by the symmetry of the pitch
+        y = project_points([centre[:2], centre[:2] + [0, 1]], h)[:, :, 1]
+        valid &= y[:, 1] > y[:, 0]
+    if not valid.any():
+        return None
+
+    support = cv2.dilate(line_mask, np.ones((5, 5), np.uint8)) > 0
+    line_points = np.argwhere(line_mask)[:, ::-1]
+    line_points = line_points[
+        np.random.default_rng(0).choice(
+            len(line_points), min(n_points, len(line_points)), replace=False
+        )
+    ]
+    scores = np.zeros(len(h))
+    scores[valid] = score_hypotheses(
+        h[valid],
+        get_samples(pitch),
+        get_distance_map(pitch),
+        support,
+        line_points,
+        tolerance=pitch.SCALE,
+    )
+    best = int(np.argmax(scores))
+    return {
+        "homography": Homography(
+            pts_src[best], pts_dst[best], im_size=get_output_size(pitch)
+        ),
+        "lines": [str(name) for name in names[best]],
+        "pts_src": pts_src[best],
+        "pts_dst": pts_dst[best],
+        "confidence": float(scores[best]),
+    }
+
+
+def calibrate_frames(frames, pitch=None, **kwargs):
+    """Detects the pitch lines of a sequence of frames.
+
+    Args:
+        frames (iterable): RGB frames.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        **kwargs: Passed to detect_pitch_lines.
+
+    Returns:
+        tuple: A (f,3,3) stack of homographies, NaN where no lines were found, and
+            the (f,) confidences
+    """
+    homographies, confidences = [], []
+    for frame in frames:
+        detection = detect_pitch_lines(frame, pitch, **kwargs)
+        if detection is None:
+            homographies.append(np.full((3, 3), np.nan))
+            confidences.append(0.0)
+        else:
+            homographies.append(detection["homography"].h)
+            confidences.append(detection["confidence"])
+    return np.array(homographies), np.array(confidences)
+
+
+def hold_homographies(homographies, frames, n_frames):
+    """Expands the homographies of some frames to one homography per frame.
+
+    Every frame takes the homography of the last frame before it where the lines
+    were detected, and the frames before the first detection take the first one.
+
+    Args:
+        homographies (ndarray): A (k,3,3) stack, NaN where no lines were found.
+        frames (ndarray): The frame index of each homography, in increasing order.
+        n_frames (int): Number of frames of the video.
+
+    Returns:
+        ndarray: A (n_frames,3,3) stack of homographies
+    """
+    valid = np.flatnonzero(np.isfinite(homographies).all(axis=(1, 2)))
+    if len(valid) == 0:
+        raise ValueError("The pitch lines were not detected on any frame")
+    index = np.searchsorted(frames[valid], np.arange(n_frames), side="right") - 1
+    return homographies[valid[np.maximum(index, 0)]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("video", help="input video")
+    parser.add_argument("output", help="output .npz file")
+    parser.add_argument("--step", type=int, default=1, help="process every n-th frame")
+    parser.add_argument("--width", type=int, default=600, help="processing width")
+    parser.add_argument("--pitch", choices=list(PITCHES), default="Football")
+    args = parser.parse_args(argv)
+
+    def get_frames(video):
+        index = 0
+        while True:
+            success, frame = video.read()
+            if not success:
+                return
+            if index % args.step == 0:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                height = int(args.width * frame.shape[0] / frame.shape[1])
+                yield cv2.resize(frame, (args.width, height))
+            index += 1
+
+    video = cv2.VideoCapture(args.video)
+    try:
+        frames = get_frames(video)
+        homographies, confidences = calibrate_frames(frames, PITCHES[args.pitch])
+    finally:
+        video.release()
+    n_frames, _, frame_size = get_video_info(args.video)
+    detected = np.arange(len(homographies)) * args.step
+    n_frames = max(n_frames, detected[-1] + 1 if len(detected) else 0)
+    image_size = (args.width, int(args.width * frame_size[1] / frame_size[0]))
+    # One homography per frame of the full resolution video, as load_calibration
+    # expects, holding the last detection over the frames without one
+    homographies = scale_homography(
+        hold_homographies(homographies, detected, n_frames), image_size, frame_size
+    )
+    np.savez(
+        args.output,
+        homographies=homographies,
+        image_size=frame_size,
+        confidences=confidences,
+        frames=detected,
+    )
+    print(f"Calibrated {np.count_nonzero(confidences)} of {len(detected)} frames")
+
+
+if __name__ == "__main__":
+    main()
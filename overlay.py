@@ -0,0 +1,224 @@
+"""Batched rendering of player positions over the frames of a video.
+
+Usage:
+    python overlay.py birdseye.mp4 positions.csv overlay.mp4
+    python overlay.py match.mp4 positions.csv overlay.mp4 --calibration calibration.json
+
+The positions are a CSV file with the "frame" index and the "x", "y" position in
+percent of the pitch of every player, and optionally their "team". The detections
+written by detection.py with a calibration can be drawn as they are, from their
+"pitch_x", "pitch_y" positions. The annotations exported by the app have no frame
+index and cannot. Without calibration, the video is taken as a bird's-eye view,
+e.g. written by batch.py; with a calibration, the circles are projected back onto
+the original camera frames.
+
+The circles of a chunk of frames are generated as one array of polygons and
+projected with a single call, and each frame is rasterized with one fillPoly call
+per color, so that thousands of frames render without per-player Python work.
+"""
+
+import argparse
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from batch import (
+    get_video_info,
+    load_calibration,
+    read_frames,
+    scale_homography,
+    write_frames,
+)
+from geometry import (
+    get_circle_polygons,
+    get_circle_radius,
+    get_output_size,
+    project_points,
+)
+from helpers import get_rgba
+from pitch import PITCHES, FootballPitch
+
+TEAM_COLORS = ["#ff0000", "#0000ff", "#ffff00", "#00ffff", "#ff00ff", "#ffffff"]
+
+
+def get_position_array(positions, n_frames=None):
+    """Lays out a table of positions as one row of players per frame.
+
+    Args:
+        positions (DataFrame): The "frame", "x" and "y" of every position, and
+            optionally its "team".
+        n_frames (int, optional): Minimal number of frames. Defaults to the last
+            frame + 1.
+
+    Returns:
+        tuple: The positions of size (frames, players, 2), NaN where a frame has
+            fewer players, and the colors of size (frames, players) of the teams
+    """
+    positions = positions.dropna(subset=["x", "y"])
+    frames = positions["frame"].values.astype(int)
+    n_frames = max(n_frames or 0, frames.max() + 1 if len(frames) else 0)
+    slots = positions.groupby("frame").cumcount().values
+    n_players = slots.max() + 1 if len(slots) else 0
+    xy = np.full((n_frames, n_players, 2), np.nan)
+    xy[frames, slots] = positions[["x", "y"]].values
+    colors = np.full((n_frames, n_players), "black", dtype=object)
+    if "team" in positions:
+        teams, codes = np.unique(positions["team"].astype(str), return_inverse=True)
+        palette = np.array(TEAM_COLORS * (len(teams) // len(TEAM_COLORS) + 1))
+        colors[frames, slots] = palette[codes]
+    return xy, colors
+
+
+def read_positions(path):
+    """Reads a CSV file of positions in percent of the pitch, with their frame.
+
+    The "pitch_x", "pitch_y" positions of the detections of detection.py replace
+    their "x", "y", which are positions on the image.
+
+    Raises:
+        ValueError: If the file has no "frame" column, e.g. the annotations exported
+            by the app, or holds detections without their pitch positions.
+    """
+    positions = pd.read_csv(path)
+    if "frame" not in positions:
+        raise ValueError(f'{path} has no "frame" column')
+    if {"pitch_x", "pitch_y"} <= set(positions):
+        positions = positions.drop(columns=["x", "y"]).rename(
+            columns={"pitch_x": "x", "pitch_y": "y"}
+        )
+    elif {"left", "top", "width", "height"} <= set(positions):
+        raise ValueError(
+            f"{path} holds detections on the image, run detection.py with "
+            "--calibration to add their pitch positions"
+        )
+    return positions
+
+
+def get_frame_polygons(positions, h=None, size=1, pitch=None):
+    """Returns the circles around the positions of a batch of frames.
+
+    Args:
+        positions (ndarray): Positions in percent of the pitch of size
+            (frames, players, 2).
+        h (ndarray, optional): A (3,3) homography or a (frames,3,3) stack from the
+            frames to the bird's-eye view. Defaults to frames of the bird's-eye view.
+        size (float, optional): Radius, in the units of PitchDraw.draw_circle.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+
+    Returns:
+        ndarray: The vertices in frame pixels of size (frames, players, vertices, 2)
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    coord_converter = np.array(get_output_size(pitch)) / 100
+    polygons = get_circle_polygons(
+        positions * coord_converter, size * get_circle_radius(coord_converter)
+    )
+    if h is None:
+        return polygons
+    n_frames, n_players, n_vertices, _ = polygons.shape
+    points = polygons.reshape(n_frames, n_players * n_vertices, 2)
+    return project_points(points, np.linalg.inv(h)).reshape(polygons.shape)
+
+
+def fill_polygons(frame, polygons, colors, opacity=255):
+    """Fills the polygons of one frame with one call per color, in place.
+
+    Args:
+        frame (ndarray): A BGR frame.
+        polygons (ndarray): Vertices of size (n, vertices, 2).
+        colors (ndarray): The color name of every polygon.
+        opacity (int, optional): Opacity of the fill.
+    """
+    visible = np.isfinite(polygons).all(axis=(1, 2))
+    if not visible.any():
+        return frame
+    layer = frame.copy() if opacity < 255 else frame
+    # Vertices with 4 fractional bits, for sub-pixel accuracy
+    vertices = np.round(np.nan_to_num(polygons) * 16).astype(np.int32)
+    for color in set(colors[visible]):
+        bgr = get_rgba(color)[2::-1]
+        selected = list(vertices[visible & (colors == color)])
+        cv2.fillPoly(layer, selected, bgr, cv2.LINE_AA, 4)
+    if opacity < 255:
+        cv2.addWeighted(layer, opacity / 255, frame, 1 - opacity / 255, 0, dst=frame)
+    return frame
+
+
+def draw_overlays(
+    frames,
+    positions,
+    colors="black",
+    h=None,
+    size=1,
+    opacity=255,
+    chunk_size=256,
+    pitch=None,
+):
+    """Draws circles around the positions of every frame of a sequence.
+
+    Args:
+        frames (iterable): BGR frames, e.g. read_frames of a video.
+        positions (ndarray): Positions in percent of the pitch of size
+            (frames, players, 2), NaN for missing players.
+        colors (optional): A color, or an array broadcast to (frames, players).
+        h (ndarray, optional): A (3,3) homography or a (frames,3,3) stack from the
+            frames to the bird's-eye view, of the size of the frames. Defaults to
+            frames of the bird's-eye view.
+        size (float, optional): Radius, in the units of PitchDraw.draw_circle.
+        opacity (int, optional): Opacity of the circles.
+        chunk_size (int, optional): Number of frames projected in one batch.
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+
+    Yields:
+        ndarray: The frames with their overlay
+    """
+    positions = np.asarray(positions, dtype=float)
+    colors = np.broadcast_to(np.asarray(colors, dtype=object), positions.shape[:2])
+    frames = iter(frames)
+    for start in range(0, len(positions), chunk_size):
+        stop = min(start + chunk_size, len(positions))
+        chunk_h = h[start:stop] if h is not None and np.ndim(h) == 3 else h
+        polygons = get_frame_polygons(positions[start:stop], chunk_h, size, pitch)
+        for index, frame in zip(range(start, stop), frames):
+            yield fill_polygons(frame, polygons[index - start], colors[index], opacity)
+    # Frames without positions are passed through
+    yield from frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("video", help="input video")
+    parser.add_argument("positions", help="CSV file of the positions")
+    parser.add_argument("output", help="output video")
+    parser.add_argument(
+        "--calibration", help="calibration file, to draw on the camera frames"
+    )
+    parser.add_argument("--size", type=float, default=2)
+    parser.add_argument("--opacity", type=int, default=160)
+    parser.add_argument("--fourcc", default="mp4v")
+    parser.add_argument("--pitch", choices=list(PITCHES), default="Football")
+    args = parser.parse_args(argv)
+
+    n_frames, fps, frame_size = get_video_info(args.video)
+    pitch = PITCHES[args.pitch]
+    h = None
+    if args.calibration:
+        h, image_size = load_calibration(args.calibration, pitch)
+        h = scale_homography(h, image_size, frame_size)
+    positions, colors = get_position_array(read_positions(args.positions), n_frames)
+    frames = draw_overlays(
+        read_frames(args.video),
+        positions,
+        colors,
+        h,
+        args.size,
+        args.opacity,
+        pitch=pitch,
+    )
+    n_written = write_frames(frames, args.output, fps, frame_size, args.fourcc)
+    print(f"Wrote {n_written} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
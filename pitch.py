@@ -1,15 +1,43 @@
 import numpy as np
-from itertools import product
+from itertools import combinations, product
 from dataclasses import dataclass, field
 
 @dataclass
 class Pitch:
-    def get_intersections(self, scale=True):
+    """Base class of the pitches and courts.
+
+    Subclasses set their vert_lines and horiz_lines, the positions in metres of the
+    named pitch lines, in __post_init__ before calling Pitch.__post_init__, and
+    implement get_line_segments. DEFAULT_LINES are the two horizontal and two
+    vertical lines preselected in the app, and IMAGE an optional picture of the
+    line names, which is otherwise drawn from the line segments. VERTICAL_PAIRS
+    and HORIZONTAL_PAIRS are the pairs of lines the automatic line detection
+    matches, by default every pair of vertical and of horizontal lines.
+    """
+    DEFAULT_LINES = []
+    IMAGE = None
+    VERTICAL_PAIRS = None
+    HORIZONTAL_PAIRS = None
+
+    def __post_init__(self):
+        # Intersection tables are computed once per pitch instead of per lookup
         intersection_points = list(product(self.vert_lines.keys(), self.horiz_lines.keys()))
-        scaler = self.scaler(scale)
-        intersections = {'_'.join([vl, hl]): (self.vert_lines[vl]*scaler, self.horiz_lines[hl]*scaler)
-                        for vl, hl in intersection_points}
-        return intersections
+        self.intersections = {}
+        for scale in (True, False):
+            scaler = self.scaler(scale)
+            self.intersections[scale] = {'_'.join([vl, hl]): (self.vert_lines[vl]*scaler, self.horiz_lines[hl]*scaler)
+                                         for vl, hl in intersection_points}
+
+    def get_intersections(self, scale=True):
+        """Returns the pitch positions of the line intersections, keyed by "vertical_horizontal"
+        line names. The returned dict is shared and should not be modified."""
+        return self.intersections[scale]
+
+    def get_line_pairs(self):
+        """Returns the pairs of vertical and of horizontal lines matched by the
+        automatic line detection."""
+        return (self.VERTICAL_PAIRS or list(combinations(self.vert_lines, 2)),
+                self.HORIZONTAL_PAIRS or list(combinations(self.horiz_lines, 2)))
 
     def get_lines(self):
         return list(sorted(set(self.vert_lines).union(set(self.horiz_lines))))
@@ -19,6 +47,13 @@ class Pitch:
 
 @dataclass
 class FootballPitch(Pitch):
+    DEFAULT_LINES = ['UP', 'DP', 'RPA', 'RG']
+    IMAGE = 'pitch.png'
+    # The lines of the penalty areas, which are usually seen together
+    VERTICAL_PAIRS = [('LG', 'LGA'), ('LG', 'LPA'), ('LGA', 'LPA'),
+                      ('RPA', 'RGA'), ('RPA', 'RG'), ('RGA', 'RG')]
+    HORIZONTAL_PAIRS = [('UP', 'DP'), ('UG', 'DG'), ('UP', 'UG'), ('DG', 'DP'),
+                        ('U', 'UP'), ('DP', 'D'), ('UP', 'DG'), ('UG', 'DP')]
     SCALE: int = 5
     X_SIZE: float = 105
     Y_SIZE: float = 68
@@ -49,7 +84,27 @@ class FootballPitch(Pitch):
                              'D': self.Y_SIZE,
                              'C': self.Y_SIZE/2
                              }
+        super().__post_init__()
+
 
+    def get_line_segments(self, convert=True):
+        """Returns the painted line segments of the pitch as an array of size (n, 2, 2)."""
+        v, h = self.vert_lines, self.horiz_lines
+        segments = [[[v['LG'], h['U']], [v['RG'], h['U']]],
+                    [[v['LG'], h['D']], [v['RG'], h['D']]],
+                    [[v['LG'], h['U']], [v['LG'], h['D']]],
+                    [[v['RG'], h['U']], [v['RG'], h['D']]],
+                    [[v['M'], h['U']], [v['M'], h['D']]]
+                   ]
+        for goal, area, box in [('LG', 'LGA', 'LPA'), ('RG', 'RGA', 'RPA')]:
+            segments += [[[v[box], h['UP']], [v[box], h['DP']]],
+                         [[v[goal], h['UP']], [v[box], h['UP']]],
+                         [[v[goal], h['DP']], [v[box], h['DP']]],
+                         [[v[area], h['UG']], [v[area], h['DG']]],
+                         [[v[goal], h['UG']], [v[area], h['UG']]],
+                         [[v[goal], h['DG']], [v[area], h['DG']]]
+                        ]
+        return np.array(segments)*self.scaler(convert)
 
     def get_penalty_area(self, convert=True):
         SPACE = (self.Y_SIZE-self.BOX_HEIGHT)/2
@@ -64,6 +119,59 @@ class FootballPitch(Pitch):
 
 @dataclass
 class BasketballPitch(Pitch):
+    DEFAULT_LINES = ['UL', 'DL', 'RFT', 'RB']
+    # The lines of a lane or of a half court, which are usually seen together
+    VERTICAL_PAIRS = [('LB', 'LFT'), ('LFT', 'M'), ('LB', 'M'), ('M', 'RFT'),
+                      ('RFT', 'RB'), ('M', 'RB'), ('LB', 'RB')]
+    HORIZONTAL_PAIRS = [('UL', 'DL'), ('U', 'UL'), ('DL', 'D'), ('UT', 'UL'),
+                        ('DL', 'DT'), ('U', 'DL'), ('UL', 'D'), ('U', 'D')]
     SCALE: int = 18
     X_SIZE: float = 28.7
-    Y_SIZE: float = 15.2
\ No newline at end of file
+    Y_SIZE: float = 15.2
+    LANE_LENGTH: float = field(default=5.8, init=False)
+    LANE_WIDTH: float = field(default=4.9, init=False)
+    CORNER_THREE_SPACE: float = field(default=0.9, init=False)
+    CORNER_THREE_LENGTH: float = field(default=2.99, init=False)
+
+    def __post_init__(self):
+        self.vert_lines = {'LB': 0,
+                           'LFT': self.LANE_LENGTH,
+                           'M': self.X_SIZE/2,
+                           'RFT': self.X_SIZE-self.LANE_LENGTH,
+                           'RB': self.X_SIZE
+                           }
+
+        self.horiz_lines = {'U': 0,
+                            'UT': self.CORNER_THREE_SPACE,
+                            'UL': (self.Y_SIZE-self.LANE_WIDTH)/2,
+                            'C': self.Y_SIZE/2,
+                            'DL': (self.Y_SIZE+self.LANE_WIDTH)/2,
+                            'DT': self.Y_SIZE-self.CORNER_THREE_SPACE,
+                            'D': self.Y_SIZE
+                            }
+        super().__post_init__()
+
+    def get_line_segments(self, convert=True):
+        """Returns the straight painted line segments of the court as an array of size (n, 2, 2)."""
+        v, h = self.vert_lines, self.horiz_lines
+        segments = [[[v['LB'], h['U']], [v['RB'], h['U']]],
+                    [[v['LB'], h['D']], [v['RB'], h['D']]],
+                    [[v['LB'], h['U']], [v['LB'], h['D']]],
+                    [[v['RB'], h['U']], [v['RB'], h['D']]],
+                    [[v['M'], h['U']], [v['M'], h['D']]]
+                   ]
+        for baseline, free_throw, sign in [('LB', 'LFT', 1), ('RB', 'RFT', -1)]:
+            three = v[baseline]+sign*self.CORNER_THREE_LENGTH
+            segments += [[[v[free_throw], h['UL']], [v[free_throw], h['DL']]],
+                         [[v[baseline], h['UL']], [v[free_throw], h['UL']]],
+                         [[v[baseline], h['DL']], [v[free_throw], h['DL']]],
+                         [[v[baseline], h['UT']], [three, h['UT']]],
+                         [[v[baseline], h['DT']], [three, h['DT']]]
+                        ]
+        return np.array(segments)*self.scaler(convert)
+
+
+# Pitches selectable in the app and the command line tools, by name
+PITCHES = {'Football': FootballPitch(),
+           'Basketball': BasketballPitch()
+           }
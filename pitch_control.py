@@ -0,0 +1,151 @@
+"""Pitch control: the probability that each team controls each cell of the pitch.
+
+Each player's arrival time at a cell is the time to react, moving with their
+current velocity, plus the time to run the remaining distance at maximal speed.
+The control of a team is a softmax over the teams of the arrival time of their
+fastest player, which for two teams reduces to the logistic model of Spearman et
+al. (2017).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pitch import FootballPitch
+
+REACTION_TIME = 0.7
+MAX_SPEED = 5.0
+SIGMA = 0.45
+
+
+def get_grid(pitch=None, n_x=105, n_y=None):
+    """Returns the centres of the cells of a grid over the pitch, in metres.
+
+    Args:
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        n_x (int, optional): Number of cells along the length of the pitch.
+        n_y (int, optional): Number of cells along the width of the pitch. Defaults
+            to square cells.
+
+    Returns:
+        ndarray: An array of size (n_y, n_x, 2)
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    if n_y is None:
+        n_y = max(1, int(round(n_x * pitch.Y_SIZE / pitch.X_SIZE)))
+    xs = (np.arange(n_x) + 0.5) * pitch.X_SIZE / n_x
+    ys = (np.arange(n_y) + 0.5) * pitch.Y_SIZE / n_y
+    return np.dstack(np.meshgrid(xs, ys))
+
+
+def get_positions(df, pitch=None):
+    """Converts the positions of get_converted_positional_data, in percent of the
+    pitch, to metres.
+
+    Returns:
+        ndarray: An array of size (n,2)
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    return df[["x", "y"]].values.astype(float) * [pitch.X_SIZE, pitch.Y_SIZE] / 100
+
+
+def get_velocities(positions, fps):
+    """Estimates velocities in m/s from a sequence of positions of size (f,n,2)."""
+    if len(positions) < 2:
+        return np.zeros_like(positions)
+    return np.gradient(positions, axis=0) * fps
+
+
+def _pitch_control(
+    positions, velocities, team_masks, grid, reaction_time, max_speed, sigma
+):
+    # (f, n, 2) expected positions after the reaction time
+    reach = positions + velocities * reaction_time
+    cells = grid.reshape(-1, 2).astype(np.float32)
+    # (f, n, cells) arrival times
+    distances = np.linalg.norm(
+        reach[:, :, None, :].astype(np.float32) - cells[None, None], axis=-1
+    )
+    arrival = reaction_time + distances / max_speed
+    arrival[np.isnan(arrival)] = np.inf
+    # (f, teams, cells) arrival time of the fastest player of each team
+    fastest = np.stack(
+        [
+            np.min(np.where(mask[None, :, None], arrival, np.inf), axis=1)
+            for mask in team_masks
+        ],
+        axis=1,
+    )
+    logits = -fastest * np.pi / (np.sqrt(3) * sigma)
+    logits -= logits.max(axis=1, keepdims=True)
+    control = np.exp(logits)
+    control /= control.sum(axis=1, keepdims=True)
+    return control.reshape(len(positions), len(team_masks), *grid.shape[:2])
+
+
+def calculate_pitch_control(
+    positions,
+    teams,
+    velocities=None,
+    grid=None,
+    reaction_time=REACTION_TIME,
+    max_speed=MAX_SPEED,
+    sigma=SIGMA,
+    chunk_size=32,
+    workers=1,
+):
+    """Computes the pitch control surface of every team for a sequence of frames.
+
+    Args:
+        positions (ndarray): Player positions in metres, of size (n,2) or (f,n,2).
+            Missing players can be set to NaN.
+        teams (array-like): Team of each of the n players.
+        velocities (ndarray, optional): Player velocities in m/s, same size as
+            positions. Defaults to standing players.
+        grid (ndarray, optional): Cell centres in metres as returned by get_grid.
+            Defaults to a 1m grid over a football pitch.
+        reaction_time (float, optional): Reaction time of the players in seconds.
+        max_speed (float, optional): Maximal running speed in m/s.
+        sigma (float, optional): Uncertainty of the arrival times in seconds.
+        chunk_size (int, optional): Number of frames computed at once, which bounds
+            the memory use.
+        workers (int, optional): Number of processes the chunks are spread over.
+
+    Returns:
+        tuple: The sorted team labels and a float32 array of size
+            (f, teams, n_y, n_x), or (teams, n_y, n_x) for (n,2) positions, with the
+            probability of each team to control each cell
+    """
+    positions = np.asarray(positions, dtype=float)
+    single_frame = positions.ndim == 2
+    if single_frame:
+        positions = positions[None]
+    if velocities is None:
+        velocities = np.zeros_like(positions)
+    velocities = np.nan_to_num(
+        np.asarray(velocities, dtype=float).reshape(positions.shape)
+    )
+    grid = get_grid() if grid is None else np.asarray(grid)
+    labels, team_index = np.unique(np.asarray(teams), return_inverse=True)
+    team_masks = [team_index == i for i in range(len(labels))]
+
+    chunks = [
+        (positions[start : start + chunk_size], velocities[start : start + chunk_size])
+        for start in range(0, len(positions), chunk_size)
+    ]
+    params = (team_masks, grid, reaction_time, max_speed, sigma)
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_pitch_control, *chunk, *params) for chunk in chunks
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [_pitch_control(*chunk, *params) for chunk in chunks]
+    control = np.concatenate(results).astype(np.float32)
+    return labels, control[0] if single_frame else control
+
+
+def save_pitch_control(path, labels, control, grid):
+    """Saves pitch control surfaces with their teams and grid to a .npz file."""
+    np.savez_compressed(path, teams=labels, control=control, grid=grid)
@@ -0,0 +1,234 @@
+"""State of the concurrent sessions of the app, with bounded memory.
+
+Every browser session gets its own Session, keyed by the Streamlit session id, so
+that users do not share annotations. The frames, videos and images a session
+caches are accounted for: when the sessions together hold more than max_bytes,
+the caches of the least recently used sessions are cleared first. Sessions idle
+for longer than idle_timeout are closed, as are the least recently used ones
+beyond max_sessions.
+
+Heavy work, like decoding, warping and Voronoi, goes through Session.run. It runs
+in the thread Streamlit gives every session, but at most `workers` computations of
+all sessions run at once, so the CPUs are shared whatever the number of users.
+Every session also runs at most max_running computations at once, so that one
+session cannot take every worker while the others wait.
+"""
+
+import importlib
+import os
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from threading import BoundedSemaphore, RLock
+
+from cache import LRUCache, get_nbytes
+
+# Location of the script run context across Streamlit versions
+SCRIPT_RUN_CONTEXTS = [
+    ("streamlit.runtime.scriptrunner", "get_script_run_ctx"),
+    ("streamlit.scriptrunner", "get_script_run_ctx"),
+    ("streamlit.report_thread", "get_report_ctx"),
+]
+
+
+def get_session_id():
+    """Returns the id of the Streamlit session running the script, None outside of
+    a Streamlit script run."""
+    for module_name, function_name in SCRIPT_RUN_CONTEXTS:
+        try:
+            get_context = getattr(importlib.import_module(module_name), function_name)
+        except (ImportError, AttributeError):
+            continue
+        try:
+            context = get_context(suppress_warning=True)
+        except TypeError:
+            context = get_context()
+        return context.session_id if context is not None else None
+    return None
+
+
+def get_object_nbytes(value):
+    """Estimates the memory held by a cached object, from its own size or the size
+    of the arrays, images and caches among its attributes."""
+    if isinstance(value, tuple):
+        return sum(get_object_nbytes(item) for item in value)
+    nbytes = get_nbytes(value)
+    if nbytes or not hasattr(value, "__dict__"):
+        return nbytes
+    for attribute in vars(value).values():
+        if isinstance(attribute, dict):
+            nbytes += sum(get_nbytes(item) for item in attribute.values())
+        else:
+            nbytes += get_nbytes(attribute)
+    return nbytes
+
+
+class Session:
+    """State of one browser session. The app subclasses it with its own state."""
+
+    def __init__(self, session_id, max_bytes=None, max_running=1):
+        """
+        Args:
+            session_id (str): Id of the session.
+            max_bytes (int, optional): Bound of the memory of the session cache.
+            max_running (int, optional): Number of computations of run the session
+                executes at once.
+        """
+        self.id = session_id
+        self.cache = LRUCache(max_bytes=max_bytes, sizeof=get_object_nbytes)
+        self.last_used = time.monotonic()
+        self._running = BoundedSemaphore(max_running)
+        # Bounds the computations of all sessions, set by the SessionManager
+        self.workers = None
+
+    @property
+    def nbytes(self):
+        """int: The memory held by the cache, measured again as cached videos
+        keep decoding frames after being cached."""
+        return sum(get_object_nbytes(value) for value in self.cache.values())
+
+    def run(self, func, *args, **kwargs):
+        """Runs a function in the calling thread and returns its result, waiting
+        while the session already runs max_running computations or all the shared
+        workers are busy."""
+        with self._running, self.workers or nullcontext():
+            return func(*args, **kwargs)
+
+    def close(self):
+        """Releases the cached objects of the session. They are not closed, as a
+        rerun of the session may still be using them."""
+        self.cache.clear()
+
+
+class SessionManager:
+    """Creates, bounds and expires the sessions of the app."""
+
+    def __init__(
+        self,
+        factory=Session,
+        max_sessions=32,
+        max_bytes=2 * 2**30,
+        idle_timeout=30 * 60,
+        workers=None,
+    ):
+        """
+        Args:
+            factory (callable, optional): Creates the Session of a session id.
+            max_sessions (int, optional): Maximal number of open sessions.
+            max_bytes (int, optional): Bound of the memory cached by all sessions.
+            idle_timeout (float, optional): Seconds after which an unused session
+                is closed.
+            workers (int, optional): Number of computations of all sessions that
+                run at once. Defaults to the number of CPUs.
+        """
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.workers = BoundedSemaphore(workers or os.cpu_count())
+        self.sessions = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(session.nbytes for session in self.sessions.values())
+
+    def get(self, session_id=None):
+        """Returns the session of an id, creating it on its first use.
+
+        Args:
+            session_id (str, optional): Defaults to the id of the running
+                Streamlit session, or "default" outside of Streamlit.
+
+        Returns:
+            Session: The session, marked as the most recently used
+        """
+        if session_id is None:
+            session_id = get_session_id() or "default"
+        with self._lock:
+            now = time.monotonic()
+            self.expire(now, keep=session_id)
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.sessions[session_id] = self.factory(session_id)
+                session.workers = self.workers
+            self.sessions.move_to_end(session_id)
+            session.last_used = now
+            self.evict(keep=session_id)
+            return session
+
+    def close(self, session_id):
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.close()
+
+    def expire(self, now=None, keep=None):
+        """Closes the sessions unused for longer than idle_timeout."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for session_id, session in list(self.sessions.items()):
+                if session_id != keep and now - session.last_used > self.idle_timeout:
+                    self.close(session_id)
+
+    def evict(self, keep=None):
+        """Closes the least recently used sessions beyond max_sessions, then clears
+        the caches of the least recently used sessions until all of them fit in
+        max_bytes."""
+        with self._lock:
+            others = [session_id for session_id in self.sessions if session_id != keep]
+            for session_id in others[: max(0, len(self.sessions) - self.max_sessions)]:
+                self.close(session_id)
+            sizes = {
+                session_id: session.nbytes
+                for session_id, session in self.sessions.items()
+            }
+            total = sum(sizes.values())
+            for session_id in self.sessions:
+                if total <= self.max_bytes:
+                    break
+                if session_id != keep and sizes[session_id]:
+                    self.sessions[session_id].cache.clear()
+                    total -= sizes[session_id]
+
+    def get_stats(self):
+        """Returns the id, cached entries, memory and idle seconds of every session,
+        from the least to the most recently used."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "session": session_id,
+                    "entries": len(session.cache),
+                    "bytes": session.nbytes,
+                    "idle_seconds": now - session.last_used,
+                }
+                for session_id, session in self.sessions.items()
+            ]
+
+
+_manager = None
+_manager_lock = RLock()
+
+
+def get_manager(factory=None, **kwargs):
+    """Returns the session manager of the process, created on the first call, as
+    the app script is executed again on every rerun.
+
+    Args:
+        factory (callable, optional): Creates the Session of a session id. Updated
+            when given, so that it follows the reruns of the script. Defaults to
+            Session.
+        **kwargs: Passed to SessionManager on the first call.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionManager(factory or Session, **kwargs)
+        elif factory is not None:
+            _manager.factory = factory
+        return _manager
@@ -1,5 +1,61 @@
-from helpers import Homography
+import io
+import json
+import os
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import cv2
 import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Polygon
+
+import analytics
+import batch
+import benchmark
+import calibration
+import detection
+from annotations import AnnotationStore, get_store
+from camera_tracking import track_homographies
+from detection import (
+    COLUMNS,
+    PlayerDetector,
+    detect_frames,
+    detect_players,
+    to_canvas_objects,
+)
+import export
+import fusion
+import helpers
+import instrumentation
+import overlay
+import pitch_control
+import sessions
+from tracking import track_positions
+from helpers import (
+    CALIBRATIONS,
+    CanvasParser,
+    Homography,
+    PitchDraw,
+    PitchImage,
+    VoronoiPitch,
+    get_converted_positional_data,
+    get_edge_img,
+    get_histogram_median,
+    get_pitch_diagram,
+    get_hue_histogram,
+    get_warp_maps,
+    project_points,
+    warp_image,
+    warp_tiled,
+)
+import line_detection
+from line_detection import detect_pitch_lines
+from pitch import PITCHES, BasketballPitch, FootballPitch
+from video import VideoReader
+
 
 def test_homography():
     pts_src = [[160.0444,  34.4228],
@@ -20,4 +76,881 @@ def test_homography():
 
     assert np.allclose(h.h, valid_h)
     assert np.allclose(h.apply_to_points([[0,0], [10,50]]),
-                       np.array([[395.2443349,  -24.94283416], [378.92692043,  72.76273286]]))
\ No newline at end of file
+                       np.array([[395.2443349,  -24.94283416], [378.92692043,  72.76273286]]))
+
+
+PTS_SRC = [
+    [160.0444, 34.4228],
+    [408.3040, 199.1448],
+    [342.0459, 18.1934],
+    [670.2333, 163.3532],
+]
+PTS_DST = [[442.5, 69.2], [442.5, 270.8], [525, 69.2], [525, 270.8]]
+
+
+def test_project_points_batch():
+    h = Homography(PTS_SRC, PTS_DST)
+    points = np.random.default_rng(0).uniform(0, 600, size=(3, 22, 2))
+
+    single = project_points(points, h.h)
+    stacked = project_points(points, np.stack([h.h, h.h_inv, np.eye(3)]))
+
+    assert single.shape == (3, 22, 2)
+    assert np.allclose(single[1], h.apply_to_points(points[1]))
+    assert np.allclose(stacked[1], h.apply_to_points(points[1], inverse=True))
+    assert np.allclose(stacked[2], points[2])
+    assert np.allclose(h.apply_to_points(single, inverse=True), points)
+
+
+def write_test_video(path, n_frames=20, fps=10, size=(64, 48)):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+    for i in range(n_frames):
+        writer.write(np.full((size[1], size[0], 3), i * 10, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def test_video_reader(tmp_path):
+    path = write_test_video(tmp_path / "clip.avi")
+    with VideoReader(path=str(path), cache_size=5, prefetch=2) as video:
+        assert len(video) == 20
+        assert np.isclose(video.duration, 2.0)
+        assert abs(int(video.get_frame(7).mean()) - 70) <= 2
+        assert abs(int(video.get_frame_at(1.25).mean()) - 120) <= 2
+        assert abs(int(video.get_frame(3).mean()) - 30) <= 2
+        assert len(video.frames) <= 5
+
+
+def test_batch_process_video(tmp_path):
+    video_path = write_test_video(tmp_path / "clip.avi", n_frames=12)
+    calibration_path = tmp_path / "calibration.json"
+    h = Homography(PTS_SRC, PTS_DST)
+    calibration_path.write_text(
+        json.dumps({"image_size": [32, 24], "homography": h.h.tolist()})
+    )
+
+    outputs = []
+    for workers in (1, 2):
+        out_path = tmp_path / f"out{workers}.avi"
+        n_frames = batch.process_video(
+            str(video_path),
+            str(calibration_path),
+            str(out_path),
+            workers=workers,
+            chunks=3,
+            fourcc="MJPG",
+        )
+        frames = list(batch.read_frames(str(out_path)))
+        assert n_frames == len(frames) == 12
+        assert frames[0].shape[0] == 340
+        outputs.append(frames)
+    # The parts of the parallel run are not encoded lossily twice
+    assert all(np.array_equal(a, b) for a, b in zip(*outputs))
+
+
+def test_warp_image_matches_warp_perspective():
+    h = Homography(PTS_SRC, PTS_DST)
+    image = np.random.default_rng(0).integers(0, 255, (400, 700, 3), np.uint8)
+    image = cv2.GaussianBlur(image, (15, 15), 5)
+
+    warped = warp_image(image, h.h, h.im_size)
+    expected = cv2.warpPerspective(image, h.h, h.im_size)
+
+    assert warped.shape == expected.shape
+    assert np.abs(warped.astype(int) - expected).max() <= 3
+    assert get_warp_maps(h.h, h.im_size) is get_warp_maps(h.h.copy(), h.im_size)
+
+
+def get_test_snapshot():
+    snapshot = PitchImage(FootballPitch(), image=np.zeros((360, 720, 3), np.uint8))
+    snapshot.h = Homography(PTS_SRC, PTS_DST)
+    return snapshot
+
+
+def get_test_positions(n=22, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "x": rng.uniform(0, 100, n),
+            "y": rng.uniform(0, 100, n),
+            "team": rng.choice(["#ff0000", "#0000ff"], n),
+        }
+    )
+
+
+def test_voronoi_polygons_cover_visible_pitch():
+    snapshot = get_test_snapshot()
+    voronoi = VoronoiPitch(get_test_positions())
+
+    polygons = voronoi.get_voronoi_polygons(snapshot, original=False)
+    area = sum(Polygon(p["polygon"]).area for p in polygons if p["polygon"] is not None)
+
+    assert np.isclose(area, snapshot.get_clip_polygon().area)
+    assert set(p["color"] for p in polygons) == {"#ff0000", "#0000ff"}
+    assert len(voronoi.get_voronoi_polygons(snapshot, original=True)) == len(polygons)
+
+
+def test_voronoi_raster():
+    voronoi = VoronoiPitch(get_test_positions())
+    size = (525, 340)
+
+    exact = voronoi.get_raster(size)
+    approximate = voronoi.get_raster(size, method="distance")
+    pixels = (voronoi.df[["x", "y"]].values * np.array(size) / 100).astype(int)
+
+    assert exact.shape == (340, 525)
+    assert np.array_equal(exact[pixels[:, 1], pixels[:, 0]], np.arange(22))
+    assert np.mean(exact == approximate) > 0.95
+
+
+def test_pitch_control():
+    grid = pitch_control.get_grid(n_x=21)
+    positions = np.array([[[30.0, 34.0], [75.0, 34.0]], [[30.0, 34.0], [np.nan, 0]]])
+
+    teams, control = pitch_control.calculate_pitch_control(
+        positions, ["home", "away"], grid=grid, chunk_size=1, workers=2
+    )
+    _, single = pitch_control.calculate_pitch_control(
+        positions[0], ["home", "away"], grid=grid
+    )
+
+    assert list(teams) == ["away", "home"]
+    assert control.shape == (2, 2, 14, 21) and control.dtype == np.float32
+    assert np.allclose(control.sum(axis=1), 1)
+    assert np.allclose(control[0], single)
+    assert control[0, 1, 7, 6] > 0.99 and control[0, 0, 7, 15] > 0.99
+    assert np.allclose(control[1, 1], 1)
+
+    draw = PitchDraw(get_test_snapshot(), original=True)
+    draw.draw_surface(control[0, 0], "red", 100)
+    assert np.array(draw.draw_im)[:, :, 3].max() > 0
+
+
+def test_pitch_mask():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, (60, 80, 3), np.uint8)
+    hues = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)[:, :, 0]
+
+    assert get_histogram_median(get_hue_histogram(hues)) == np.median(hues[hues > 1])
+
+    snapshot = get_test_snapshot()
+    assert snapshot.get_pitch_mask(10) is snapshot.get_pitch_mask(10)
+
+
+def draw_test_pitch(h, size=(720, 360), seed=0, pitch=None):
+    """Renders the painted lines of a pitch, by default a football pitch, seen
+    through a homography."""
+    rng = np.random.default_rng(seed)
+    img = np.clip(rng.normal((40, 140, 40), 6, (size[1], size[0], 3)), 0, 255)
+    img = img.astype(np.uint8)
+    pitch = pitch if pitch is not None else FootballPitch()
+    for segment in pitch.get_line_segments():
+        points = h.apply_to_points(np.linspace(*segment, 200), inverse=True)
+        cv2.polylines(img, [points.astype(np.int32)], False, (255, 255, 255), 2)
+    return img
+
+
+def test_detect_pitch_lines():
+    h = Homography(PTS_SRC, PTS_DST)
+    detection = detect_pitch_lines(draw_test_pitch(h))
+    points = np.array([[300, 100], [500, 150], [400, 120]])
+
+    assert set(detection["lines"]) == {"UP", "DP", "RPA", "RG"}
+    assert detection["confidence"] > 0.5
+    assert np.allclose(
+        detection["homography"].apply_to_points(points),
+        h.apply_to_points(points),
+        atol=5,
+    )
+
+    # The detection of an image is cached with its warped image
+    image = cv2.cvtColor(draw_test_pitch(h), cv2.COLOR_RGB2BGR)
+    snapshot = PitchImage(FootballPitch(), image=image, width=None, key="detect")
+    session = sessions.Session("a")
+    detection = snapshot.set_detected_lines(cache=session.cache)
+    conv_im = snapshot.conv_im
+    assert snapshot.h is detection["homography"]
+    snapshot.set_homography(h, ["UP", "DP", "RPA", "RG"])
+    assert snapshot.set_detected_lines(cache=session.cache) is detection
+    assert snapshot.h is detection["homography"] and snapshot.conv_im is conv_im
+
+
+@pytest.mark.parametrize(
+    "pts_src, lines",
+    [
+        (
+            [[250, 80], [180, 290], [560, 80], [680, 290]],
+            ["RFT_UL", "RFT_DL", "RB_UL", "RB_DL"],
+        ),
+        (
+            [[200, 40], [120, 330], [600, 40], [700, 330]],
+            ["M_U", "M_D", "RB_U", "RB_D"],
+        ),
+        (
+            [[60, 40], [60, 320], [660, 40], [660, 320]],
+            ["LB_U", "LB_D", "RB_U", "RB_D"],
+        ),
+    ],
+)
+def test_detect_basketball_lines(pts_src, lines):
+    court = PITCHES["Basketball"]
+    h = Homography(pts_src, [court.get_intersections()[name] for name in lines])
+    detection = detect_pitch_lines(draw_test_pitch(h, pitch=court), court)
+    points = np.array([[300, 150], [500, 200], [400, 100]])
+
+    assert detection["confidence"] > 0.5
+    assert np.allclose(
+        detection["homography"].apply_to_points(points),
+        h.apply_to_points(points),
+        atol=5,
+    )
+
+
+def test_line_detection_main(tmp_path):
+    h = Homography(PTS_SRC, PTS_DST)
+    pitch_frame = cv2.cvtColor(draw_test_pitch(h), cv2.COLOR_RGB2BGR)
+    grass_frame = np.full_like(pitch_frame, (40, 140, 40))
+    video_path = str(tmp_path / "pitch.avi")
+    batch.write_frames(
+        [grass_frame, pitch_frame, grass_frame, pitch_frame],
+        video_path,
+        10,
+        (720, 360),
+        "FFV1",
+    )
+    out_path = str(tmp_path / "calibration.npz")
+    line_detection.main([video_path, out_path, "--width", "360"])
+
+    # The frames without lines hold the nearest earlier detection
+    assert np.load(out_path)["confidences"][[0, 2]].tolist() == [0, 0]
+    homographies, image_size = batch.load_calibration(out_path, FootballPitch())
+    assert image_size == (720, 360) and homographies.shape == (4, 3, 3)
+    points = np.array([[300, 100], [500, 150]])
+    for frame_h in homographies:
+        assert np.allclose(
+            project_points(points, frame_h), h.apply_to_points(points), atol=10
+        )
+
+
+def test_track_homographies():
+    h = Homography(PTS_SRC, PTS_DST)
+    pitch_img = cv2.GaussianBlur(draw_test_pitch(h, size=(900, 360)), (3, 3), 1)
+    shifts = np.arange(0, 60, 4)
+    frames = [pitch_img[:, shift : shift + 600] for shift in shifts]
+    expected = [
+        h.h @ np.array([[1, 0, shift], [0, 1, 0], [0, 0, 1]]) for shift in shifts
+    ]
+
+    homographies = track_homographies(frames, h.h)
+
+    points = np.array([[100, 100], [300, 200], [500, 150]])
+    assert homographies.shape == (len(frames), 3, 3)
+    assert np.allclose(
+        project_points(points, homographies), project_points(points, expected), atol=2
+    )
+
+
+def test_annotation_store(tmp_path):
+    path = str(tmp_path / "annotations.parquet")
+    store = AnnotationStore(["team", "x", "y"], {"x": float}, path, capacity=2)
+    rows = pd.DataFrame(
+        {
+            "situation_id": ["1", "1", "2"],
+            "object_id": [0, 1, 0],
+            "team": ["a", "b", "a"],
+            "x": [1.0, 2.0, 3.0],
+            "y": [4.0, 5.0, 6.0],
+        }
+    )
+
+    assert store.upsert(rows) == 3
+    version = store.version
+    assert store.upsert(rows) == 0 and store.version == version
+    assert store.upsert(rows.iloc[[1]].assign(x=7.0)) == 1
+
+    df = store.to_frame()
+    assert len(df) == 3 and df["x"].tolist() == [1.0, 7.0, 3.0]
+    store.flush()
+    reloaded = AnnotationStore(["team", "x", "y"], {"x": float}, path)
+    assert reloaded.to_frame().equals(df)
+
+    # Pending changes of an idle store are flushed after flush_interval
+    idle_path = str(tmp_path / "idle.parquet")
+    idle = AnnotationStore(["team", "x", "y"], path=idle_path, flush_interval=0.1)
+    idle.upsert(rows)
+    assert not os.path.exists(idle_path)
+    time.sleep(0.5)
+    assert len(pd.read_parquet(idle_path)) == 3
+
+    # The sessions of a project share its store, reloaded from its file
+    shared = get_store(path, ["team", "x", "y"], {"x": float})
+    assert get_store(str(tmp_path / "." / "annotations.parquet"), []) is shared
+    assert shared.to_frame().equals(df)
+
+
+def test_export(tmp_path):
+    df = pd.DataFrame(
+        {"team": ["a", "b", "a"], "x": [1.0, 2.0, 3.0], "y": [4.0, 5.0, 6.0]}
+    )
+    for fmt in export.EXPORTERS:
+        export.export(df, str(tmp_path / f"data.{fmt}"), chunk_size=2)
+
+    assert pd.read_csv(tmp_path / "data.csv").equals(df)
+    assert pd.read_parquet(tmp_path / "data.parquet").equals(df)
+    arrays = np.load(tmp_path / "data.npz")
+    assert arrays["xy"].dtype == np.float32
+    assert arrays["team_categories"][arrays["team_codes"]].tolist() == ["a", "b", "a"]
+    assert np.array_equal(arrays["xy"], df[["x", "y"]].values)
+    # Chunks are written as they come, with codes shared across chunks
+    buffer = io.BytesIO()
+    export.export_npz((df.iloc[[i]] for i in range(3)), buffer)
+    buffer.seek(0)
+    assert np.load(buffer)["team_codes"].tolist() == [0, 1, 0]
+    xy = np.fromfile(tmp_path / "data.f32", "<f4").reshape(-1, 2)
+    assert np.array_equal(xy, df[["x", "y"]].values)
+
+    store = AnnotationStore(["team", "x", "y"], {"x": float, "y": float})
+    store.upsert(df.assign(situation_id="1", object_id=df.index))
+    content = export.get_export_bytes(store, "parquet", ["x", "y"])
+    assert export.get_export_bytes(store, "parquet", ["x", "y"]) is content
+
+    # A new store, possibly at the address of a collected one, is not served the
+    # export of another store at the same version
+    del store
+    other = AnnotationStore(["team", "x", "y"], {"x": float, "y": float})
+    other.upsert(df.assign(situation_id="2", object_id=df.index, x=0.0))
+    assert export.get_export_bytes(other, "parquet", ["x", "y"]) != content
+
+
+def test_benchmark():
+    results = benchmark.run("apply_to_points", quick=True)
+    assert set(results) == {"apply_to_points[1]", "apply_to_points[1000]"}
+
+    baseline = {case: seconds / 2 for case, seconds in results.items()}
+    assert set(benchmark.compare(results, baseline)) == set(results)
+    assert benchmark.compare(results, results) == {}
+
+
+def test_instrumentation():
+    instrumentation.reset()
+    get_edge_img(np.zeros((10, 10, 3), np.uint8))
+    assert instrumentation.get_stats() == {}
+
+    instrumentation.enable(memory=True)
+    try:
+        with instrumentation.stage("outer"):
+            with instrumentation.stage("inner"):
+                buffer = np.ones(2**20, np.uint8)
+            del buffer
+        get_edge_img(np.zeros((10, 10, 3), np.uint8))
+    finally:
+        instrumentation.disable()
+
+    stats = instrumentation.get_stats()
+    assert stats["get_edge_img"]["count"] == 1
+    assert stats["outer"]["seconds"] >= stats["inner"]["seconds"]
+    assert stats["outer"]["peak_bytes"] >= stats["inner"]["peak_bytes"] >= 2**20
+    assert 'bpv_stage_calls_total{stage="inner"} 1' in instrumentation.to_prometheus()
+    instrumentation.reset()
+
+    # A session turning its counters off does not stop another session's
+    instrumentation.enable(owner="a")
+    instrumentation.enable(memory=True, owner="b")
+    instrumentation.disable(owner="a")
+    assert instrumentation.is_enabled() and tracemalloc.is_tracing()
+    instrumentation.disable(owner="b")
+    assert not instrumentation.is_enabled() and not tracemalloc.is_tracing()
+
+
+def test_calibration_cache():
+    CALIBRATIONS.clear()
+    snapshot = PitchImage(
+        FootballPitch(), image=np.zeros((360, 720, 3), np.uint8), key="upload"
+    )
+    lines = pd.DataFrame(
+        {
+            "left": 0.0,
+            "top": 0.0,
+            "x1": [0.0, 0.0, 100.0, 400.0],
+            "y1": [50.0, 200.0, 0.0, 0.0],
+            "x2": [600.0, 600.0, 110.0, 420.0],
+            "y2": [60.0, 220.0, 300.0, 300.0],
+        }
+    )
+    names = ["UP", "DP", "RPA", "RG"]
+
+    snapshot.set_info(lines, names)
+    h, conv_im = snapshot.h, snapshot.conv_im
+    snapshot.set_info(lines.copy(), names)
+    assert snapshot.h is h and snapshot.conv_im is conv_im
+
+    snapshot.set_info(lines.assign(top=1.0), names)
+    assert snapshot.h is not h
+    snapshot.set_info(lines, names)
+    assert snapshot.h is h and len(CALIBRATIONS) == 2
+
+    # The calibrations of a session count in its memory
+    session = sessions.Session("a")
+    snapshot.set_info(lines, names, cache=session.cache)
+    assert len(CALIBRATIONS) == 2 and len(session.cache) == 1
+    assert session.nbytes >= 525 * 340 * 3
+
+
+def test_converted_positional_data():
+    snapshot = get_test_snapshot()
+    rect = {"type": "rect", "left": 100.0, "top": 50.0, "width": 10.0, "height": 20.0}
+    rect.update(scaleX=2.0, scaleY=1.0, stroke="#ff0000")
+    line = {"type": "line", "left": 300.0, "top": 100.0, "stroke": "#0000ff"}
+    line.update(x1=-20.0, y1=-10.0, x2=20.0, y2=10.0)
+    tags = {"Sender": "#ff0000", "Body orientation": "#0000ff"}
+    parser = CanvasParser()
+
+    canvas = SimpleNamespace(json_data={"objects": [rect]})
+    df = get_converted_positional_data(tags, snapshot, True, canvas, parser)
+    foot = snapshot.h.apply_to_points([[110, 70]]) / snapshot.h.coord_converter
+    assert np.allclose(df[["x", "y"]].values, foot)
+    assert df["team"].tolist() == ["Sender"] and df["x_start"].isna().all()
+
+    canvas.json_data["objects"] = [rect, line]
+    df = get_converted_positional_data(tags, snapshot, True, canvas, parser)
+    ends = snapshot.h.apply_to_points([[280, 90], [320, 110]])
+    ends /= snapshot.h.coord_converter
+    assert np.allclose(df.loc[1, ["x_start", "y_start", "x_end", "y_end"]], ends.ravel())
+    assert np.allclose(df.loc[1, ["x", "y"]], ends.mean(axis=0))
+    assert df["team"].tolist() == ["Sender", "Body orientation"]
+    assert parser.objects[0] is rect and len(parser.rows) == 2
+
+
+def test_fusion():
+    views = [
+        Homography(PTS_SRC, PTS_DST),
+        Homography(np.array(PTS_SRC) * 0.5 + [100, 50], PTS_DST),
+    ]
+    players = np.random.default_rng(0).uniform([380, 60], [525, 280], (11, 2))
+    detections = []
+    for view, seen in zip(views, [slice(0, 8), slice(4, 11)]):
+        image_points = view.apply_to_points(players[seen], inverse=True)
+        detections.append(
+            pd.DataFrame(
+                {
+                    "frame": 3,
+                    "x": image_points[:, 0],
+                    "y": image_points[:, 1],
+                    "team": np.arange(11)[seen] % 2,
+                }
+            )
+        )
+
+    fused = fusion.fuse_detections(views, detections, radius=1.0, workers=2)
+
+    assert len(fused) == 11 and (fused["frame"] == 3).all()
+    assert fused["n_views"].sum() == 15
+    expected = players / views[0].coord_converter
+    fused = fused.sort_values("x")
+    assert np.allclose(fused[["x", "y"]], expected[np.argsort(expected[:, 0])])
+
+
+def test_detect_frames():
+    # The players walk on the pitch after the background is learnt
+    frames = [np.full((240, 320, 3), (40, 140, 50), np.uint8) for _ in range(30)]
+    for frame in frames[20:]:
+        for x in [40, 140, 240]:
+            cv2.rectangle(frame, (x, 100), (x + 10, 140), (20, 20, 200), -1)
+
+    detections = detect_frames(frames, method="background")
+
+    assert detections["frame"].min() == 20
+    first = detections[detections["frame"] == 20]
+    assert len(first) == 3
+    assert np.allclose(first["x"].sort_values(), [45.5, 145.5, 245.5], atol=1)
+    assert np.allclose(first["y"], 141, atol=3)
+    canvas = SimpleNamespace(json_data={"objects": to_canvas_objects(first, "#ff0000")})
+    parsed, _, _, _ = CanvasParser().parse(canvas.json_data["objects"])
+    assert np.allclose(parsed, first[["x", "y"]])
+
+
+def test_detect_players():
+    rng = np.random.default_rng(0)
+    image = np.clip(rng.normal((40, 140, 40), 6, (360, 720, 3)), 0, 255)
+    image = image.astype(np.uint8)
+    image[:20] = (120, 120, 120)
+    cv2.line(image, (100, 50), (600, 60), (255, 255, 255), 2)
+    cv2.line(image, (300, 0), (310, 360), (255, 255, 255), 3)
+    for x in [150, 400, 550]:
+        cv2.rectangle(image, (x, 150), (x + 14, 190), (30, 30, 200), -1)
+
+    # The default method works with any OpenCV version
+    detections = detect_players(image, key="players")
+    assert np.allclose(detections["x"], [157.5, 407.5, 557.5])
+    assert np.allclose(detections["y"], 191)
+    assert detect_players(image, key="players") is detections
+
+    if hasattr(cv2, "HOGDescriptor"):
+        hog = PlayerDetector("hog").detect(image)
+        assert hog.columns.tolist() == COLUMNS
+    else:
+        assert PlayerDetector().method == "grass"
+        with pytest.raises(RuntimeError):
+            PlayerDetector("hog")
+
+
+def test_track_positions():
+    # Two players of different teams crossing each other, both missed on frame 20
+    frames = np.arange(50)
+    players = [
+        np.c_[10 + 0.3 * frames, np.full(50, 30)],
+        np.c_[25 - 0.3 * frames, np.full(50, 31)],
+    ]
+    detections = pd.concat(
+        pd.DataFrame(
+            {
+                "frame": frames,
+                "x": p[:, 0] * 100 / 105,
+                "y": p[:, 1] * 100 / 68,
+                "team": team,
+            }
+        )
+        for p, team in zip(players, ["a", "b"])
+    ).drop(index=20)
+
+    trajectories, tracks = track_positions(detections, fps=25)
+
+    assert trajectories.shape == (50, 2, 2) and trajectories.dtype == np.float32
+    assert tracks["team"].tolist() == ["a", "b"]
+    assert tracks["detections"].tolist() == [49, 49]
+    assert np.isnan(trajectories[20]).all()
+    assert np.allclose(trajectories[49], [players[0][49], players[1][49]], atol=0.1)
+
+
+def test_warp_tiled():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (1080, 1920, 3), np.uint8)
+    snapshot = PitchImage(FootballPitch(), image=image, width=480)
+    snapshot.h = Homography(PTS_SRC, PTS_DST)
+
+    warped = snapshot.get_warped_image(scale=2, tile_size=256, workers=2)
+
+    h = np.diag([2, 2, 1.0]) @ snapshot.h.h @ np.diag([0.25, 0.25, 1])
+    expected = cv2.warpPerspective(np.asarray(snapshot.full_im), h, (1050, 680))
+    assert warped.shape == (680, 1050, 3)
+    assert np.abs(warped.astype(int) - expected).max() <= 1
+    tiled = warp_tiled(image, h, (1050, 680), tile_size=300)
+    expected = cv2.warpPerspective(image, h, (1050, 680))
+    assert np.abs(tiled.astype(int) - expected).max() <= 1
+
+
+def test_draw_circles():
+    snapshot = get_test_snapshot()
+    snapshot.set_homography(snapshot.h, ["UP", "DP", "RPA", "RG"])
+    df = get_test_positions()
+    drawing = PitchDraw(snapshot, original=False)
+    drawing.draw_circles(df[["x", "y"]].values, df["team"].values, size=2)
+    covered = np.asarray(drawing.draw_im)[..., 3] > 0
+    # Circles of radius 2 * 5.25 * 3.4 / 8.65 pixels around the positions
+    yy, xx = np.mgrid[: covered.shape[0], : covered.shape[1]]
+    centres = df[["x", "y"]].values * drawing.h.coord_converter
+    distances = np.hypot(
+        xx[..., None] - centres[:, 0], yy[..., None] - centres[:, 1]
+    ).min(axis=-1)
+    assert covered[distances < 3.5].all()
+    assert not covered[distances > 6].any()
+
+    original = PitchDraw(snapshot, original=True)
+    original.draw_circles(df[["x", "y"]].values, df["team"].values, size=2)
+    assert (np.asarray(original.draw_im)[..., 3] > 0).sum() > 0
+
+    positions = np.full((3, 2, 2), np.nan)
+    positions[1] = [[50, 50], [10, 90]]
+    frames = [np.zeros((340, 525, 3), np.uint8) for _ in range(4)]
+    rendered = list(overlay.draw_overlays(frames, positions, "#ff0000", size=2))
+    assert len(rendered) == 4
+    assert rendered[0].max() == 0 and rendered[2].max() == 0
+    assert (rendered[1][170, 262] == [0, 0, 255]).all()
+    assert (rendered[1][306, 52] == [0, 0, 255]).all()
+
+    h = Homography(PTS_SRC, PTS_DST)
+    frames = [np.zeros((300, 600, 3), np.uint8) for _ in range(3)]
+    positions[1] = [[90, 50], [np.nan, np.nan]]
+    rendered = list(overlay.draw_overlays(frames, positions, "white", h.h, size=2))
+    u, v = h.apply_to_points(np.array([[472.5, 170.0]]), inverse=True)[0]
+    assert rendered[1][int(round(v)), int(round(u))].min() == 255
+
+
+
+def test_overlay_detections(tmp_path):
+    h = Homography(PTS_SRC, PTS_DST)
+    frame = cv2.cvtColor(draw_test_pitch(h), cv2.COLOR_RGB2BGR)
+    cv2.rectangle(frame, (200, 250), (214, 290), (200, 30, 30), -1)
+    video_path = str(tmp_path / "match.avi")
+    batch.write_frames([frame, frame], video_path, 10, (720, 360), "FFV1")
+    calibration_path = str(tmp_path / "calibration.json")
+    with open(calibration_path, "w") as fp:
+        json.dump({"homography": h.h.tolist(), "image_size": [720, 360]}, fp)
+    detections_path = str(tmp_path / "detections.csv")
+    detection.main(
+        [video_path, detections_path, "--method", "grass"]
+        + ["--calibration", calibration_path]
+    )
+
+    # The detections are drawn back at the feet of the player
+    out_path = str(tmp_path / "overlay.avi")
+    overlay.main(
+        [video_path, detections_path, out_path, "--calibration", calibration_path]
+        + ["--fourcc", "FFV1", "--opacity", "255"]
+    )
+    rendered = list(batch.read_frames(out_path))
+    assert len(rendered) == 2
+    assert rendered[0][291, 207].max() == 0 and frame[291, 207].max() > 0
+
+    # The annotations exported by the app have no frame index
+    export_path = tmp_path / "annotations.csv"
+    pd.DataFrame({"team": ["a"], "x": [50.0], "y": [50.0]}).to_csv(export_path)
+    with pytest.raises(ValueError):
+        overlay.read_positions(str(export_path))
+
+def test_calibration():
+    # A vertical and a horizontal segment cross without slope arithmetic
+    lines = calibration.get_homogeneous_lines([[10, 0, 10, 50], [0, 20, 40, 20]])
+    assert np.allclose(calibration.intersect_lines(lines[0], lines[1]), [10, 20])
+
+    pitch = FootballPitch()
+    h = Homography(PTS_SRC, PTS_DST)
+    names = ["M", "RPA", "RG", "UP", "DP", "C"]
+    segments = []
+    for name in names:
+        if name in pitch.vert_lines:
+            x = pitch.vert_lines[name] * pitch.SCALE
+            ends = [[x, 100], [x, 250]]
+        else:
+            y = pitch.horiz_lines[name] * pitch.SCALE
+            ends = [[300, y], [500, y]]
+        segments.append(h.apply_to_points(np.array(ends), inverse=True).ravel())
+    df = pd.DataFrame(segments, columns=["x1", "y1", "x2", "y2"])
+    df["left"] = df["top"] = 0.0
+
+    snapshot = PitchImage(pitch, image=np.zeros((360, 720, 3), np.uint8))
+    # A wrong keypoint is rejected by RANSAC
+    snapshot.set_info(df, names, keypoints={"LG_U": [5.0, 5.0]})
+    result = snapshot.calibration
+    assert len(result["names"]) == 10 and result["names"][-1] == "LG_U"
+    assert result["inliers"].sum() == 9 and not result["inliers"][-1]
+    assert result["rms_error"] < 1e-3
+    assert np.allclose(snapshot.h.h, h.h / h.h[2, 2], rtol=1e-4, atol=1e-6)
+
+    # A second UP line, wrongly named DG, is left out of the refinement
+    snapshot.set_info(pd.concat([df, df.iloc[[3]]]), names + ["DG"])
+    assert snapshot.calibration["line_inliers"].tolist() == [True] * 6 + [False]
+    assert np.allclose(snapshot.h.h, h.h / h.h[2, 2], rtol=1e-4, atol=1e-6)
+
+    rng = np.random.default_rng(0)
+    pts_dst = np.array(list(pitch.get_intersections().values()))
+    homographies = np.stack([h.h @ np.diag([s, s, 1]) for s in rng.uniform(1, 2, 5)])
+    pts_src = project_points(pts_dst, np.linalg.inv(homographies))
+    corners = [
+        list(pitch.get_intersections()).index(name)
+        for name in ["LG_U", "LG_D", "RG_U", "RG_D"]
+    ]
+    pts_src[0, np.setdiff1d(np.arange(len(pts_dst)), corners)] = np.nan
+    pts_src[1, 3:] = np.nan
+    solved, errors = calibration.solve_homographies(pts_src, pts_dst)
+    assert np.allclose(solved[0], homographies[0] / homographies[0, 2, 2])
+    assert np.isnan(solved[1]).all() and np.isnan(errors[1])
+    assert np.allclose(solved[2:], homographies[2:] / homographies[2:, 2:, 2:])
+    assert (errors[[0, 2, 3, 4]] < 1e-6).all()
+
+
+def test_calibration_canvas_objects():
+    # Five lines and a keypoint drawn and named on the calibration canvas
+    pitch = FootballPitch()
+    h = Homography(PTS_SRC, PTS_DST)
+    names = ["UP", "DP", "RPA", "RG", "C", "RGA_UP"]
+    objects = []
+    for name in names[:5]:
+        if name in pitch.vert_lines:
+            x = pitch.vert_lines[name] * pitch.SCALE
+            ends = [[x, 110], [x, 240]]
+        else:
+            y = pitch.horiz_lines[name] * pitch.SCALE
+            ends = [[330, y], [500, y]]
+        (x1, y1), (x2, y2) = h.apply_to_points(np.array(ends), inverse=True)
+        # Line ends are relative to the centre of the line
+        left, top = (x1 + x2) / 2, (y1 + y2) / 2
+        objects.append(
+            {
+                "type": "line",
+                "left": left,
+                "top": top,
+                "x1": x1 - left,
+                "y1": y1 - top,
+                "x2": x2 - left,
+                "y2": y2 - top,
+            }
+        )
+    point = pitch.get_intersections()["RGA_UP"]
+    x, y = h.apply_to_points(np.array([point]), inverse=True)[0]
+    objects.append(
+        {"type": "circle", "left": x - 3, "top": y, "radius": 3, "originY": "center"}
+    )
+
+    df, lines, keypoints = helpers.split_calibration_objects(objects, names)
+    assert lines == names[:5] and np.allclose(keypoints["RGA_UP"], [x, y])
+    snapshot = PitchImage(pitch, image=np.zeros((360, 720, 3), np.uint8))
+    snapshot.set_info(df, lines, keypoints)
+    assert len(snapshot.calibration["names"]) == 7
+    assert snapshot.calibration["inliers"].all()
+    assert np.allclose(snapshot.h.h, h.h / h.h[2, 2], rtol=1e-4, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        helpers.split_calibration_objects(objects, names[:4] + ["UP", "RGA_UP"])
+
+
+def test_basketball_pitch():
+    court = PITCHES["Basketball"]
+    assert isinstance(court, BasketballPitch)
+    assert court.get_intersections() is court.get_intersections()
+    assert court.get_intersections()["RB_D"] == (28.7 * 18, 15.2 * 18)
+
+    # A camera looking at the right half of the court from the side
+    names = court.DEFAULT_LINES
+    corners = ["RFT_UL", "RFT_DL", "RB_UL", "RB_DL"]
+    pts_dst = [court.get_intersections()[name] for name in corners]
+    h = Homography([[150, 60], [80, 250], [420, 60], [520, 250]], pts_dst)
+    segments = []
+    for name in names:
+        if name in court.vert_lines:
+            x = court.vert_lines[name] * court.SCALE
+            ends = [[x, 100], [x, 150]]
+        else:
+            y = court.horiz_lines[name] * court.SCALE
+            ends = [[420, y], [500, y]]
+        segments.append(h.apply_to_points(np.array(ends), inverse=True).ravel())
+    df = pd.DataFrame(segments, columns=["x1", "y1", "x2", "y2"])
+    df["left"] = df["top"] = 0.0
+
+    snapshot = PitchImage(court, image=np.full((300, 600, 3), 128, np.uint8))
+    snapshot.set_info(df, names)
+    assert snapshot.h.im_size == (517, 274)
+    assert snapshot.conv_im.size == (517, 274)
+    assert np.allclose(snapshot.h.coord_converter, [5.17, 2.74])
+
+    positions = pd.DataFrame(
+        {"x": [80.0, 90.0, 95.0], "y": [30.0, 50.0, 70.0], "team": ["red"] * 3}
+    )
+    polygons = VoronoiPitch(positions).get_voronoi_polygons(snapshot, original=False)
+    clipped = [p["polygon"] for p in polygons if p["polygon"] is not None]
+    assert len(clipped) == 3 and (np.vstack(clipped) <= [517, 274]).all()
+    drawing = PitchDraw(snapshot, original=False)
+    drawing.draw_circles(positions[["x", "y"]].values, "red", size=2)
+    alpha = np.asarray(drawing.draw_im)[..., 3]
+    assert alpha[int(0.5 * 274), int(0.9 * 517)] > 0
+
+    assert get_pitch_diagram(court).shape == (547 + 60, 1033 + 60, 3)
+
+
+def test_import_time():
+    seconds, loaded = benchmark.measure_import("geometry")
+    assert loaded == []
+    assert benchmark.measure_import("calibration")[1] == []
+    assert benchmark.measure_import("pitch")[1] == []
+    helpers_seconds, loaded = benchmark.measure_import("helpers")
+    assert set(loaded) == {"pandas", "PIL"}
+    assert seconds < helpers_seconds
+
+
+def test_sessions():
+    assert sessions.get_session_id() is None
+    manager = sessions.SessionManager(max_sessions=2, max_bytes=3000, workers=2)
+    a, b = manager.get("a"), manager.get("b")
+    assert a is not b and manager.get("a") is a
+    a.cache.put("frame", np.zeros(2000, np.uint8))
+    b.cache.put("frame", np.zeros(2000, np.uint8))
+    # b is the most recently used, so a's cache is cleared
+    manager.get("b")
+    assert len(a.cache) == 0 and len(b.cache) == 1 and manager.nbytes == 2000
+
+    snapshot = get_test_snapshot()
+    b.cache.put("snapshot", snapshot)
+    assert sessions.get_object_nbytes(snapshot) == (720 * 360 + 600 * 300) * 3
+    assert b.run(lambda x: x + 1, 1) == 2
+
+    # A busy session takes one of the two shared workers, the other is free for
+    # the other sessions
+    started, release = threading.Event(), threading.Event()
+    busy = threading.Thread(
+        target=b.run, args=(lambda: started.set() or release.wait(),)
+    )
+    busy.start()
+    started.wait()
+    assert not b._running.acquire(blocking=False)
+    assert a.run(lambda: manager.workers.acquire(blocking=False)) is False
+    release.set()
+    busy.join()
+
+    manager.get("c")
+    assert list(manager.sessions) == ["b", "c"]
+    manager.expire(now=b.last_used + manager.idle_timeout + 1, keep="c")
+    assert list(manager.sessions) == ["c"] and len(b.cache) == 0
+
+
+def test_analytics():
+    columns = ["team", "x", "y", "x_start", "y_start", "x_end", "y_end"]
+    store = AnnotationStore(columns, {c: float for c in columns[1:]})
+    line = dict(x_start=20.0, y_start=40.0, x_end=20.0, y_end=60.0)
+    store.upsert(
+        pd.DataFrame(
+            [
+                dict(situation_id=1, team="Ball @ Start pass", x=0.0, y=50.0),
+                dict(
+                    situation_id=1,
+                    team="Intended pass receiver @ Start pass",
+                    x=50.0,
+                    y=50.0,
+                ),
+                dict(
+                    situation_id=1,
+                    team="Interception candidate @ Start pass",
+                    x=25.0,
+                    y=60.0,
+                ),
+                dict(
+                    situation_id=1,
+                    team="Body orientation visual line @ Start pass",
+                    x=20.0,
+                    y=50.0,
+                    **line,
+                ),
+                dict(
+                    situation_id=2,
+                    team="Interception candidate @ Start pass",
+                    x=10.0,
+                    y=10.0,
+                ),
+            ]
+        ).assign(object_id=[0, 1, 2, 3, 0])
+    )
+
+    candidates = analytics.query(store, roles="interception candidate")
+    assert candidates.index.get_level_values("situation_id").tolist() == [1, 2]
+    first = candidates.loc[1].iloc[0]
+    assert np.isclose(first["pass_distance"], 6.8)
+    assert np.isclose(first["pass_angle"], np.degrees(np.arctan2(6.8, 26.25)))
+    assert np.isnan(candidates.loc[2].iloc[0]["pass_distance"])
+    orientation = analytics.query(store, 1, "Body orientation visual line @ Start pass")
+    assert orientation["line_angle"].tolist() == [90.0]
+
+    areas = analytics.aggregate(store, by=("situation_id",), agg="sum")
+    assert np.allclose(areas["voronoi_area"], 105 * 68)
+    assert analytics.aggregate(store, by=("situation_id",), agg="sum") is areas
+    store.upsert(pd.DataFrame([dict(situation_id=2, object_id=0, x=90.0)]))
+    assert analytics.aggregate(store, by=("situation_id",), agg="sum") is not areas
+
+    # A new store, possibly at the address of a collected one, is not served the
+    # features of another store at the same version
+    dtypes, version = {c: float for c in columns[1:]}, store.version
+    del store
+    other = AnnotationStore(columns, dtypes)
+    candidate = dict(situation_id=3, object_id=0, team="Interception candidate")
+    other.upsert(pd.DataFrame([dict(candidate, x=10.0, y=10.0)]))
+    other.upsert(pd.DataFrame([dict(candidate, x=20.0, y=10.0)]))
+    assert other.version == version
+    assert analytics.query(other).index.get_level_values("situation_id").tolist() == [3]
@@ -0,0 +1,190 @@
+"""Linking of per-frame player positions into trajectories.
+
+Every track follows a constant velocity Kalman filter in metres on the pitch. On
+each frame, the predicted positions of all tracks are matched to the detections
+with the Hungarian algorithm, within a gating distance and within the same team
+when teams are known. Unmatched detections start new tracks, and tracks that are
+not matched for a number of frames are ended.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+
+from pitch import FootballPitch
+
+# Cost of impossible matches, above any gating distance
+NO_MATCH = 1e6
+
+
+class KalmanTracker:
+    """Multi-object tracker with one constant velocity Kalman filter per track.
+
+    The filters of all tracks are stored as stacked arrays and predicted and
+    updated together.
+    """
+
+    def __init__(
+        self,
+        dt=1 / 25,
+        max_distance=3.0,
+        max_missed=10,
+        acceleration=5.0,
+        measurement_noise=0.3,
+        initial_speed=5.0,
+    ):
+        """
+        Args:
+            dt (float, optional): Time between frames in seconds.
+            max_distance (float, optional): Maximal distance in metres between the
+                predicted position of a track and its detection.
+            max_missed (int, optional): Number of frames without detection after
+                which a track is ended.
+            acceleration (float, optional): Standard deviation of the accelerations
+                of the players in m/s².
+            measurement_noise (float, optional): Standard deviation of the detected
+                positions in metres.
+            initial_speed (float, optional): Standard deviation of the speed of a new
+                track in m/s.
+        """
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.initial_speed = initial_speed
+        self.F = np.eye(4)
+        self.F[0, 2] = self.F[1, 3] = dt
+        g = np.array([dt**2 / 2, dt**2 / 2, dt, dt])
+        self.Q = np.outer(g, g) * np.kron(np.ones((2, 2)), np.eye(2)) * acceleration**2
+        self.R = np.eye(2) * measurement_noise**2
+        self.x = np.zeros((0, 4))
+        self.P = np.zeros((0, 4, 4))
+        self.ids = np.zeros(0, dtype=int)
+        self.teams = np.zeros(0, dtype=object)
+        self.missed = np.zeros(0, dtype=int)
+        self.n_tracks = 0
+
+    def predict(self):
+        self.x = self.x @ self.F.T
+        self.P = self.F @ self.P @ self.F.T + self.Q
+
+    def match(self, positions, teams=None):
+        """Returns the (track, detection) index pairs matched by the Hungarian
+        algorithm."""
+        if len(self.x) == 0 or len(positions) == 0:
+            return np.zeros((0, 2), dtype=int)
+        cost = cdist(self.x[:, :2], positions)
+        cost[cost > self.max_distance] = NO_MATCH
+        if teams is not None:
+            cost[self.teams[:, None] != teams[None, :]] = NO_MATCH
+        tracks, detections = linear_sum_assignment(cost)
+        valid = cost[tracks, detections] < NO_MATCH
+        return np.c_[tracks[valid], detections[valid]]
+
+    def correct(self, tracks, positions):
+        """Updates the filters of some tracks with their detected positions."""
+        x, P = self.x[tracks], self.P[tracks]
+        S = P[:, :2, :2] + self.R
+        K = P[:, :, :2] @ np.linalg.inv(S)
+        self.x[tracks] = x + (K @ (positions - x[:, :2])[:, :, None])[:, :, 0]
+        self.P[tracks] = P - K @ P[:, :2, :]
+
+    def start(self, positions, teams):
+        """Starts new tracks at some positions."""
+        n = len(positions)
+        x = np.c_[positions, np.zeros((n, 2))]
+        P = np.diag(np.r_[np.diag(self.R), [self.initial_speed**2] * 2])
+        self.x = np.concatenate([self.x, x])
+        self.P = np.concatenate([self.P, np.repeat(P[None], n, axis=0)])
+        self.ids = np.r_[self.ids, np.arange(self.n_tracks, self.n_tracks + n)]
+        self.teams = np.r_[self.teams, np.asarray(teams, dtype=object)]
+        self.missed = np.r_[self.missed, np.zeros(n, dtype=int)]
+        self.n_tracks += n
+
+    def update(self, positions, teams=None):
+        """Processes the detections of the next frame.
+
+        Args:
+            positions (ndarray): Detected positions in metres, of size (n,2).
+            teams (ndarray, optional): Team of every detection.
+
+        Returns:
+            ndarray: The track id of every detection
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        teams = None if teams is None else np.asarray(teams, dtype=object)
+        self.predict()
+        pairs = self.match(positions, teams)
+        self.correct(pairs[:, 0], positions[pairs[:, 1]])
+
+        ids = np.full(len(positions), -1, dtype=int)
+        ids[pairs[:, 1]] = self.ids[pairs[:, 0]]
+        self.missed += 1
+        self.missed[pairs[:, 0]] = 0
+        alive = self.missed <= self.max_missed
+        self.x, self.P = self.x[alive], self.P[alive]
+        self.ids, self.teams = self.ids[alive], self.teams[alive]
+        self.missed = self.missed[alive]
+
+        new = ids == -1
+        ids[new] = np.arange(self.n_tracks, self.n_tracks + new.sum())
+        self.start(
+            positions[new], teams[new] if teams is not None else [None] * new.sum()
+        )
+        return ids
+
+    def get_positions(self):
+        """Returns the filtered positions in metres of the current tracks."""
+        return self.x[:, :2]
+
+
+def track_positions(detections, pitch=None, fps=25, **kwargs):
+    """Links the detections of a sequence of frames into trajectories.
+
+    Args:
+        detections (DataFrame): Detections with their "frame" index and position
+            "x", "y" in percent of the pitch, as returned by
+            get_converted_positional_data or fuse_detections, and optionally their
+            "team".
+        pitch (Pitch, optional): The pitch. Defaults to a FootballPitch.
+        fps (float, optional): Frame rate of the sequence.
+        **kwargs: Passed to KalmanTracker.
+
+    Returns:
+        tuple: A float32 array of size (frames, tracks, 2) with the filtered
+            position in metres of every track on every frame, NaN when the track
+            was not detected, and a DataFrame of the "track_id", "team",
+            "first_frame", "last_frame" and number of "detections" of every track
+    """
+    pitch = pitch if pitch is not None else FootballPitch()
+    detections = detections.dropna(subset=["x", "y"])
+    detections = detections.sort_values("frame", kind="stable")
+    frames = detections["frame"].values.astype(int)
+    positions = detections[["x", "y"]].values * [pitch.X_SIZE, pitch.Y_SIZE] / 100
+    teams = detections["team"].values if "team" in detections else None
+    n_frames = frames.max() + 1 if len(frames) else 0
+    bounds = np.searchsorted(frames, np.arange(n_frames + 1))
+
+    tracker = KalmanTracker(dt=1 / fps, **kwargs)
+    ids = np.zeros(len(frames), dtype=int)
+    filtered = np.zeros((len(frames), 2))
+    for frame in range(n_frames):
+        rows = slice(bounds[frame], bounds[frame + 1])
+        frame_ids = tracker.update(
+            positions[rows], teams[rows] if teams is not None else None
+        )
+        ids[rows] = frame_ids
+        # Track ids are sorted, as they are assigned in increasing order
+        index = np.searchsorted(tracker.ids, frame_ids)
+        filtered[rows] = tracker.get_positions()[index]
+
+    trajectories = np.full((n_frames, tracker.n_tracks, 2), np.nan, dtype=np.float32)
+    trajectories[frames, ids] = filtered
+    table = pd.DataFrame({"track_id": ids, "frame": frames})
+    table["team"] = teams if teams is not None else None
+    table = table.groupby("track_id").agg(
+        team=("team", "first"),
+        first_frame=("frame", "min"),
+        last_frame=("frame", "max"),
+        detections=("frame", "size"),
+    )
+    return trajectories, table.reset_index()
@@ -0,0 +1,151 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
+
+import cv2
+import numpy as np
+
+from cache import LRUCache
+
+
+class VideoReader:
+    """Random access to the frames of a video by index or by time.
+
+    A timestamp index is built once when the video is opened. Decoded frames are
+    kept in a bounded LRU cache and the neighbourhood of every requested frame is
+    decoded ahead of time in a background thread, so scrubbing back and forth does
+    not seek and re-decode from the previous keyframe on every request.
+    """
+
+    def __init__(self, path=None, data=None, cache_size=64, prefetch=8, seek_window=30):
+        """
+        Args:
+            path (str, optional): Path of a video file.
+            data (bytes, optional): Content of a video file, e.g. an upload. It is
+                written to a temporary file that lives as long as the reader.
+            cache_size (int, optional): Maximum number of decoded frames kept in memory.
+            prefetch (int, optional): Number of frames decoded on each side of a
+                requested frame. 0 disables prefetching.
+            seek_window (int, optional): Frames ahead of the decoder position that are
+                reached by decoding forward instead of seeking.
+        """
+        self._tmp_path = None
+        if data is not None:
+            fd, self._tmp_path = tempfile.mkstemp(suffix=".mp4")
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            path = self._tmp_path
+        self.path = path
+        self.video = cv2.VideoCapture(path)
+        if not self.video.isOpened():
+            self.close()
+            raise IOError(f"Could not open video {path}")
+        self.fps = self.video.get(cv2.CAP_PROP_FPS) or 25.0
+        self.prefetch = prefetch
+        self.seek_window = seek_window
+        self.frames = LRUCache(max_entries=cache_size)
+        self._lock = RLock()
+        self._pos = 0
+        self._generation = 0
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.timestamps = self._build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    @property
+    def duration(self):
+        """float: Duration of the video in seconds."""
+        if len(self.timestamps) == 0:
+            return 0.0
+        return float(self.timestamps[-1]) + 1 / self.fps
+
+    def _build_index(self):
+        """Grabs every frame once, without decoding to RGB, and records its
+        presentation time in seconds."""
+        timestamps = []
+        with self._lock:
+            while self.video.grab():
+                timestamps.append(self.video.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+            self._seek(0)
+        timestamps = np.array(timestamps, dtype=float)
+        if len(timestamps) and not np.all(np.diff(timestamps) > 0):
+            timestamps = np.arange(len(timestamps)) / self.fps
+        return timestamps
+
+    def _seek(self, index):
+        self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+        self._pos = index
+
+    def _decode(self, index):
+        with self._lock:
+            if not self._pos <= index < self._pos + self.seek_window:
+                self._seek(index)
+            while self._pos < index:
+                self.video.grab()
+                self._pos += 1
+            success, frame = self.video.read()
+            self._pos += 1
+        if not success:
+            return None
+        frame.flags.writeable = False
+        return self.frames.put(index, frame)
+
+    def _prefetch(self, index, generation):
+        start = max(0, index - self.prefetch)
+        stop = min(len(self), index + self.prefetch + 1)
+        # Frames ahead continue from the decoder position, frames behind need a seek
+        for index in [*range(index + 1, stop), *range(start, index)]:
+            if generation != self._generation or self.video is None:
+                return
+            if index not in self.frames:
+                self._decode(index)
+
+    def index_at(self, t):
+        """Returns the index of the frame shown at time t (in seconds)."""
+        index = np.searchsorted(self.timestamps, t, side="right") - 1
+        return int(np.clip(index, 0, len(self) - 1))
+
+    def get_frame(self, index):
+        """Returns the BGR frame at the given index as a read-only array.
+
+        Args:
+            index (int): Frame index, between 0 and len(self) - 1.
+
+        Returns:
+            ndarray: The decoded frame, or None if it could not be decoded
+        """
+        index = int(np.clip(index, 0, len(self) - 1))
+        frame = self.frames.get(index)
+        if frame is None:
+            frame = self._decode(index)
+        if self._executor is not None:
+            self._generation += 1
+            self._executor.submit(self._prefetch, index, self._generation)
+        return frame
+
+    def get_frame_at(self, t):
+        """Returns the BGR frame shown at time t (in seconds)."""
+        return self.get_frame(self.index_at(t))
+
+    def close(self):
+        if getattr(self, "_executor", None) is not None:
+            self._generation += 1
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if getattr(self, "video", None) is not None:
+            self.video.release()
+            self.video = None
+        if getattr(self, "_tmp_path", None) is not None:
+            os.remove(self._tmp_path)
+            self._tmp_path = None